@@ -0,0 +1,165 @@
+"""
+下载吞吐量基准测试：对比 FileResponse 分块读写与 socket.sendfile 零拷贝发送。
+
+用法：
+    python benchmarks/download_throughput.py --size-mb 512 --rounds 3
+
+脚本会在临时目录中启动 server_simple.py（通过 TRANSFER_DATA_DIR 指定数据目录），
+同时启动一个只用 socket.sendfile 发送同一个文件的最小 HTTP 服务作为零拷贝上限参考，
+分别测量完整下载和 Range 下载的吞吐量，并以 JSON 输出结果。
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+READ_SIZE = 1024 * 1024
+
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"服务在 {timeout} 秒内没有监听端口 {port}")
+
+
+def serve_with_sendfile(listener: socket.socket, file_path: Path, stop_event: threading.Event):
+    """极简 HTTP 服务：读完请求头后直接用 sendfile 发送整个文件或单个 Range"""
+    file_size = file_path.stat().st_size
+    listener.settimeout(0.5)
+    while not stop_event.is_set():
+        try:
+            conn, _ = listener.accept()
+        except socket.timeout:
+            continue
+        with conn, file_path.open("rb") as source:
+            request = b""
+            while b"\r\n\r\n" not in request:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                request += data
+            start, end = 0, file_size
+            for line in request.decode("latin-1").split("\r\n"):
+                if line.lower().startswith("range: bytes="):
+                    first, last = line.split("=", 1)[1].split("-", 1)
+                    start, end = int(first), int(last) + 1
+            status = "206 Partial Content" if (start, end) != (0, file_size) else "200 OK"
+            headers = (
+                f"HTTP/1.1 {status}\r\nContent-Length: {end - start}\r\n"
+                f"Content-Type: application/octet-stream\r\nConnection: close\r\n\r\n"
+            )
+            conn.sendall(headers.encode("latin-1"))
+            conn.sendfile(source, offset=start, count=end - start)
+
+
+def download(port: int, path: str, range_header: str | None = None) -> tuple[int, float]:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    headers = {"Range": range_header} if range_header else {}
+    started = time.perf_counter()
+    connection.request("GET", path, headers=headers)
+    response = connection.getresponse()
+    received = 0
+    while True:
+        chunk = response.read(READ_SIZE)
+        if not chunk:
+            break
+        received += len(chunk)
+    elapsed = time.perf_counter() - started
+    connection.close()
+    if response.status not in (200, 206):
+        raise RuntimeError(f"{path} 返回状态码 {response.status}")
+    return received, elapsed
+
+
+def measure(port: int, path: str, rounds: int, range_header: str | None = None) -> dict:
+    throughputs = []
+    for _ in range(rounds):
+        received, elapsed = download(port, path, range_header)
+        throughputs.append(received / elapsed / 1024 / 1024)
+    return {
+        "bytes": received,
+        "best_mb_s": round(max(throughputs), 1),
+        "mean_mb_s": round(sum(throughputs) / len(throughputs), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=256, help="测试文件大小（MB）")
+    parser.add_argument("--rounds", type=int, default=3, help="每种方式重复下载的次数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="transfer-bench-") as data_dir:
+        shared_dir = Path(data_dir) / "shared_files"
+        shared_dir.mkdir()
+        file_path = shared_dir / "bench.bin"
+        block = os.urandom(READ_SIZE)
+        with file_path.open("wb") as output_file:
+            for _ in range(args.size_mb):
+                output_file.write(block)
+        file_size = file_path.stat().st_size
+        half_range = f"bytes={file_size // 2}-{file_size - 1}"
+
+        server_port = find_free_port()
+        env = dict(os.environ, TRANSFER_DATA_DIR=data_dir)
+        server = subprocess.Popen(
+            [sys.executable, str(ROOT_DIR / "server_simple.py"), str(server_port)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        sendfile_port = listener.getsockname()[1]
+        stop_event = threading.Event()
+        sendfile_thread = threading.Thread(
+            target=serve_with_sendfile, args=(listener, file_path, stop_event), daemon=True
+        )
+        sendfile_thread.start()
+
+        try:
+            wait_for_port(server_port)
+            results = {
+                "file_size": file_size,
+                "rounds": args.rounds,
+                "file_response": {
+                    "full": measure(server_port, "/download/bench.bin", args.rounds),
+                    "range": measure(server_port, "/download/bench.bin", args.rounds, half_range),
+                },
+                "sendfile": {
+                    "full": measure(sendfile_port, "/", args.rounds),
+                    "range": measure(sendfile_port, "/", args.rounds, half_range),
+                },
+            }
+        finally:
+            stop_event.set()
+            server.terminate()
+            server.wait(timeout=10)
+            sendfile_thread.join(timeout=5)
+            listener.close()
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+加密传输吞吐量基准测试：对比明文上传/下载与 AES-GCM 分帧加密上传/下载。
+
+用法：
+    python benchmarks/encrypted_throughput.py --size-mb 1024 --rounds 2
+
+脚本会在临时目录中启动 server_simple.py（通过 TRANSFER_DATA_DIR 指定数据目录，
+TRANSFER_CONFIG 指向带 pre_shared_key 的临时配置），分别测量：
+    - 明文：流式 PUT 到断点续传会话，以及 /download 下载
+    - 加密：secure_transfer 客户端上传到 /upload_encrypted，以及从 /download_encrypted 下载并解密
+另外单独测量本机 AES-GCM 加密/解密的纯计算速度，用来判断瓶颈在 CPU 还是网络栈。
+结果以 JSON 输出。
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from download_throughput import ROOT_DIR, READ_SIZE, find_free_port, wait_for_port  # noqa: E402
+from secure_transfer import DEFAULT_FRAME_SIZE, StreamDecryptor, StreamEncryptor, download, upload  # noqa: E402
+
+BENCH_KEY = "benchmark-only-pre-shared-key"
+
+
+def iter_file(file_path: Path):
+    with file_path.open("rb") as input_file:
+        while True:
+            chunk = input_file.read(READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def plain_upload(port: int, file_path: Path) -> float:
+    size = file_path.stat().st_size
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    started = time.perf_counter()
+    connection.request("POST", "/upload_session", body=f"filename={file_path.name}&size={size}&target=received",
+                       headers={"Content-Type": "application/x-www-form-urlencoded"})
+    session_id = json.loads(connection.getresponse().read())["session_id"]
+    connection.request("PUT", f"/upload_session/{session_id}?offset=0", body=iter_file(file_path),
+                       headers={"Content-Length": str(size)})
+    connection.getresponse().read()
+    connection.request("POST", f"/upload_session/{session_id}/complete")
+    response = connection.getresponse()
+    response.read()
+    elapsed = time.perf_counter() - started
+    connection.close()
+    if response.status != 200:
+        raise RuntimeError(f"明文上传返回状态码 {response.status}")
+    return elapsed
+
+
+def plain_download(port: int, file_id: str) -> float:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    started = time.perf_counter()
+    connection.request("GET", f"/download/{file_id}")
+    response = connection.getresponse()
+    while response.read(READ_SIZE):
+        pass
+    elapsed = time.perf_counter() - started
+    connection.close()
+    if response.status != 200:
+        raise RuntimeError(f"明文下载返回状态码 {response.status}")
+    return elapsed
+
+
+def timed(function, *args) -> float:
+    started = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started
+
+
+def measure(size: int, rounds: int, function, *args) -> dict:
+    throughputs = [size / function(*args) / 1024 / 1024 for _ in range(rounds)]
+    return {
+        "best_mb_s": round(max(throughputs), 1),
+        "mean_mb_s": round(sum(throughputs) / len(throughputs), 1),
+    }
+
+
+def cipher_only(size_mb: int) -> dict:
+    """不经过网络，只测 AES-GCM 分帧加解密本身的速度"""
+    key = BENCH_KEY.encode("utf-8")
+    block = os.urandom(DEFAULT_FRAME_SIZE)
+    encryptor = StreamEncryptor(key)
+    started = time.perf_counter()
+    frames = [encryptor.header] + [encryptor.encrypt_frame(block) for _ in range(size_mb)]
+    frames.append(encryptor.encrypt_frame(b"", final=True))
+    encrypt_elapsed = time.perf_counter() - started
+
+    decryptor = StreamDecryptor(key)
+    started = time.perf_counter()
+    for frame in frames:
+        decryptor.feed(frame)
+    decryptor.finish()
+    decrypt_elapsed = time.perf_counter() - started
+    return {
+        "encrypt_mb_s": round(size_mb / encrypt_elapsed, 1),
+        "decrypt_mb_s": round(size_mb / decrypt_elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=1024, help="测试文件大小（MB）")
+    parser.add_argument("--rounds", type=int, default=2, help="每种方式重复的次数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="transfer-bench-") as data_dir:
+        shared_dir = Path(data_dir) / "shared_files"
+        shared_dir.mkdir()
+        file_path = shared_dir / "bench.bin"
+        block = os.urandom(READ_SIZE)
+        with file_path.open("wb") as output_file:
+            for _ in range(args.size_mb):
+                output_file.write(block)
+        file_size = file_path.stat().st_size
+        config_path = Path(data_dir) / "config.json"
+        config_path.write_text(json.dumps({"pre_shared_key": BENCH_KEY}), encoding="utf-8")
+        output_path = Path(data_dir) / "downloaded.bin"
+
+        server_port = find_free_port()
+        server_url = f"http://127.0.0.1:{server_port}"
+        key = BENCH_KEY.encode("utf-8")
+        env = dict(os.environ, TRANSFER_DATA_DIR=data_dir, TRANSFER_CONFIG=str(config_path))
+        server = subprocess.Popen(
+            [sys.executable, str(ROOT_DIR / "server_simple.py"), str(server_port)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_port(server_port)
+            results = {
+                "file_size": file_size,
+                "rounds": args.rounds,
+                "cipher_only": cipher_only(min(args.size_mb, 256)),
+                "plain": {
+                    "upload": measure(file_size, args.rounds, plain_upload, server_port, file_path),
+                    "download": measure(file_size, args.rounds, plain_download, server_port, file_path.name),
+                },
+                "encrypted": {
+                    "upload": measure(file_size, args.rounds, timed, upload, server_url, file_path, "received", key),
+                    "download": measure(file_size, args.rounds, timed, download, server_url, file_path.name,
+                                        "shared", output_path, key),
+                },
+            }
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+
+    for direction in ("upload", "download"):
+        plain = results["plain"][direction]["mean_mb_s"]
+        encrypted = results["encrypted"][direction]["mean_mb_s"]
+        results["encrypted"][direction]["relative_to_plain"] = round(encrypted / plain, 2) if plain else None
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
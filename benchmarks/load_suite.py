@@ -0,0 +1,381 @@
+"""
+接口负载基准测试：在本地启动服务，对 /upload、/download、/files、/preview 运行可配置的负载。
+
+用法：
+    python benchmarks/load_suite.py --concurrency 1,8,32 --duration 10 --output result.json
+    python benchmarks/load_suite.py --baseline result.json --threshold 0.1
+
+脚本会在临时目录中准备数据并启动 server_simple.py（通过 TRANSFER_DATA_DIR / TRANSFER_CONFIG
+指定数据目录和配置）：
+    - shared_files 中生成 --listing-entries 个小文件，用来测试大目录下的列表分页
+    - 按 --size-mix 生成下载用的文件，上传也按同样的大小分布发送（每次内容不同，不会命中秒传）
+    - 生成几个多 MB 的文本文件，随机偏移分页预览
+
+每个场景在每个并发数下运行 --duration 秒，统计吞吐量（请求/秒、MB/秒）、
+p50/p95/p99 延迟和服务进程（含所有工作进程）的内存峰值，以 JSON 输出。
+指定 --baseline 时与之前保存的结果对比，吞吐量下降或 p95 延迟上升超过 --threshold 时以退出码 1 结束。
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，只能依赖采样得到的内存峰值
+    resource = None
+
+from download_throughput import ROOT_DIR, READ_SIZE, find_free_port, wait_for_port
+
+SCENARIOS = ("upload", "download", "files", "preview")
+SIZE_UNITS = {"k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024}
+PREVIEW_FILE_COUNT = 4
+PREVIEW_FILE_SIZE = 8 * 1024 * 1024
+DOWNLOAD_FILES_PER_SIZE = 8
+RSS_SAMPLE_INTERVAL = 0.2
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    if text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def parse_size_mix(text: str) -> list[tuple[int, int]]:
+    """解析 "4k:60,256k:30,4m:10" 形式的大小分布，返回 (字节数, 权重) 列表"""
+    mix = []
+    for part in text.split(","):
+        size, _, weight = part.partition(":")
+        mix.append((parse_size(size), int(weight or 1)))
+    return mix
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    position = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[position]
+
+
+class RssSampler:
+    """定期采样服务进程及其子进程的常驻内存之和，记录峰值（仅 Linux 可用 /proc）"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_bytes = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def process_tree(self) -> list[int]:
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            try:
+                children = Path(f"/proc/{pid}/task/{pid}/children").read_text().split()
+            except OSError:
+                continue
+            pending.extend(int(child) for child in children)
+        return pids
+
+    def sample(self) -> int:
+        total = 0
+        for pid in self.process_tree():
+            try:
+                for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            except OSError:
+                continue
+        return total
+
+    def run(self):
+        while not self.stop_event.wait(RSS_SAMPLE_INTERVAL):
+            self.peak_bytes = max(self.peak_bytes, self.sample())
+
+    def start(self):
+        if Path("/proc").is_dir():
+            self.thread.start()
+
+    def reset(self) -> int:
+        peak, self.peak_bytes = self.peak_bytes, 0
+        return peak
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+class Workload:
+    """单个场景的请求生成器：每次调用返回 (方法, 路径, 请求体, 请求头)"""
+
+    def __init__(self, scenario: str, fixtures: dict, size_mix: list[tuple[int, int]], seed: int):
+        self.scenario = scenario
+        self.fixtures = fixtures
+        self.sizes = [size for size, _ in size_mix]
+        self.weights = [weight for _, weight in size_mix]
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def next_request(self) -> tuple[str, str, bytes | None, dict]:
+        if self.scenario == "upload":
+            with self.lock:
+                size = self.random.choices(self.sizes, self.weights)[0]
+            return self.upload_request(size)
+        with self.lock:
+            if self.scenario == "download":
+                size = self.random.choices(self.sizes, self.weights)[0]
+                name = self.random.choice(self.fixtures["download"][size])
+                return "GET", f"/download/{name}", None, {}
+            if self.scenario == "files":
+                sort = self.random.choice(["mtime", "name", "size"])
+                return "GET", f"/files?limit=200&sort={sort}", None, {}
+            name = self.random.choice(self.fixtures["preview"])
+            offset = self.random.randrange(0, PREVIEW_FILE_SIZE - 65536)
+            return "GET", f"/preview/{name}?offset={offset}&length=65536", None, {}
+
+    def upload_request(self, size: int) -> tuple[str, str, bytes, dict]:
+        boundary = uuid.uuid4().hex
+        payload = self.fixtures["payloads"][size]
+        # 每次在开头写入不同的标记，避免重复内容被秒传
+        content = uuid.uuid4().bytes + payload[16:]
+        body = (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"upload-{size}.bin\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("latin-1") + content + f"\r\n--{boundary}--\r\n".encode("latin-1")
+        return "POST", "/upload", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def run_client(port: int, workload: Workload, deadline: float, latencies: list, counters: dict, lock):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    local_latencies = []
+    requests = errors = bytes_sent = bytes_received = 0
+    while time.perf_counter() < deadline:
+        method, path, body, headers = workload.next_request()
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            received = 0
+            while True:
+                chunk = response.read(READ_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+            errors += 1
+            continue
+        local_latencies.append(time.perf_counter() - started)
+        requests += 1
+        bytes_sent += len(body or b"")
+        bytes_received += received
+        if response.status >= 400:
+            errors += 1
+    connection.close()
+    with lock:
+        latencies.extend(local_latencies)
+        counters["requests"] += requests
+        counters["errors"] += errors
+        counters["bytes"] += bytes_sent + bytes_received
+
+
+def run_scenario(port: int, workload: Workload, concurrency: int, duration: float, sampler: RssSampler) -> dict:
+    latencies, lock = [], threading.Lock()
+    counters = {"requests": 0, "errors": 0, "bytes": 0}
+    sampler.reset()
+    started = time.perf_counter()
+    deadline = started + duration
+    clients = [
+        threading.Thread(target=run_client, args=(port, workload, deadline, latencies, counters, lock))
+        for _ in range(concurrency)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": counters["requests"],
+        "errors": counters["errors"],
+        "requests_per_second": round(counters["requests"] / elapsed, 1),
+        "mb_per_second": round(counters["bytes"] / elapsed / 1024 / 1024, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+        },
+        "peak_rss_mb": round(max(sampler.reset(), sampler.sample()) / 1024 / 1024, 1),
+    }
+
+
+def prepare_fixtures(data_dir: Path, size_mix: list[tuple[int, int]], listing_entries: int, seed: int) -> dict:
+    shared_dir = data_dir / "shared_files"
+    shared_dir.mkdir()
+    generator = random.Random(seed)
+    for number in range(listing_entries):
+        (shared_dir / f"entry-{number:06d}.txt").write_bytes(b"x" * generator.randrange(1, 512))
+
+    fixtures = {"download": {}, "payloads": {}, "preview": []}
+    for size, _ in size_mix:
+        payload = generator.randbytes(size)
+        fixtures["payloads"][size] = payload
+        names = []
+        for number in range(DOWNLOAD_FILES_PER_SIZE):
+            name = f"download-{size}-{number}.bin"
+            (shared_dir / name).write_bytes(number.to_bytes(4, "big") + payload[4:])
+            names.append(name)
+        fixtures["download"][size] = names
+
+    line = "局域网文件传输 preview benchmark line with some ascii text\n".encode("utf-8")
+    for number in range(PREVIEW_FILE_COUNT):
+        name = f"preview-{number}.txt"
+        with (shared_dir / name).open("wb") as output_file:
+            output_file.write(line * (PREVIEW_FILE_SIZE // len(line) + 1))
+        fixtures["preview"].append(name)
+    return fixtures
+
+
+def describe_environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                                text=True, check=False).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "commit": commit,
+    }
+
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """吞吐量下降或 p95 延迟上升超过阈值的记录视为性能回退"""
+    regressions = []
+    baseline_runs = {
+        (scenario, run["concurrency"]): run
+        for scenario, runs in baseline.get("scenarios", {}).items() for run in runs
+    }
+    for scenario, runs in results["scenarios"].items():
+        for run in runs:
+            previous = baseline_runs.get((scenario, run["concurrency"]))
+            if previous is None:
+                continue
+            label = f"{scenario} x{run['concurrency']}"
+            old_rps, new_rps = previous["requests_per_second"], run["requests_per_second"]
+            if old_rps and new_rps < old_rps * (1 - threshold):
+                regressions.append(f"{label}: 吞吐量 {old_rps} -> {new_rps} 请求/秒")
+            old_error_rate = previous["errors"] / max(previous["requests"], 1)
+            new_error_rate = run["errors"] / max(run["requests"], 1)
+            if new_error_rate > old_error_rate + threshold:
+                regressions.append(f"{label}: 错误率 {old_error_rate:.1%} -> {new_error_rate:.1%}")
+            old_p95, new_p95 = previous["latency_ms"]["p95"], run["latency_ms"]["p95"]
+            if old_p95 and new_p95 > old_p95 * (1 + threshold):
+                regressions.append(f"{label}: p95 延迟 {old_p95} -> {new_p95} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="要运行的场景，逗号分隔")
+    parser.add_argument("--concurrency", default="1,8,32", help="并发连接数，逗号分隔")
+    parser.add_argument("--duration", type=float, default=10, help="每个场景每个并发数的运行秒数")
+    parser.add_argument("--size-mix", default="4k:60,256k:30,4m:10", help="上传/下载文件大小分布，大小:权重")
+    parser.add_argument("--listing-entries", type=int, default=10000, help="共享目录中的文件数")
+    parser.add_argument("--workers", type=int, default=1, help="服务器工作进程数")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子，相同种子生成相同的数据和请求序列")
+    parser.add_argument("--output", help="结果保存路径，默认只输出到标准输出")
+    parser.add_argument("--baseline", help="用于对比的历史结果文件")
+    parser.add_argument("--threshold", type=float, default=0.1, help="允许的性能回退比例")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {', '.join(sorted(unknown))}")
+    concurrency_levels = [int(value) for value in args.concurrency.split(",")]
+    size_mix = parse_size_mix(args.size_mix)
+
+    with tempfile.TemporaryDirectory(prefix="transfer-bench-") as data_dir:
+        data_path = Path(data_dir)
+        fixtures = prepare_fixtures(data_path, size_mix, args.listing_entries, args.seed)
+        config_path = data_path / "config.json"
+        # 基准测试关注处理能力，放宽上传准入限制，避免大量 503 干扰结果
+        config_path.write_text(json.dumps({
+            "workers": args.workers,
+            "max_concurrent_uploads": 1024,
+            "max_inflight_upload_bytes": 2 ** 36,
+        }), encoding="utf-8")
+
+        port = find_free_port()
+        env = dict(os.environ, TRANSFER_DATA_DIR=data_dir, TRANSFER_CONFIG=str(config_path))
+        server = subprocess.Popen(
+            [sys.executable, str(ROOT_DIR / "server_simple.py"), str(port)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        sampler = RssSampler(server.pid)
+        results = {
+            "environment": describe_environment(),
+            "settings": {
+                "duration": args.duration,
+                "size_mix": args.size_mix,
+                "listing_entries": args.listing_entries,
+                "workers": args.workers,
+                "seed": args.seed,
+            },
+            "scenarios": {},
+        }
+        try:
+            wait_for_port(port)
+            sampler.start()
+            for scenario in scenarios:
+                workload = Workload(scenario, fixtures, size_mix, args.seed)
+                results["scenarios"][scenario] = [
+                    run_scenario(port, workload, concurrency, args.duration, sampler)
+                    for concurrency in concurrency_levels
+                ]
+        finally:
+            sampler.stop()
+            server.terminate()
+            server.wait(timeout=30)
+
+    # 服务进程退出后，子进程资源统计里的 ru_maxrss 是单个进程的内存峰值（Linux 单位为 KB）
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        results["peak_process_rss_mb"] = round(max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output, encoding="utf-8")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        if regressions:
+            print(f"发现 {len(regressions)} 项性能回退（阈值 {args.threshold:.0%}）:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  - {regression}", file=sys.stderr)
+            sys.exit(1)
+        print("与基准结果相比没有超过阈值的性能回退", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+块级增量同步（rsync 式）：更新服务器上已有的大文件时只发送变化的数据
+
+签名：GET /delta_signature/文件名 返回旧文件按固定大小分块后每块的弱校验和（adler32）
+      与强校验和（blake2b 前 16 字节），以及代表旧文件版本的 base。
+增量流：客户端用滚动校验和在新文件中逐字节查找与旧文件相同的块，生成指令序列：
+    C + 起始块号(4 字节) + 块数(4 字节)   复制旧文件中连续的若干块
+    L + 长度(4 字节) + 数据               新数据
+    E + sha256(32 字节)                   结束，服务器校验重建后的完整文件
+服务器边接收边把新版本写入临时文件，校验通过后原子替换旧文件，或另存为新版本。
+
+用法：
+    python delta_sync.py 本地文件 --server http://192.168.0.197:8000
+    python delta_sync.py 本地文件 --server http://192.168.0.197:8000 --name 服务器上的文件名 --new-version
+"""
+import argparse
+import base64
+import hashlib
+import http.client
+import json
+import math
+import struct
+import sys
+import time
+import zlib
+from pathlib import Path
+from urllib.parse import quote, urlencode
+
+from secure_transfer import open_connection
+
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+MAX_LITERAL_SIZE = 1024 * 1024
+STRONG_SIZE = 16
+ADLER_MOD = 65521
+COPY_OP = b"C"
+LITERAL_OP = b"L"
+END_OP = b"E"
+COPY_STRUCT = struct.Struct(">II")
+LITERAL_STRUCT = struct.Struct(">I")
+WEAK_STRUCT = struct.Struct(">I")
+DIGEST_SIZE = 32
+DELTA_MEDIA_TYPE = "application/vnd.lan-transfer.delta"
+
+
+class DeltaFormatError(ValueError):
+    """增量数据格式错误，或重建结果与客户端的校验和不一致"""
+
+
+def choose_block_size(size: int) -> int:
+    """块大小取文件大小的平方根附近的 2 的幂，兼顾签名大小和匹配粒度"""
+    if size <= 0:
+        return MIN_BLOCK_SIZE
+    block_size = 1 << math.ceil(math.log2(math.sqrt(size)))
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def strong_checksum(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def compute_signature(file_path: Path, block_size: int) -> dict:
+    """逐块读取文件，计算每块的弱校验和与强校验和"""
+    weak = bytearray()
+    strong = bytearray()
+    size = 0
+    with file_path.open("rb") as input_file:
+        while True:
+            block = input_file.read(block_size)
+            if not block:
+                break
+            weak += WEAK_STRUCT.pack(zlib.adler32(block))
+            strong += strong_checksum(block)
+            size += len(block)
+    return {
+        "block_size": block_size,
+        "size": size,
+        "weak": base64.b64encode(bytes(weak)).decode("ascii"),
+        "strong": base64.b64encode(bytes(strong)).decode("ascii"),
+    }
+
+
+def decode_signature(signature: dict) -> tuple[int, int, list[int], list[bytes]]:
+    weak_data = base64.b64decode(signature["weak"])
+    strong_data = base64.b64decode(signature["strong"])
+    weak = [value for (value,) in WEAK_STRUCT.iter_unpack(weak_data)]
+    strong = [strong_data[index:index + STRONG_SIZE] for index in range(0, len(strong_data), STRONG_SIZE)]
+    return signature["block_size"], signature["size"], weak, strong
+
+
+def roll_adler32(checksum: int, removed: int, added: int, block_size: int) -> int:
+    """窗口右移一个字节后的 adler32，与 zlib.adler32 对新窗口的计算结果相同"""
+    a = checksum & 0xFFFF
+    b = checksum >> 16
+    a = (a - removed + added) % ADLER_MOD
+    b = (b - block_size * removed - 1 + a) % ADLER_MOD
+    return (b << 16) | a
+
+
+def iter_delta(file_path: Path, signature: dict, stats: dict | None = None):
+    """
+    边读新文件边生成把旧文件变成新文件的增量指令。整块匹配时直接跳过一个块，
+    只有不匹配的区域才逐字节滚动，未修改的部分几乎不消耗计算；内存中只保留尚未发出的数据。
+    """
+    block_size, base_size, weak, strong = decode_signature(signature)
+    full_blocks = base_size // block_size
+    tail_size = base_size - full_blocks * block_size
+    table: dict[int, list[int]] = {}
+    for index in range(full_blocks):
+        table.setdefault(weak[index], []).append(index)
+
+    stats = stats if stats is not None else {}
+    stats.update(literal_bytes=0, copied_bytes=0)
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    copy = [0, 0]
+
+    def literal(end: int):
+        for start in range(0, end, MAX_LITERAL_SIZE):
+            chunk = bytes(buffer[start:min(start + MAX_LITERAL_SIZE, end)])
+            stats["literal_bytes"] += len(chunk)
+            yield LITERAL_OP + LITERAL_STRUCT.pack(len(chunk)) + chunk
+        del buffer[:end]
+
+    def flush_copy():
+        if copy[1]:
+            yield COPY_OP + COPY_STRUCT.pack(copy[0], copy[1])
+            copy[1] = 0
+
+    def add_copy(index: int, size: int):
+        # 连续的块合并成一条复制指令
+        stats["copied_bytes"] += size
+        if copy[1] and copy[0] + copy[1] == index:
+            copy[1] += 1
+            return []
+        pending = list(flush_copy())
+        copy[0], copy[1] = index, 1
+        return pending
+
+    def find_block(position: int, checksum: int) -> int | None:
+        candidates = table.get(checksum)
+        if not candidates:
+            return None
+        block_strong = strong_checksum(buffer[position:position + block_size])
+        for index in candidates:
+            if strong[index] == block_strong:
+                return index
+        return None
+
+    with file_path.open("rb") as input_file:
+        eof = False
+        position = 0
+        checksum = None
+        while True:
+            if position + block_size >= len(buffer) and not eof:
+                chunk = input_file.read(MAX_BLOCK_SIZE)
+                eof = not chunk
+                digest.update(chunk)
+                buffer += chunk
+                continue
+            if position + block_size > len(buffer):
+                break
+            if checksum is None:
+                checksum = zlib.adler32(buffer[position:position + block_size])
+            index = find_block(position, checksum)
+            if index is None:
+                # 不匹配时窗口右移一个字节继续查找，积累的新数据达到上限就先发出去
+                if position + block_size < len(buffer):
+                    checksum = roll_adler32(checksum, buffer[position], buffer[position + block_size], block_size)
+                else:
+                    checksum = None
+                position += 1
+                if position >= MAX_LITERAL_SIZE:
+                    yield from flush_copy()
+                    yield from literal(position)
+                    position = 0
+                continue
+            if position:
+                yield from flush_copy()
+                yield from literal(position)
+            yield from add_copy(index, block_size)
+            del buffer[:block_size]
+            position = 0
+            checksum = None
+
+    # 旧文件末尾不足一块的部分只能与新文件的末尾对齐匹配
+    tail_matched = False
+    if tail_size and len(buffer) >= tail_size:
+        tail = bytes(buffer[len(buffer) - tail_size:])
+        tail_matched = zlib.adler32(tail) == weak[full_blocks] and strong_checksum(tail) == strong[full_blocks]
+    literal_end = len(buffer) - tail_size if tail_matched else len(buffer)
+    if literal_end:
+        yield from flush_copy()
+        yield from literal(literal_end)
+    if tail_matched:
+        yield from add_copy(full_blocks, tail_size)
+    yield from flush_copy()
+    yield END_OP + digest.digest()
+
+
+class DeltaApplier:
+    """
+    增量解析指令流并写出新文件：复制指令从旧文件读取，新数据直接写入。
+    每次喂入任意长度的数据，只缓存不完整的指令，内存占用与文件大小无关。
+    """
+
+    def __init__(self, base_file, base_size: int, block_size: int, write):
+        self.base_file = base_file
+        self.base_size = base_size
+        self.block_size = block_size
+        self.block_count = (base_size + block_size - 1) // block_size
+        self.write = write
+        self.buffer = bytearray()
+        self.digest = hashlib.sha256()
+        self.literal_remaining = 0
+        self.written = 0
+        self.literal_bytes = 0
+        self.finished = False
+
+    def emit(self, data: bytes):
+        self.write(data)
+        self.digest.update(data)
+        self.written += len(data)
+
+    def copy_blocks(self, start: int, count: int):
+        if count == 0 or start + count > self.block_count:
+            raise DeltaFormatError("复制指令超出旧文件范围")
+        offset = start * self.block_size
+        end = min((start + count) * self.block_size, self.base_size)
+        self.base_file.seek(offset)
+        while offset < end:
+            chunk = self.base_file.read(min(MAX_BLOCK_SIZE, end - offset))
+            if not chunk:
+                raise DeltaFormatError("旧文件在同步过程中被修改")
+            self.emit(chunk)
+            offset += len(chunk)
+
+    def feed(self, data: bytes):
+        self.buffer.extend(data)
+        position = 0
+        while position < len(self.buffer):
+            if self.finished:
+                raise DeltaFormatError("结束指令之后还有多余数据")
+            if self.literal_remaining:
+                take = min(self.literal_remaining, len(self.buffer) - position)
+                self.emit(bytes(self.buffer[position:position + take]))
+                self.literal_bytes += take
+                self.literal_remaining -= take
+                position += take
+                continue
+            op = self.buffer[position:position + 1]
+            if op == COPY_OP:
+                if len(self.buffer) - position < 1 + COPY_STRUCT.size:
+                    break
+                self.copy_blocks(*COPY_STRUCT.unpack_from(self.buffer, position + 1))
+                position += 1 + COPY_STRUCT.size
+            elif op == LITERAL_OP:
+                if len(self.buffer) - position < 1 + LITERAL_STRUCT.size:
+                    break
+                (self.literal_remaining,) = LITERAL_STRUCT.unpack_from(self.buffer, position + 1)
+                if self.literal_remaining > MAX_LITERAL_SIZE:
+                    raise DeltaFormatError("数据指令过长")
+                position += 1 + LITERAL_STRUCT.size
+            elif op == END_OP:
+                if len(self.buffer) - position < 1 + DIGEST_SIZE:
+                    break
+                expected = bytes(self.buffer[position + 1:position + 1 + DIGEST_SIZE])
+                if expected != self.digest.digest():
+                    raise DeltaFormatError("重建后的文件校验失败")
+                self.finished = True
+                position += 1 + DIGEST_SIZE
+            else:
+                raise DeltaFormatError("未知的增量指令")
+        del self.buffer[:position]
+
+    def finish(self):
+        if not self.finished or self.buffer or self.literal_remaining:
+            raise DeltaFormatError("增量数据不完整")
+
+
+def request_json(connection: http.client.HTTPConnection, method: str, path: str, **kwargs) -> tuple[int, dict]:
+    connection.request(method, path, **kwargs)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read() or b"{}")
+
+
+def sync(server: str, file_path: Path, name: str, target: str, new_version: bool) -> dict:
+    connection, prefix = open_connection(server)
+    try:
+        status, signature = request_json(
+            connection, "GET", f"{prefix}/delta_signature/{quote(name)}?{urlencode({'target': target})}")
+        if status != 200:
+            raise SystemExit(f"获取签名失败 ({status}): {signature.get('message')}")
+
+        stats = {}
+        query = urlencode({
+            "target": target,
+            "base": signature["base"],
+            "block_size": signature["block_size"],
+            "mode": "version" if new_version else "replace",
+        })
+        status, result = request_json(
+            connection, "POST", f"{prefix}/delta_apply/{quote(name)}?{query}",
+            body=iter_delta(file_path, signature, stats), encode_chunked=True,
+            headers={"Content-Type": DELTA_MEDIA_TYPE, "Transfer-Encoding": "chunked"},
+        )
+        if status != 200:
+            raise SystemExit(f"增量同步失败 ({status}): {result.get('message')}")
+        result.update(stats)
+        return result
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="只发送变化的数据块，更新服务器上已有的文件")
+    parser.add_argument("path", help="本地的新版本文件")
+    parser.add_argument("--server", required=True, help="服务器地址，例如 http://192.168.0.197:8000")
+    parser.add_argument("--name", help="服务器上的文件名，默认与本地文件同名")
+    parser.add_argument("--target", choices=["received", "shared"], default="shared", help="服务器目录，默认 shared")
+    parser.add_argument("--new-version", action="store_true", help="保留旧文件，把新版本另存为新文件")
+    args = parser.parse_args()
+
+    file_path = Path(args.path)
+    started = time.perf_counter()
+    result = sync(args.server, file_path, args.name or file_path.name, args.target, args.new_version)
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    size = file_path.stat().st_size
+    print(f"已同步 {file_path.name} -> {result.get('filename')}")
+    print(f"{size} 字节，发送新数据 {result['literal_bytes']} 字节，复用旧数据 {result['copied_bytes']} 字节，"
+          f"用时 {elapsed:.2f} 秒")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""
+加密传输格式与命令行客户端（AES-256-GCM 分帧流）
+
+流格式：
+    流头：MAGIC(4 字节) + salt(16 字节)
+    帧：  长度(4 字节大端，最高位表示最后一帧) + 密文 + GCM 标签(16 字节)
+
+每个流用预共享密钥和随机 salt 经 HKDF-SHA256 派生独立的 AES 密钥，
+帧序号作为 nonce，序号和结束标记同时作为附加认证数据，
+因此任何一帧被篡改、重排、删除或整个流被截断，都会在解密时发现。
+加解密都按帧进行，内存占用只与帧大小有关，与文件大小无关。
+
+用法：
+    python secure_transfer.py upload 文件路径 --server http://192.168.0.197:8000
+    python secure_transfer.py download 文件名 --server http://192.168.0.197:8000 -o 保存路径
+"""
+import argparse
+import http.client
+import json
+import os
+import struct
+import sys
+import time
+from pathlib import Path
+from urllib.parse import quote, urlencode, urlsplit
+
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:  # 可选依赖：安装 cryptography 后改用 OpenSSL 的 AES-GCM，速度可快一个数量级
+    AESGCM = None
+    InvalidTag = ValueError
+
+STREAM_MAGIC = b"LTE1"
+SALT_SIZE = 16
+TAG_SIZE = 16
+FRAME_HEADER = struct.Struct(">I")
+FINAL_FLAG = 0x80000000
+DEFAULT_FRAME_SIZE = 1024 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+STREAM_HEADER_SIZE = len(STREAM_MAGIC) + SALT_SIZE
+FRAME_OVERHEAD = FRAME_HEADER.size + TAG_SIZE
+KDF_CONTEXT = b"lan-file-transfer stream v1"
+ENCRYPTED_MEDIA_TYPE = "application/vnd.lan-transfer.encrypted"
+
+
+class StreamIntegrityError(ValueError):
+    """密文校验失败：密钥不一致，或数据被篡改、截断"""
+
+
+def derive_stream_key(pre_shared_key: bytes, salt: bytes) -> bytes:
+    return HKDF(pre_shared_key, 32, salt, SHA256, context=KDF_CONTEXT)
+
+
+def frame_nonce_and_aad(index: int, final: bool) -> tuple[bytes, bytes]:
+    nonce = index.to_bytes(12, "big")
+    return nonce, nonce + (b"\x01" if final else b"\x00")
+
+
+class FrameCipher:
+    """单个流的 AES-GCM 帧加解密，密文与标签拼接存放，两种实现的格式完全相同"""
+
+    def __init__(self, key: bytes):
+        self.key = key
+        self.aead = AESGCM(key) if AESGCM is not None else None
+
+    def seal(self, nonce: bytes, data: bytes, aad: bytes) -> bytes:
+        if self.aead is not None:
+            return self.aead.encrypt(nonce, data, aad)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+        cipher.update(aad)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return ciphertext + tag
+
+    def open(self, nonce: bytes, body: memoryview, aad: bytes) -> bytes:
+        try:
+            if self.aead is not None:
+                return self.aead.decrypt(nonce, body, aad)
+            cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+            cipher.update(aad)
+            return cipher.decrypt_and_verify(body[:-TAG_SIZE], body[-TAG_SIZE:])
+        except (ValueError, InvalidTag) as error:
+            raise StreamIntegrityError("数据校验失败，密钥不一致或数据被篡改") from error
+
+
+def encrypted_size(plain_size: int, frame_size: int = DEFAULT_FRAME_SIZE) -> int:
+    """加密后的总长度：数据帧加一个空的结束帧"""
+    frames = (plain_size + frame_size - 1) // frame_size
+    return STREAM_HEADER_SIZE + plain_size + (frames + 1) * FRAME_OVERHEAD
+
+
+class StreamEncryptor:
+    def __init__(self, pre_shared_key: bytes):
+        salt = os.urandom(SALT_SIZE)
+        self.cipher = FrameCipher(derive_stream_key(pre_shared_key, salt))
+        self.header = STREAM_MAGIC + salt
+        self.index = 0
+        self.finished = False
+
+    def encrypt_frame(self, data: bytes, final: bool = False) -> bytes:
+        if self.finished:
+            raise ValueError("加密流已结束")
+        if len(data) > MAX_FRAME_SIZE:
+            raise ValueError("单帧数据过大")
+        nonce, aad = frame_nonce_and_aad(self.index, final)
+        sealed = self.cipher.seal(nonce, data, aad)
+        self.index += 1
+        self.finished = final
+        length = len(data) | (FINAL_FLAG if final else 0)
+        return FRAME_HEADER.pack(length) + sealed
+
+
+class StreamDecryptor:
+    """增量解密：每次喂入任意长度的密文，返回已完整到达并校验通过的明文帧"""
+
+    def __init__(self, pre_shared_key: bytes):
+        self.pre_shared_key = pre_shared_key
+        self.cipher = None
+        self.buffer = bytearray()
+        self.index = 0
+        self.finished = False
+
+    def feed(self, data: bytes) -> list[bytes]:
+        self.buffer.extend(data)
+        if self.cipher is None:
+            if len(self.buffer) < STREAM_HEADER_SIZE:
+                return []
+            if self.buffer[:len(STREAM_MAGIC)] != STREAM_MAGIC:
+                raise StreamIntegrityError("不是有效的加密数据流")
+            salt = bytes(self.buffer[len(STREAM_MAGIC):STREAM_HEADER_SIZE])
+            self.cipher = FrameCipher(derive_stream_key(self.pre_shared_key, salt))
+            del self.buffer[:STREAM_HEADER_SIZE]
+
+        frames = []
+        position = 0
+        while len(self.buffer) - position >= FRAME_HEADER.size:
+            if self.finished:
+                raise StreamIntegrityError("结束帧之后还有多余数据")
+            (length,) = FRAME_HEADER.unpack_from(self.buffer, position)
+            final = bool(length & FINAL_FLAG)
+            length &= ~FINAL_FLAG
+            if length > MAX_FRAME_SIZE:
+                raise StreamIntegrityError("帧长度不合法")
+            frame_end = position + FRAME_HEADER.size + length + TAG_SIZE
+            if len(self.buffer) < frame_end:
+                break
+            body = memoryview(self.buffer)[position + FRAME_HEADER.size:frame_end]
+            nonce, aad = frame_nonce_and_aad(self.index, final)
+            try:
+                frames.append(self.cipher.open(nonce, body, aad))
+            finally:
+                body.release()
+            self.index += 1
+            self.finished = final
+            position = frame_end
+        del self.buffer[:position]
+        return frames
+
+    def finish(self):
+        if not self.finished or self.buffer:
+            raise StreamIntegrityError("加密数据流不完整")
+
+
+def iter_encrypted_file(file_path: Path, pre_shared_key: bytes, frame_size: int = DEFAULT_FRAME_SIZE):
+    """逐帧读取并加密文件，同一时间只持有一帧数据"""
+    encryptor = StreamEncryptor(pre_shared_key)
+    yield encryptor.header
+    with file_path.open("rb") as input_file:
+        while True:
+            chunk = input_file.read(frame_size)
+            if not chunk:
+                break
+            yield encryptor.encrypt_frame(chunk)
+    yield encryptor.encrypt_frame(b"", final=True)
+
+
+def load_key(key: str | None) -> bytes:
+    if key:
+        return key.encode("utf-8")
+    if os.environ.get("TRANSFER_KEY"):
+        return os.environ["TRANSFER_KEY"].encode("utf-8")
+    config_path = Path(os.environ.get("TRANSFER_CONFIG") or Path(__file__).resolve().parent / "config.json")
+    try:
+        with config_path.open("r", encoding="utf-8") as config_file:
+            value = json.load(config_file).get("pre_shared_key")
+    except (OSError, ValueError, AttributeError):
+        value = None
+    if not isinstance(value, str) or not value:
+        raise SystemExit("未找到预共享密钥，请使用 --key、环境变量 TRANSFER_KEY 或 config.json 的 pre_shared_key")
+    return value.encode("utf-8")
+
+
+def open_connection(server: str) -> tuple[http.client.HTTPConnection, str]:
+    parts = urlsplit(server if "://" in server else f"http://{server}")
+    connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    return connection_class(parts.hostname, parts.port, timeout=60), parts.path.rstrip("/")
+
+
+def upload(server: str, file_path: Path, target: str, pre_shared_key: bytes) -> dict:
+    connection, prefix = open_connection(server)
+    query = urlencode({"filename": file_path.name, "target": target})
+    size = file_path.stat().st_size
+    connection.request(
+        "POST", f"{prefix}/upload_encrypted?{query}",
+        body=iter_encrypted_file(file_path, pre_shared_key),
+        headers={"Content-Type": ENCRYPTED_MEDIA_TYPE, "Content-Length": str(encrypted_size(size))},
+    )
+    response = connection.getresponse()
+    result = json.loads(response.read() or b"{}")
+    connection.close()
+    if response.status != 200:
+        raise SystemExit(f"上传失败 ({response.status}): {result.get('message')}")
+    return result
+
+
+def download(server: str, file_id: str, target: str, output_path: Path, pre_shared_key: bytes) -> int:
+    connection, prefix = open_connection(server)
+    connection.request("GET", f"{prefix}/download_encrypted/{quote(file_id)}?{urlencode({'target': target})}")
+    response = connection.getresponse()
+    if response.status != 200:
+        message = json.loads(response.read() or b"{}").get("message")
+        raise SystemExit(f"下载失败 ({response.status}): {message}")
+
+    decryptor = StreamDecryptor(pre_shared_key)
+    written = 0
+    temp_path = output_path.with_name(output_path.name + ".part")
+    try:
+        with temp_path.open("wb") as output_file:
+            while True:
+                chunk = response.read(DEFAULT_FRAME_SIZE)
+                if not chunk:
+                    break
+                for frame in decryptor.feed(chunk):
+                    output_file.write(frame)
+                    written += len(frame)
+        decryptor.finish()
+        os.replace(temp_path, output_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+        connection.close()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="通过加密通道上传或下载文件")
+    parser.add_argument("action", choices=["upload", "download"])
+    parser.add_argument("path", help="上传时为本地文件路径，下载时为服务器上的文件名")
+    parser.add_argument("--server", required=True, help="服务器地址，例如 http://192.168.0.197:8000")
+    parser.add_argument("--target", choices=["received", "shared"], help="服务器目录，上传默认 received，下载默认 shared")
+    parser.add_argument("-o", "--output", help="下载文件的保存路径")
+    parser.add_argument("--key", help="预共享密钥，默认读取环境变量 TRANSFER_KEY 或 config.json")
+    args = parser.parse_args()
+
+    pre_shared_key = load_key(args.key)
+    started = time.perf_counter()
+    if args.action == "upload":
+        file_path = Path(args.path)
+        result = upload(args.server, file_path, args.target or "received", pre_shared_key)
+        size = file_path.stat().st_size
+        print(f"已上传 {file_path.name} -> {result.get('filename')}")
+    else:
+        output_path = Path(args.output or args.path)
+        size = download(args.server, args.path, args.target or "shared", output_path, pre_shared_key)
+        print(f"已下载 {args.path} -> {output_path}")
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f"{size} 字节，用时 {elapsed:.2f} 秒，{size / elapsed / 1024 / 1024:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,144 +1,3826 @@
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+import asyncio
+import atexit
+import base64
+import bisect
+import codecs
+import errno
+import hashlib
+import http.client
 import json
+import logging
+import logging.handlers
+import mimetypes
+import multiprocessing
 import os
+import queue
 import re
+import secrets
+import shutil
+import sqlite3
+import sys
+import tarfile
+import threading
 import time
+import uuid
+import zipfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from importlib.util import find_spec
+from urllib.parse import quote
 
+import anyio
 from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
+
+from delta_sync import MAX_BLOCK_SIZE as MAX_DELTA_BLOCK_SIZE, MIN_BLOCK_SIZE as MIN_DELTA_BLOCK_SIZE
+from delta_sync import DeltaApplier, DeltaFormatError, choose_block_size, compute_signature
+from secure_transfer import (
+    DEFAULT_FRAME_SIZE, ENCRYPTED_MEDIA_TYPE, StreamDecryptor, StreamIntegrityError, encrypted_size,
+    iter_encrypted_file, open_connection,
+)
+from thumbnails import PILLOW_AVAILABLE, generate_thumbnail
+
+try:
+    import zstandard
+except ImportError:  # zstd 压缩是可选功能，未安装时只使用 gzip
+    zstandard = None
 
 # 预共享密钥（需要在客户端和服务端保持一致）
-PRE_SHARED_KEY = b"your_secure_pre_shared_key_here"  # 请更换为强密钥
+PRE_SHARED_KEY = b"your_secure_pre_shared_key_here"  # 请更换为强密钥，也可以在 config.json 的 pre_shared_key 中设置
 
 BASE_DIR = Path(__file__).resolve().parent
 TEMPLATES_DIR = BASE_DIR / "templates"
-RECEIVED_DIR = BASE_DIR / "received_files"
-SHARED_DIR = BASE_DIR / "shared_files"
-CONFIG_PATH = BASE_DIR / "config.json"
+# 数据目录默认就是程序目录；基准测试等场景可以通过环境变量指向临时目录
+DATA_DIR = Path(os.environ.get("TRANSFER_DATA_DIR") or BASE_DIR).resolve()
+RECEIVED_DIR = DATA_DIR / "received_files"
+SHARED_DIR = DATA_DIR / "shared_files"
+CONFIG_PATH = Path(os.environ.get("TRANSFER_CONFIG") or BASE_DIR / "config.json")
+UPLOAD_SESSION_DIR = DATA_DIR / ".upload_sessions"
+# 上传中的文件先写在这里，写完再改名放进目标目录；与数据目录在同一文件系统上，改名是原子操作
+STAGING_DIR = DATA_DIR / ".staging"
+CONTENT_INDEX_PATH = DATA_DIR / ".content_index.json"
+METADATA_DB_PATH = DATA_DIR / ".metadata.sqlite3"
+THUMBNAIL_DIR = DATA_DIR / ".thumbnails"
+COMPRESSED_CACHE_DIR = DATA_DIR / ".compressed"
+METRICS_DIR = DATA_DIR / ".metrics"
+# 从其他节点镜像文件时的断点续传数据，按内容哈希命名，中断后从已下载的位置继续
+MIRROR_DIR = DATA_DIR / ".mirror"
 INVALID_FILENAME_PATTERN = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
 MAX_FILENAME_LENGTH = 200
+MAX_PATH_DEPTH = 32
+TAR_BLOCK_SIZE = 512
+MAX_TAR_METADATA_SIZE = 64 * 1024
 DEFAULT_PORT = 5000
+DEFAULT_WORKERS = 1
+MAX_WORKERS = 64
+# 目录变更日志只保留最近的记录，落后太多的进程直接全量扫描
+MAX_INDEX_CHANGE_LOG = 10000
+LOG_FORMATS = {"text", "json"}
+# none：交给操作系统择机写回；fsync：提交前把文件和目录刷到磁盘，断电也不会丢失已确认的上传
+DURABILITY_MODES = {"none", "fsync"}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DISK_WRITE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# 多进程模式下其他进程超过这个时间没有更新指标快照，视为已退出
+METRICS_SNAPSHOT_TTL = 30
+DEFAULT_UPLOAD_CHUNK_SIZE = 1024 * 1024
+MIN_UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_SESSION_CHUNK_SIZE = 4 * 1024 * 1024
+MIN_SESSION_CHUNK_SIZE = 256 * 1024
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+DEFAULT_MAX_CONCURRENT_UPLOADS = 8
+DEFAULT_MAX_INFLIGHT_UPLOAD_BYTES = 512 * 1024 * 1024
+DEFAULT_CLIENT_UPLOAD_PARALLELISM = 3
+INGEST_RETRY_AFTER = 2
+INDEX_POLL_INTERVAL = 2
+INDEX_FULL_RESCAN_INTERVAL = 60
+EVENT_KEEPALIVE_INTERVAL = 15
+EVENT_RETRY_MS = 3000
+EVENT_QUEUE_SIZE = 1000
+MAX_RESCAN_EVENTS = 200
+SHUTDOWN_GRACE_PERIOD = 5
+DEFAULT_RETENTION_INTERVAL = 600
+# 同一时刻只有一个工作进程执行清理，租约过期后其他进程可以接手
+RETENTION_LEASE_TTL = 3 * DEFAULT_RETENTION_INTERVAL
+# 清理任务每删除一批文件就让出一会儿磁盘，避免和正在进行的传输抢 I/O
+RETENTION_BATCH_SIZE = 100
+RETENTION_BATCH_PAUSE = 0.5
+RETENTION_REPORT_HISTORY = 20
+RETENTION_EVICT_ORDERS = {"lru", "age"}
+DEFAULT_MIRROR_INTERVAL = 30
+MIRROR_CHUNK_SIZE = 8 * 1024 * 1024
+MIRROR_READ_SIZE = 64 * 1024
+MIRROR_LEASE_TTL = 120
+# 删除记录保留的时间，超过这个时间仍未同步的节点只能靠手动处理
+MIRROR_TOMBSTONE_TTL = 30 * 24 * 60 * 60
+MAX_LISTING_PAGE_SIZE = 1000
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# 只有这些类型允许在浏览器中直接打开；html、svg 等可执行脚本的类型一律按附件下载，避免存储型 XSS
+INLINE_MEDIA_TYPES = {
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp", "image/avif", "application/pdf",
+}
+INLINE_MEDIA_PREFIXES = ("audio/", "video/")
+MAX_BATCH_FILES = 1000
+PREVIEW_SAMPLE_SIZE = 64 * 1024
+DEFAULT_PREVIEW_PAGE_SIZE = 128 * 1024
+MAX_PREVIEW_PAGE_SIZE = 1024 * 1024
+DEFAULT_PREVIEW_LINES = 500
+MAX_PREVIEW_LINES = 5000
+PREVIEW_LINE_INDEX_STRIDE = 1000
+# 按行读取时每次从文件读入的字节数
+PREVIEW_READ_SIZE = 64 * 1024
+# UTF-16 的换行符占一个 2 字节的字符单元，其余支持的编码都是单字节的 \n
+PREVIEW_NEWLINES = {"utf-16-le": b"\n\x00", "utf-16-be": b"\x00\n"}
+PREVIEW_CACHE_ENTRIES = 128
+DELTA_SIGNATURE_CACHE_ENTRIES = 16
+# 全文索引只收录文本文件开头的这一部分，超大的日志文件不会让索引膨胀
+SEARCH_CONTENT_LIMIT = 1024 * 1024
+DEFAULT_SEARCH_RESULTS = 50
+MAX_SEARCH_RESULTS = 200
+# trigram 分词按三个字符切分，更短的关键词无法走全文索引，只匹配文件名
+MIN_FULL_TEXT_TERM = 3
+# 正文摘要的长度（字符数），trigram 分词下每个字符对应一个词元
+SEARCH_SNIPPET_LENGTH = 48
+THUMBNAIL_SIZE = 320
+THUMBNAIL_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+DEFAULT_THUMBNAIL_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_THUMBNAIL_WORKERS = 2
+STALE_TEMP_FILE_AGE = 600
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+PRECOMPRESS_MIN_HITS = 2
+DEFAULT_COMPRESSED_CACHE_BYTES = 256 * 1024 * 1024
+COMPRESSIBLE_MEDIA_TYPES = {
+    "application/json", "application/javascript", "application/xml", "image/svg+xml", "text/csv",
+}
+UPLOAD_PATHS = {"/upload", "/upload_shared", "/upload_text", "/upload_encrypted", "/upload_folder", "/upload_session"}
+DOWNLOAD_PATH_PREFIXES = (
+    "/download/", "/download_received/", "/download_encrypted/", "/download_batch", "/mirror/file/",
+)
+# 只有这些上传接口接受压缩的请求体，按完整路径匹配
+COMPRESSED_UPLOAD_PATHS = {"/upload", "/upload_shared", "/upload_text"}
+COMPRESSED_UPLOAD_SESSION_PATTERN = re.compile(r"^/upload_session/[0-9a-f]{32}$")
+# 压缩的请求体逐块解压交给应用，每块不超过这个大小，解压后的总大小超过上限时返回 413
+REQUEST_DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+MAX_DECOMPRESSED_BODY_SIZE = 4 * 1024 * 1024 * 1024
+# zstandard 的 decompressobj 不能限制输出大小，每次只喂入这么多字节，单个块最多展开约 2MB
+ZSTD_DECOMPRESS_INPUT_STEP = 64
+# 常见压缩格式的文件头，命中时不再压缩
+COMPRESSED_MAGIC_PREFIXES = (
+    b"\x1f\x8b", b"PK\x03\x04", b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"\x28\xb5\x2f\xfd", b"BZh",
+    b"\xfd7zXZ\x00", b"7z\xbc\xaf\x27\x1c", b"Rar!", b"OggS", b"fLaC", b"ID3",
+)
+# 这些格式本身已经压缩过，打包时直接存储，避免浪费 CPU
+STORED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".heif",
+    ".mp4", ".mov", ".m4v", ".mkv", ".webm", ".avi", ".mp3", ".m4a", ".aac", ".ogg", ".flac",
+    ".zip", ".rar", ".7z", ".gz", ".bz2", ".xz", ".zst", ".apk", ".ipa", ".jar", ".docx", ".xlsx", ".pptx",
+}
+LISTING_SORT_KEYS = {
+    "mtime": lambda item: (item["mtime_ts"], item["name"]),
+    "size": lambda item: (item["size"], item["name"]),
+    "name": lambda item: (item["name"].casefold(), item["name"]),
+}
+LISTING_DEFAULT_ORDERS = {"mtime": "desc", "size": "desc", "name": "asc"}
+# 每次进程启动生成不同的前缀，避免重启后版本号重复导致 ETag 误命中
+INDEX_EPOCH = uuid.uuid4().hex[:8]
+UPLOAD_SESSION_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
 HIDDEN_FILE_NAMES = {".DS_Store"}
 
-app = FastAPI()
-templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
-RECEIVED_DIR.mkdir(exist_ok=True)
-SHARED_DIR.mkdir(exist_ok=True)
+
+server_initialized = False
+
+
+def initialize_server():
+    """
+    创建数据目录，初始化元数据库和磁盘缓存，清理上次异常退出留下的文件。
+    导入本模块时不做这些事：spawn 方式启动的子进程（缩略图进程池、uvicorn 工作进程）
+    会以 __mp_main__ 的名字重新执行启动脚本，只有真正处理请求的进程才在 lifespan 中初始化一次。
+    """
+    global server_initialized
+    if server_initialized:
+        return
+    setup_logging()
+    for directory in (DATA_DIR, RECEIVED_DIR, SHARED_DIR, UPLOAD_SESSION_DIR, STAGING_DIR, THUMBNAIL_DIR,
+                      COMPRESSED_CACHE_DIR, MIRROR_DIR, METRICS_DIR):
+        directory.mkdir(parents=True, exist_ok=True)
+    metadata_store.initialize()
+    search_index.initialize()
+    mirror_service.initialize()
+    content_index.load()
+    cleanup_stale_upload_sessions()
+    cleanup_staging_files()
+    thumbnail_cache.load()
+    compressed_variant_cache.load()
+    server_initialized = True
+    logger.info(f"服务进程 {os.getpid()} 初始化完成", extra=log_fields(event="startup", pid=os.getpid()))
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await run_in_threadpool(initialize_server)
+    stop_event = threading.Event()
+    change_broker.attach(asyncio.get_running_loop())
+    for index in directory_indexes.values():
+        await run_in_threadpool(index.rescan)
+        search_index.schedule_reconcile(index)
+    watcher = threading.Thread(target=watch_directory_indexes, args=(stop_event,), daemon=True)
+    watcher.start()
+    if CONFIG["retention"]:
+        threading.Thread(target=retention_manager.run, args=(stop_event,), daemon=True).start()
+    if CONFIG["peers"]:
+        threading.Thread(target=mirror_service.run, args=(stop_event,), daemon=True).start()
+    try:
+        yield
+    finally:
+        stop_event.set()
+        change_broker.attach(None)
+        thumbnail_cache.shutdown()
+        search_index.executor.shutdown(wait=False, cancel_futures=True)
+        mirror_service.hash_executor.shutdown(wait=False, cancel_futures=True)
+        metadata_store.release_lease("retention", retention_manager.owner)
+        metadata_store.release_lease("mirror", mirror_service.owner)
+        compressed_variant_cache.executor.shutdown(wait=False, cancel_futures=True)
+        (METRICS_DIR / f"{os.getpid()}.json").unlink(missing_ok=True)
+
+
+app = FastAPI(lifespan=lifespan)
+templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
+UPLOAD_TARGETS = {
+    "received": (RECEIVED_DIR, "uploaded_file", "收到文件"),
+    "shared": (SHARED_DIR, "shared_file", "共享文件上传"),
+}
+
+
+def read_int_option(config: dict, key: str, default: int, minimum: int, maximum: int) -> int:
+    value = config.get(key)
+    if isinstance(value, int) and not isinstance(value, bool) and minimum <= value <= maximum:
+        return value
+    return default
+
+
+def read_key_option(config: dict, key: str, default: bytes) -> bytes:
+    value = config.get(key)
+    if isinstance(value, str) and value:
+        return value.encode("utf-8")
+    return default
+
+
+def read_retention_option(config: dict) -> dict[str, dict]:
+    """按目录读取配额和保留期限，未设置或为 0 的项表示不限制，全部不限制的目录不做清理"""
+    value = config.get("retention")
+    if not isinstance(value, dict):
+        return {}
+    policies = {}
+    for target in UPLOAD_TARGETS:
+        section = value.get(target)
+        if not isinstance(section, dict):
+            continue
+        policy = {
+            "max_bytes": read_int_option(section, "max_bytes", 0, 0, 2 ** 60),
+            "max_files": read_int_option(section, "max_files", 0, 0, 2 ** 40),
+            "max_age_days": read_int_option(section, "max_age_days", 0, 0, 36500),
+            "evict": section.get("evict") if section.get("evict") in RETENTION_EVICT_ORDERS else "lru",
+        }
+        if policy["max_bytes"] or policy["max_files"] or policy["max_age_days"]:
+            policies[target] = policy
+    return policies
+
+
+def read_peers_option(config: dict) -> list[str]:
+    value = config.get("peers")
+    if not isinstance(value, list):
+        return []
+    return [
+        peer.rstrip("/") for peer in value
+        if isinstance(peer, str) and peer.startswith(("http://", "https://"))
+    ]
+
+
+def load_config():
+    default_config = {
+        "port": DEFAULT_PORT,
+        "workers": DEFAULT_WORKERS,
+        "upload_chunk_size": DEFAULT_UPLOAD_CHUNK_SIZE,
+        "session_chunk_size": DEFAULT_SESSION_CHUNK_SIZE,
+        "max_concurrent_uploads": DEFAULT_MAX_CONCURRENT_UPLOADS,
+        "max_inflight_upload_bytes": DEFAULT_MAX_INFLIGHT_UPLOAD_BYTES,
+        "client_upload_parallelism": DEFAULT_CLIENT_UPLOAD_PARALLELISM,
+        "thumbnail_cache_bytes": DEFAULT_THUMBNAIL_CACHE_BYTES,
+        "thumbnail_workers": DEFAULT_THUMBNAIL_WORKERS,
+        "compressed_cache_bytes": DEFAULT_COMPRESSED_CACHE_BYTES,
+        "pre_shared_key": PRE_SHARED_KEY,
+        "log_format": "text",
+        "durability": "none",
+        "retention": {},
+        "retention_interval": DEFAULT_RETENTION_INTERVAL,
+        "peers": [],
+        "mirror_interval": DEFAULT_MIRROR_INTERVAL,
+        "mirror_bandwidth": 0,
+    }
+    if not CONFIG_PATH.exists():
+        return default_config
+
+    try:
+        with CONFIG_PATH.open("r", encoding="utf-8") as config_file:
+            config = json.load(config_file)
+    except Exception:
+        return default_config
+    if not isinstance(config, dict):
+        return default_config
+
+    return {
+        "port": read_int_option(config, "port", DEFAULT_PORT, 1024, 65535),
+        "workers": read_int_option(config, "workers", DEFAULT_WORKERS, 1, MAX_WORKERS),
+        "upload_chunk_size": read_int_option(
+            config, "upload_chunk_size", DEFAULT_UPLOAD_CHUNK_SIZE, MIN_UPLOAD_CHUNK_SIZE, MAX_UPLOAD_CHUNK_SIZE
+        ),
+        "session_chunk_size": read_int_option(
+            config, "session_chunk_size", DEFAULT_SESSION_CHUNK_SIZE, MIN_SESSION_CHUNK_SIZE, MAX_UPLOAD_CHUNK_SIZE
+        ),
+        "max_concurrent_uploads": read_int_option(
+            config, "max_concurrent_uploads", DEFAULT_MAX_CONCURRENT_UPLOADS, 1, 1024
+        ),
+        "max_inflight_upload_bytes": read_int_option(
+            config, "max_inflight_upload_bytes", DEFAULT_MAX_INFLIGHT_UPLOAD_BYTES, MIN_UPLOAD_CHUNK_SIZE, 2 ** 40
+        ),
+        "client_upload_parallelism": read_int_option(
+            config, "client_upload_parallelism", DEFAULT_CLIENT_UPLOAD_PARALLELISM, 1, 16
+        ),
+        "thumbnail_cache_bytes": read_int_option(
+            config, "thumbnail_cache_bytes", DEFAULT_THUMBNAIL_CACHE_BYTES, 1024 * 1024, 2 ** 40
+        ),
+        "thumbnail_workers": read_int_option(config, "thumbnail_workers", DEFAULT_THUMBNAIL_WORKERS, 1, 32),
+        "compressed_cache_bytes": read_int_option(
+            config, "compressed_cache_bytes", DEFAULT_COMPRESSED_CACHE_BYTES, 1024 * 1024, 2 ** 40
+        ),
+        "pre_shared_key": read_key_option(config, "pre_shared_key", PRE_SHARED_KEY),
+        "log_format": config.get("log_format") if config.get("log_format") in LOG_FORMATS else "text",
+        "durability": config.get("durability") if config.get("durability") in DURABILITY_MODES else "none",
+        "retention": read_retention_option(config),
+        "retention_interval": read_int_option(
+            config, "retention_interval", DEFAULT_RETENTION_INTERVAL, 10, 7 * 24 * 60 * 60
+        ),
+        "peers": read_peers_option(config),
+        "mirror_interval": read_int_option(config, "mirror_interval", DEFAULT_MIRROR_INTERVAL, 2, 24 * 60 * 60),
+        "mirror_bandwidth": read_int_option(config, "mirror_bandwidth", 0, 0, 2 ** 40),
+    }
+
+
+CONFIG = load_config()
+
+
+class IngestAdmission:
+    """限制同时写入的上传请求数和在途字节数，超出时让客户端稍后重试"""
+
+    def __init__(self, max_uploads: int, max_bytes: int):
+        self.max_uploads = max_uploads
+        self.max_bytes = max_bytes
+        self.active_uploads = 0
+        self.inflight_bytes = 0
+
+    def try_acquire(self, size: int) -> bool:
+        if self.active_uploads >= self.max_uploads:
+            return False
+        # 单个超大请求在空闲时仍然放行，避免永远无法上传
+        if self.active_uploads and self.inflight_bytes + size > self.max_bytes:
+            return False
+        self.active_uploads += 1
+        self.inflight_bytes += size
+        return True
+
+    def release(self, size: int):
+        self.active_uploads -= 1
+        self.inflight_bytes -= size
+
+
+class StructuredFormatter(logging.Formatter):
+    """日志格式：text 为便于阅读的一行文字加 key=value 字段，json 为每行一个 JSON 对象"""
+
+    def __init__(self, output_format: str):
+        super().__init__()
+        self.output_format = output_format
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", {})
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        if self.output_format == "json":
+            entry = {"time": timestamp, "level": record.levelname, "logger": record.name,
+                     "message": record.getMessage(), **fields}
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+        marker = "[!]" if record.levelno >= logging.WARNING else "[*]"
+        text = f"{timestamp} {marker} {record.getMessage()}"
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+def log_fields(**fields) -> dict:
+    """作为 logging 的 extra 参数传入，附加结构化字段"""
+    return {"fields": fields}
+
+
+def setup_logging():
+    """
+    请求处理路径只把日志记录放进队列，由后台线程负责格式化和输出，
+    控制台输出慢时也不会阻塞事件循环。uvicorn 自己的访问日志也走同一个队列。
+    """
+    global log_listener
+    if log_listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    output_handler = logging.StreamHandler(sys.stdout)
+    output_handler.setFormatter(StructuredFormatter(CONFIG["log_format"]))
+    listener = logging.handlers.QueueListener(log_queue, output_handler, respect_handler_level=False)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    for name in ("transfer", "uvicorn"):
+        named_logger = logging.getLogger(name)
+        named_logger.handlers = [queue_handler]
+        named_logger.setLevel(logging.INFO)
+        named_logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+    log_listener = listener
+
+
+log_listener = None
+logger = logging.getLogger("transfer")
+
+
+class MetricsRegistry:
+    """
+    进程内的 Prometheus 指标：计数器、仪表盘和直方图，标签为 (名称, 值) 元组。
+    多进程模式下各进程定期把快照写入 METRICS_DIR，/metrics 汇总所有进程的数据。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions: dict[str, tuple[str, str, tuple | None]] = {}
+        self.values: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], list[float]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: tuple | None = None):
+        self.descriptions[name] = (kind, help_text, buckets)
+
+    def inc(self, name: str, labels: tuple = (), amount: float = 1):
+        with self.lock:
+            self.values[(name, labels)] = self.values.get((name, labels), 0) + amount
+
+    def observe(self, name: str, labels: tuple, value: float):
+        buckets = self.descriptions[name][2]
+        with self.lock:
+            state = self.histograms.get((name, labels))
+            if state is None:
+                # 各个桶的计数，最后两项是总和与总次数
+                state = self.histograms[(name, labels)] = [0] * (len(buckets) + 2)
+            for position, bound in enumerate(buckets):
+                if value <= bound:
+                    state[position] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "values": [[name, list(labels), value] for (name, labels), value in self.values.items()],
+                "histograms": [[name, list(labels), list(state)] for (name, labels), state in self.histograms.items()],
+            }
+
+    @staticmethod
+    def merge(snapshots: list[dict]) -> tuple[dict, dict]:
+        values, histograms = {}, {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["values"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                values[key] = values.get(key, 0) + value
+            for name, labels, state in snapshot["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                merged = histograms.setdefault(key, [0] * len(state))
+                for position, amount in enumerate(state):
+                    merged[position] += amount
+        return values, histograms
+
+    @staticmethod
+    def format_value(value: float) -> str:
+        # 不用 :g 格式，避免大计数值被截断成科学计数法
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+    @staticmethod
+    def format_labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self, snapshots: list[dict]) -> str:
+        values, histograms = self.merge(snapshots)
+        lines = []
+        for name, (kind, help_text, buckets) in self.descriptions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                for (metric_name, labels), value in sorted(values.items()):
+                    if metric_name == name:
+                        lines.append(f"{name}{self.format_labels(labels)} {self.format_value(value)}")
+                continue
+            for (metric_name, labels), state in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                for bound, count in zip(buckets, state):
+                    bucket_labels = self.format_labels(labels, (("le", f"{bound:g}"),))
+                    lines.append(f"{name}_bucket{bucket_labels} {self.format_value(count)}")
+                total = self.format_value(state[-1])
+                lines.append(f"{name}_bucket{self.format_labels(labels, (('le', '+Inf'),))} {total}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {self.format_value(state[-2])}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {total}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.describe("transfer_http_request_duration_seconds", "histogram", "请求处理耗时（秒），按路由和方法统计",
+                 LATENCY_BUCKETS)
+metrics.describe("transfer_http_requests_total", "counter", "请求数，按路由、方法和状态码统计")
+metrics.describe("transfer_http_request_bytes_total", "counter", "接收的请求体字节数（压缩时为压缩后的大小）")
+metrics.describe("transfer_http_response_bytes_total", "counter", "发送的响应体字节数")
+metrics.describe("transfer_uploads_in_flight", "gauge", "正在处理的上传请求数")
+metrics.describe("transfer_downloads_in_flight", "gauge", "正在发送的下载请求数")
+metrics.describe("transfer_listing_scan_duration_seconds", "histogram", "目录全量扫描耗时（秒）", LATENCY_BUCKETS)
+metrics.describe("transfer_disk_write_duration_seconds", "histogram", "单次磁盘写入耗时（秒），按写入来源统计",
+                 DISK_WRITE_BUCKETS)
+metrics.describe("transfer_disk_write_bytes_total", "counter", "写入磁盘的字节数，按写入来源统计")
+metrics.describe("transfer_event_subscribers", "gauge", "已连接的 /events 变更推送订阅数")
+metrics.describe("transfer_mirror_bytes_total", "counter", "从其他节点镜像下载的字节数，按节点统计")
+metrics.describe("transfer_mirror_files_total", "counter", "镜像同步的文件数，按节点和操作（pull/delete）统计")
+metrics.describe("transfer_retention_evicted_files_total", "counter", "保留策略清理的文件数，按目录和原因统计")
+metrics.describe("transfer_retention_evicted_bytes_total", "counter", "保留策略清理释放的字节数，按目录和原因统计")
+
+
+def write_timed(output_file, data: bytes, source: str) -> int:
+    """写入磁盘并记录耗时，用于观察磁盘是否成为上传瓶颈"""
+    started = time.perf_counter()
+    written = output_file.write(data)
+    labels = (("source", source),)
+    metrics.observe("transfer_disk_write_duration_seconds", labels, time.perf_counter() - started)
+    metrics.inc("transfer_disk_write_bytes_total", labels, len(data))
+    return written
+
+
+def save_metrics_snapshot():
+    snapshot_path = METRICS_DIR / f"{os.getpid()}.json"
+    temp_path = snapshot_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(metrics.snapshot()), encoding="utf-8")
+    os.replace(temp_path, snapshot_path)
+
+
+def collect_metrics_snapshots() -> list[dict]:
+    """本进程的实时数据，加上其他工作进程最近写入的快照"""
+    snapshots = [metrics.snapshot()]
+    if CONFIG["workers"] == 1:
+        return snapshots
+    own_name = f"{os.getpid()}.json"
+    expire_before = time.time() - METRICS_SNAPSHOT_TTL
+    for path in METRICS_DIR.glob("*.json"):
+        try:
+            if path.name == own_name or path.stat().st_mtime < expire_before:
+                continue
+            snapshots.append(json.loads(path.read_text(encoding="utf-8")))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def per_worker_share(total: int) -> int:
+    """多进程模式下每个进程只分到总限额的一部分，整体上限与单进程一致"""
+    return max(1, total // CONFIG["workers"])
+
+
+ingest_admission = IngestAdmission(
+    per_worker_share(CONFIG["max_concurrent_uploads"]), per_worker_share(CONFIG["max_inflight_upload_bytes"])
+)
+
+
+class MetadataStore:
+    """
+    多个工作进程共享的元数据（SQLite，WAL 模式）：上传会话、内容哈希索引和目录变更日志。
+    每个线程使用独立连接，写操作用 BEGIN IMMEDIATE 事务在进程间串行化。
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self.local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def initialize(self):
+        self.connect().executescript("""
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS content_index (
+                path TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS content_index_sha256 ON content_index (sha256);
+            CREATE TABLE IF NOT EXISTS index_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS file_access (
+                target TEXT NOT NULL,
+                path TEXT NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (target, path)
+            );
+            CREATE TABLE IF NOT EXISTS maintenance_leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS retention_reports (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                finished REAL NOT NULL,
+                report TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS node_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS mirror_tombstones (
+                path TEXT PRIMARY KEY,
+                sha256 TEXT,
+                deleted REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS mirror_evictions (
+                path TEXT PRIMARY KEY,
+                sha256 TEXT,
+                evicted REAL NOT NULL
+            );
+        """)
+
+    def log_index_change(self, directory: str, name: str):
+        with self.transaction() as connection:
+            seq = connection.execute(
+                "INSERT INTO index_changes (directory, name) VALUES (?, ?)", (directory, name)
+            ).lastrowid
+            if seq % 1000 == 0:
+                connection.execute("DELETE FROM index_changes WHERE seq <= ?", (seq - MAX_INDEX_CHANGE_LOG,))
+
+    def read_index_changes(self, directory: str, after_seq: int) -> tuple[int, int, list[str]]:
+        """返回 (最早保留的序号, 最新序号, after_seq 之后变更过的文件名)"""
+        connection = self.connect()
+        # 两次查询放在同一个读事务里，看到的是同一个快照
+        connection.execute("BEGIN")
+        try:
+            first_seq, last_seq = connection.execute("SELECT MIN(seq), MAX(seq) FROM index_changes").fetchone()
+            names = [row[0] for row in connection.execute(
+                "SELECT name FROM index_changes WHERE directory = ? AND seq > ? ORDER BY seq", (directory, after_seq)
+            )]
+        finally:
+            connection.execute("COMMIT")
+        return first_seq or 0, last_seq or 0, names
+
+    def last_index_change(self) -> int:
+        return self.connect().execute("SELECT MAX(seq) FROM index_changes").fetchone()[0] or 0
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """获取或续期后台任务的租约，其他进程持有且未过期时返回 False"""
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute("SELECT owner, expires FROM maintenance_leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            connection.execute("INSERT OR REPLACE INTO maintenance_leases (name, owner, expires) VALUES (?, ?, ?)",
+                               (name, owner, now + ttl))
+        return True
+
+    def release_lease(self, name: str, owner: str):
+        """正常退出时释放租约，重启后不必等租约过期"""
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM maintenance_leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def node_id(self) -> str:
+        """本机数据目录的唯一标识，镜像时用来识别 peers 里误填的本机地址"""
+        with self.transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO node_settings (key, value) VALUES ('node_id', ?)",
+                               (uuid.uuid4().hex,))
+            return connection.execute("SELECT value FROM node_settings WHERE key = 'node_id'").fetchone()[0]
+
+
+metadata_store = MetadataStore(METADATA_DB_PATH)
+
+
+def sanitize_filename(filename: str, default_name: str) -> str:
+    safe_name = Path(filename or "").name.strip()
+    safe_name = INVALID_FILENAME_PATTERN.sub("", safe_name).rstrip(" ")
+    if safe_name in {"", ".", ".."}:
+        safe_name = default_name
+
+    if len(safe_name) > MAX_FILENAME_LENGTH:
+        name, ext = os.path.splitext(safe_name)
+        safe_name = name[: MAX_FILENAME_LENGTH - len(ext)] + ext
+
+    return safe_name or default_name
+
+
+class UniqueNameAllocator:
+    """用独占创建保证文件名唯一，并记住每个重名文件下一个可用的序号"""
+
+    def __init__(self):
+        self.next_counters: dict[tuple[str, str, str], int] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def try_create(file_path: Path) -> bool:
+        try:
+            fd = os.open(file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
+
+    def create(self, base_dir: Path, filename: str, claim=None) -> Path:
+        """claim 负责独占地占用候选文件名，名字已被占用时返回 False；默认创建一个空文件"""
+        claim = claim or self.try_create
+        candidate = base_dir / filename
+        stem = candidate.stem
+        suffix = candidate.suffix
+        key = (str(base_dir), stem, suffix)
+        with self.lock:
+            counter = self.next_counters.get(key)
+            if counter is None:
+                if claim(candidate):
+                    return candidate
+                counter = 1
+            # 只有发生过重名的文件名才会记录序号，正常情况下一次创建即可成功
+            while True:
+                next_candidate = base_dir / f"{stem}_{counter}{suffix}"
+                counter += 1
+                if claim(next_candidate):
+                    self.next_counters[key] = counter
+                    return next_candidate
+
+
+name_allocator = UniqueNameAllocator()
+
+
+def create_unique_file(base_dir: Path, filename: str) -> Path:
+    """原子地创建一个不重名的空文件并返回其路径，并发上传不会互相覆盖"""
+    return name_allocator.create(base_dir, filename)
+
+
+def link_unique_file(source: Path, base_dir: Path, filename: str) -> Path:
+    """以不重名的文件名为 source 创建硬链接，新文件一出现就是完整内容；文件系统不支持硬链接时抛出 OSError"""
+    def try_link(candidate: Path) -> bool:
+        try:
+            os.link(source, candidate)
+        except FileExistsError:
+            return False
+        return True
+
+    return name_allocator.create(base_dir, filename, claim=try_link)
+
+
+def create_unique_directory(base_dir: Path, name: str) -> Path:
+    candidate = base_dir / name
+    counter = 1
+    while True:
+        try:
+            candidate.mkdir()
+            return candidate
+        except FileExistsError:
+            candidate = base_dir / f"{name}_{counter}"
+            counter += 1
+
+
+def resolve_relative_path(base_dir: Path, file_id: str) -> Path:
+    """把 a/b/c.txt 形式的相对路径解析为 base_dir 下的绝对路径，每一级都必须是合法文件名"""
+    if not file_id:
+        raise HTTPException(status_code=400, detail="文件名不能为空")
+
+    parts = file_id.split("/")
+    if len(parts) > MAX_PATH_DEPTH:
+        raise HTTPException(status_code=400, detail="目录层级过深")
+    for part in parts:
+        if part in {"", ".", ".."} or part != Path(part).name:
+            raise HTTPException(status_code=400, detail="非法文件路径")
+        if sanitize_filename(part, "") != part:
+            raise HTTPException(status_code=400, detail="非法文件名")
+
+    # 解析符号链接后仍必须位于 base_dir 之内
+    root = base_dir.resolve()
+    file_path = root.joinpath(*parts).resolve()
+    if not file_path.is_relative_to(root) or file_path == root:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return file_path
+
+
+def resolve_existing_file(base_dir: Path, file_id: str) -> Path:
+    file_path = resolve_relative_path(base_dir, file_id)
+    if not file_path.is_file():
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return file_path
+
+
+def remove_empty_parents(base_dir: Path, file_path: Path):
+    """删除文件后顺带删除已经空了的上级目录，base_dir 本身保留"""
+    root = base_dir.resolve()
+    parent = file_path.parent
+    while parent != root and parent.is_relative_to(root):
+        try:
+            parent.rmdir()
+        except OSError:
+            return
+        parent = parent.parent
+
+
+def format_mtime(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+class ChangeBroker:
+    """
+    把目录索引的增量变更推送给 /events 的订阅者。
+    变更发生在线程池或后台轮询线程中，通过 call_soon_threadsafe 交给事件循环分发。
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.subscribers: set[asyncio.Queue] = set()
+
+    def attach(self, loop: asyncio.AbstractEventLoop | None):
+        self.loop = loop
+
+    def subscribe(self) -> asyncio.Queue:
+        subscriber = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.subscribers.add(subscriber)
+        metrics.inc("transfer_event_subscribers")
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue):
+        if subscriber in self.subscribers:
+            self.subscribers.discard(subscriber)
+            metrics.inc("transfer_event_subscribers", amount=-1)
+
+    def publish(self, events: list[dict]):
+        loop = self.loop
+        if loop is None or not events or not self.subscribers:
+            return
+        try:
+            loop.call_soon_threadsafe(self.dispatch, events)
+        except RuntimeError:  # 事件循环已关闭
+            pass
+
+    def dispatch(self, events: list[dict]):
+        for subscriber in list(self.subscribers):
+            try:
+                for event in events:
+                    subscriber.put_nowait(event)
+            except asyncio.QueueFull:
+                # 客户端读得太慢，丢弃积压的增量，让它重新加载整个列表
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait({"op": "reset"})
+
+
+change_broker = ChangeBroker()
+
+
+class DirectoryIndex:
+    """
+    目录的内存索引：写操作直接更新索引，外部改动由后台轮询发现。
+    子目录中的文件以相对路径（如 DCIM/IMG_0001.jpg）作为条目 id 和名称。
+    多进程模式下每个进程各有一份索引，写操作同时记入共享的变更日志，其他进程据此增量同步。
+    每次条目变化都会作为增量事件推送给 /events 的订阅者。
+    """
+
+    def __init__(self, base_dir: Path, target: str):
+        self.base_dir = base_dir
+        self.target = target
+        self.entries: dict[str, dict] = {}
+        self.version = 0
+        self.change_seq = 0
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.dir_mtimes: dict[str, int] = {}
+        self.sorted_files = None
+        self.sorted_views = {}
+
+    @staticmethod
+    def make_entry(name: str, file_stats: os.stat_result) -> dict:
+        return {
+            "id": name,
+            "name": name,
+            "size": file_stats.st_size,
+            "mtime": format_mtime(file_stats.st_mtime),
+            "mtime_ts": file_stats.st_mtime,
+            "thumbnail": supports_thumbnail(name),
+        }
+
+    def mark_changed(self):
+        self.version += 1
+        self.sorted_files = None
+        self.sorted_views = {}
+
+    def announce(self, version: int, changes: list[tuple[str, str, dict | None]]):
+        """把 (操作, 文件名, 条目) 列表推送给订阅者，变化太多时只通知重新加载"""
+        if changes:
+            search_index.schedule(self, changes)
+            if self.target == "shared":
+                mirror_service.record_changes(changes)
+        if len(changes) > MAX_RESCAN_EVENTS:
+            change_broker.publish([{"target": self.target, "version": version, "op": "reset"}])
+            return
+        change_broker.publish([
+            {"target": self.target, "version": version, "op": op, "id": name, "file": entry}
+            for op, name, entry in changes
+        ])
+
+    def relative_id(self, file_path: Path) -> str:
+        return file_path.relative_to(self.base_dir).as_posix()
+
+    def scan_tree(self) -> tuple[dict[str, dict], dict[str, int]]:
+        """遍历目录树，返回文件条目和每个目录（相对路径前缀）的 mtime"""
+        entries = {}
+        dir_mtimes = {"": self.base_dir.stat().st_mtime_ns}
+        pending = [("", self.base_dir)]
+        while pending:
+            prefix, directory = pending.pop()
+            try:
+                scanner = os.scandir(directory)
+            except OSError:
+                continue
+            with scanner:
+                for entry in scanner:
+                    if entry.name in HIDDEN_FILE_NAMES:
+                        continue
+                    name = prefix + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if name.count("/") + 1 < MAX_PATH_DEPTH:
+                                dir_mtimes[name + "/"] = entry.stat(follow_symlinks=False).st_mtime_ns
+                                pending.append((name + "/", entry.path))
+                        elif entry.is_file():
+                            entries[name] = self.make_entry(name, entry.stat())
+                    except OSError:
+                        continue
+        return entries, dir_mtimes
+
+    def rescan(self):
+        started = time.perf_counter()
+        # 先记下日志位置再扫描，扫描期间发生的变更之后还会再同步一次
+        change_seq = metadata_store.last_index_change() if CONFIG["workers"] > 1 else 0
+        entries, dir_mtimes = self.scan_tree()
+
+        changes = []
+        with self.lock:
+            self.dir_mtimes = dir_mtimes
+            self.change_seq = change_seq
+            if not self.loaded or entries != self.entries:
+                if self.loaded:
+                    # 外部新增、删除、重命名的文件通过对比前后两次扫描得到增量
+                    changes = [("remove", name, None) for name in self.entries.keys() - entries.keys()]
+                    changes += [("upsert", name, entry) for name, entry in entries.items()
+                                if self.entries.get(name) != entry]
+                self.entries = entries
+                self.mark_changed()
+            self.loaded = True
+            version = self.version
+        if changes:
+            self.announce(version, changes)
+        metrics.observe("transfer_listing_scan_duration_seconds", (("directory", self.base_dir.name),),
+                        time.perf_counter() - started)
+
+    def refresh_if_changed(self):
+        # 新增、删除、重命名都会改变所在目录的 mtime，只需检查各个目录，无需逐个 stat 文件
+        if not self.loaded:
+            self.rescan()
+            return
+        with self.lock:
+            dir_mtimes = list(self.dir_mtimes.items())
+        for prefix, mtime_ns in dir_mtimes:
+            try:
+                current = (self.base_dir / prefix).stat().st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime_ns:
+                self.rescan()
+                return
+
+    def sync_dir_mtime(self, name: str):
+        # 自己写入导致的目录 mtime 变化不需要再全量扫描，只更新文件所在的各级目录；
+        # 同一时刻发生的外部改动由定期全量扫描兜底
+        parts = name.split("/")[:-1]
+        for depth in range(len(parts) + 1):
+            prefix = "".join(part + "/" for part in parts[:depth])
+            try:
+                self.dir_mtimes[prefix] = (self.base_dir / prefix).stat().st_mtime_ns
+            except OSError:
+                if prefix:
+                    self.dir_mtimes.pop(prefix, None)
+
+    def apply_entry(self, name: str):
+        """按文件当前状态更新单个条目，文件不存在时删除条目"""
+        if name.rsplit("/", 1)[-1] in HIDDEN_FILE_NAMES:
+            return
+        try:
+            entry = self.make_entry(name, (self.base_dir / name).stat())
+        except OSError:
+            entry = None
+        changes = []
+        with self.lock:
+            if entry is None:
+                if self.entries.pop(name, None) is not None:
+                    self.mark_changed()
+                    changes.append(("remove", name, None))
+            elif self.entries.get(name) != entry:
+                self.entries[name] = entry
+                self.mark_changed()
+                changes.append(("upsert", name, entry))
+            self.sync_dir_mtime(name)
+            version = self.version
+        self.announce(version, changes)
+
+    def publish_change(self, name: str):
+        if CONFIG["workers"] > 1:
+            metadata_store.log_index_change(self.base_dir.name, name)
+
+    def update(self, file_path: Path):
+        name = self.relative_id(file_path)
+        self.apply_entry(name)
+        self.publish_change(name)
+
+    def remove(self, name: str):
+        changes = []
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self.mark_changed()
+                changes.append(("remove", name, None))
+            self.sync_dir_mtime(name)
+            version = self.version
+        self.announce(version, changes)
+        self.publish_change(name)
+
+    def sync_changes(self):
+        """应用其他工作进程记录的变更；日志已被裁剪到看不到的位置时退回全量扫描"""
+        if not self.loaded:
+            self.rescan()
+            return
+        first_seq, last_seq, names = metadata_store.read_index_changes(self.base_dir.name, self.change_seq)
+        if first_seq > self.change_seq + 1:
+            self.rescan()
+            return
+        for name in dict.fromkeys(names):
+            self.apply_entry(name)
+        with self.lock:
+            self.change_seq = max(self.change_seq, last_seq)
+
+    def list_files(self) -> list[dict]:
+        if not self.loaded:
+            self.rescan()
+        with self.lock:
+            if self.sorted_files is None:
+                self.sorted_files = sorted(self.entries.values(), key=lambda item: item["mtime_ts"], reverse=True)
+            return self.sorted_files
+
+    def get_sorted_view(self, sort: str) -> tuple[int, list[tuple], list[dict]]:
+        """返回 (版本号, 升序排序键, 升序条目)，同一版本内只排序一次"""
+        if not self.loaded:
+            self.rescan()
+        with self.lock:
+            view = self.sorted_views.get(sort)
+            if view is None:
+                key_func = LISTING_SORT_KEYS[sort]
+                items = sorted(self.entries.values(), key=key_func)
+                view = ([key_func(item) for item in items], items)
+                self.sorted_views[sort] = view
+            return self.version, view[0], view[1]
+
+
+directory_indexes = {
+    RECEIVED_DIR: DirectoryIndex(RECEIVED_DIR, "received"),
+    SHARED_DIR: DirectoryIndex(SHARED_DIR, "shared"),
+}
+
+
+def get_directory_index(base_dir: Path) -> DirectoryIndex:
+    return directory_indexes[base_dir]
+
+
+class SearchIndex:
+    """
+    文件名和文本内容的持久化搜索索引，保存在共享的 SQLite 数据库中，多个工作进程共用一份。
+    使用 FTS5 的 trigram 分词，中文和英文都可以按任意片段搜索；不足三个字的关键词和没有 FTS5 的 SQLite
+    退化为逐行匹配。
+    目录索引的每次变化都排进后台线程增量更新，启动时再与目录内容核对一次，补上停机期间的改动。
+    """
+
+    def __init__(self, store: MetadataStore):
+        self.store = store
+        self.full_text = False
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index")
+
+    def initialize(self):
+        connection = self.store.connect()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS search_documents (
+                id INTEGER PRIMARY KEY,
+                target TEXT NOT NULL,
+                path TEXT NOT NULL,
+                folded TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                UNIQUE (target, path)
+            )
+        """)
+        try:
+            connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search_text USING fts5(name, content, tokenize='trigram')"
+            )
+        except sqlite3.OperationalError:
+            # SQLite 3.34 之前没有 trigram 分词，或者编译时未启用 FTS5
+            connection.execute("CREATE TABLE IF NOT EXISTS search_text (id INTEGER PRIMARY KEY, name TEXT, content TEXT)")
+        table_sql = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'search_text'").fetchone()[0]
+        self.full_text = "fts5" in table_sql.lower()
+
+    @staticmethod
+    def read_text(file_path: Path) -> str:
+        """读取文本文件开头的内容用于全文索引，二进制文件返回空字符串"""
+        with file_path.open("rb") as input_file:
+            data = input_file.read(PREVIEW_SAMPLE_SIZE)
+            encoding = detect_text_encoding(data)
+            # latin-1 是无法识别编码时的兜底，这类文件多半不是真正的文本
+            if encoding is None or encoding == "latin-1":
+                return ""
+            data += input_file.read(SEARCH_CONTENT_LIMIT - len(data))
+        return data.decode(encoding, errors="ignore")
+
+    def index_file(self, target: str, base_dir: Path, name: str):
+        file_path = base_dir / name
+        try:
+            file_stats = file_path.stat()
+        except OSError:
+            self.remove(target, name)
+            return
+        connection = self.store.connect()
+        row = connection.execute(
+            "SELECT size, mtime_ns FROM search_documents WHERE target = ? AND path = ?", (target, name)
+        ).fetchone()
+        # 多个工作进程都会收到同一个变更，内容没变时只有第一个进程真正建立索引
+        if row == (file_stats.st_size, file_stats.st_mtime_ns):
+            return
+        try:
+            content = self.read_text(file_path)
+        except OSError:
+            content = ""
+        with self.store.transaction() as connection:
+            connection.execute(
+                "INSERT INTO search_documents (target, path, folded, size, mtime_ns) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (target, path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns",
+                (target, name, name.casefold(), file_stats.st_size, file_stats.st_mtime_ns),
+            )
+            (document_id,) = connection.execute(
+                "SELECT id FROM search_documents WHERE target = ? AND path = ?", (target, name)
+            ).fetchone()
+            connection.execute("DELETE FROM search_text WHERE rowid = ?", (document_id,))
+            connection.execute("INSERT INTO search_text (rowid, name, content) VALUES (?, ?, ?)",
+                               (document_id, name, content))
+
+    def remove(self, target: str, name: str):
+        with self.store.transaction() as connection:
+            row = connection.execute(
+                "SELECT id FROM search_documents WHERE target = ? AND path = ?", (target, name)
+            ).fetchone()
+            if row is not None:
+                connection.execute("DELETE FROM search_text WHERE rowid = ?", row)
+                connection.execute("DELETE FROM search_documents WHERE id = ?", row)
+
+    def apply_changes(self, index: DirectoryIndex, changes: list[tuple[str, str, dict | None]]):
+        for op, name, _ in changes:
+            try:
+                if op == "remove":
+                    self.remove(index.target, name)
+                else:
+                    self.index_file(index.target, index.base_dir, name)
+            except Exception as error:
+                logger.error(f"更新搜索索引失败 {name}: {error}")
+
+    def reconcile(self, index: DirectoryIndex):
+        """启动时把索引与目录内容对齐：删除已不存在的文件，补上新增或修改过的文件"""
+        with index.lock:
+            entries = dict(index.entries)
+        indexed = {
+            path: (size, mtime_ns) for path, size, mtime_ns in self.store.connect().execute(
+                "SELECT path, size, mtime_ns FROM search_documents WHERE target = ?", (index.target,)
+            )
+        }
+        changes = [("remove", name, None) for name in indexed.keys() - entries.keys()]
+        for name, entry in entries.items():
+            size, mtime_ns = indexed.get(name, (None, 0))
+            if size != entry["size"] or abs(mtime_ns / 1e9 - entry["mtime_ts"]) > 1e-6:
+                changes.append(("upsert", name, entry))
+        self.apply_changes(index, changes)
+        if changes:
+            logger.info(f"搜索索引已同步 {index.target}: {len(changes)} 个文件")
+
+    def schedule(self, index: DirectoryIndex, changes: list[tuple[str, str, dict | None]]):
+        try:
+            self.executor.submit(self.apply_changes, index, changes)
+        except RuntimeError:
+            # 服务器关闭后不再接受新任务，下次启动时的核对会补上
+            pass
+
+    def schedule_reconcile(self, index: DirectoryIndex):
+        try:
+            self.executor.submit(self.reconcile, index)
+        except RuntimeError:
+            pass
+
+    def search(self, query: str, targets: list[str], limit: int) -> dict:
+        terms = query.casefold().split()
+        full_text = self.full_text and all(len(term) >= MIN_FULL_TEXT_TERM for term in terms)
+        target_filter = ",".join("?" * len(targets))
+        connection = self.store.connect()
+        if full_text:
+            match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            rows = connection.execute(
+                "SELECT d.target, d.path, d.size, d.mtime_ns, snippet(search_text, 1, '', '', '…', ?) "
+                "FROM search_text JOIN search_documents AS d ON d.id = search_text.rowid "
+                f"WHERE search_text MATCH ? AND d.target IN ({target_filter}) "
+                # 文件名命中的权重远高于正文命中
+                "ORDER BY bm25(search_text, 10.0, 1.0) LIMIT ?",
+                (SEARCH_SNIPPET_LENGTH, match, *targets, limit),
+            ).fetchall()
+        else:
+            # 关键词太短无法使用 trigram 索引（或者没有 FTS5），逐行匹配文件名和已索引的正文，
+            # 摘要取第一个关键词在正文中首次出现的位置附近
+            conditions = " AND ".join("(instr(d.folded, ?) > 0 OR instr(lower(t.content), ?) > 0)" for _ in terms)
+            rows = connection.execute(
+                "SELECT d.target, d.path, d.size, d.mtime_ns, "
+                "substr(t.content, max(instr(lower(t.content), ?) - ?, 1), ?) "
+                "FROM search_documents AS d JOIN search_text AS t ON t.rowid = d.id "
+                f"WHERE {conditions} AND d.target IN ({target_filter}) ORDER BY d.mtime_ns DESC LIMIT ?",
+                (terms[0], SEARCH_SNIPPET_LENGTH // 3, SEARCH_SNIPPET_LENGTH,
+                 *[term for term in terms for _ in range(2)], *targets, limit),
+            ).fetchall()
+
+        results = []
+        for target, path, size, mtime_ns, snippet in rows:
+            mtime_ts = mtime_ns / 1e9
+            folded_snippet = (snippet or "").casefold()
+            results.append({
+                "target": target,
+                "id": path,
+                "name": path,
+                "size": size,
+                "mtime": format_mtime(mtime_ts),
+                "mtime_ts": mtime_ts,
+                "thumbnail": supports_thumbnail(path),
+                # 只有正文里确实出现了关键词才返回摘要，文件名命中时 snippet 只是正文开头
+                "snippet": snippet if any(term in folded_snippet for term in terms) else None,
+            })
+        return {"results": results}
+
+
+search_index = SearchIndex(metadata_store)
+
+
+def delete_stored_file(base_dir: Path, file_path: Path, replicate: bool = True):
+    """
+    删除目录中的文件，并同步内容索引、目录索引和访问记录。
+    replicate=False 表示按本机策略清理（如保留策略的配额），镜像时不把删除同步到其他节点。
+    """
+    index = get_directory_index(base_dir)
+    name = index.relative_id(file_path)
+    if not replicate and index.target == "shared":
+        mirror_service.record_eviction(name)
+    file_path.unlink()
+    remove_empty_parents(base_dir, file_path)
+    # 先更新目录索引再删除哈希记录，镜像的删除记录需要知道被删除版本的哈希
+    index.remove(name)
+    content_index.forget(file_path)
+
+
+class AccessTracker:
+    """
+    记录文件最近一次被下载或预览的时间，供保留策略按最近使用时间清理。
+    请求处理中只更新内存，由后台线程每隔几秒批量写入共享数据库，不拖慢下载。
+    """
+
+    def __init__(self, store: MetadataStore):
+        self.store = store
+        self.pending: dict[tuple[str, str], float] = {}
+        self.lock = threading.Lock()
+
+    def touch(self, base_dir: Path, file_path: Path):
+        index = get_directory_index(base_dir)
+        with self.lock:
+            self.pending[(index.target, index.relative_id(file_path))] = time.time()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        with self.store.transaction() as connection:
+            connection.executemany(
+                "INSERT INTO file_access (target, path, accessed) VALUES (?, ?, ?) "
+                "ON CONFLICT (target, path) DO UPDATE SET accessed = max(accessed, excluded.accessed)",
+                [(target, path, accessed) for (target, path), accessed in pending.items()],
+            )
+
+    def load(self, target: str) -> dict[str, float]:
+        return dict(self.store.connect().execute(
+            "SELECT path, accessed FROM file_access WHERE target = ?", (target,)
+        ).fetchall())
+
+    def prune(self, target: str, names: list[str]):
+        with self.store.transaction() as connection:
+            connection.executemany("DELETE FROM file_access WHERE target = ? AND path = ?",
+                                   [(target, name) for name in names])
+
+
+access_tracker = AccessTracker(metadata_store)
+
+
+class RetentionManager:
+    """
+    按 config.json 的 retention 配置在后台清理文件：超过保留天数的文件直接删除，
+    超出容量或文件数上限时从最久未使用（lru）或最早上传（age）的文件开始删除，直到回到上限以内。
+    多进程模式下通过数据库中的租约保证只有一个进程执行清理；每次清理的结果写入日志、指标和清理记录。
+    """
+
+    def __init__(self, store: MetadataStore):
+        self.store = store
+        self.owner = uuid.uuid4().hex
+
+    def acquire_lease(self) -> bool:
+        return self.store.acquire_lease("retention", self.owner,
+                                        max(RETENTION_LEASE_TTL, 3 * CONFIG["retention_interval"]))
+
+    @staticmethod
+    def plan(entries: dict[str, dict], accessed: dict[str, float], policy: dict, now: float,
+             inodes: dict[str, tuple[int, int]] | None = None) -> list[tuple]:
+        """
+        返回按清理顺序排列的 (文件名, 条目, 原因)。
+        inodes 为文件名到 (st_dev, st_ino) 的映射：同一内容的多个硬链接只占用一份容量，
+        删除其中一个不会腾出空间，直到目录中最后一个链接也被删除。
+        """
+        inodes = inodes or {}
+        links: dict = {}
+        sizes: dict = {}
+        for name, entry in entries.items():
+            key = inodes.get(name, name)
+            links[key] = links.get(key, 0) + 1
+            sizes[key] = entry["size"]
+
+        def sort_key(item):
+            name, entry = item
+            if policy["evict"] == "lru":
+                return max(entry["mtime_ts"], accessed.get(name, 0))
+            return entry["mtime_ts"]
+
+        expire_before = now - policy["max_age_days"] * 86400 if policy["max_age_days"] else None
+        total_bytes = sum(sizes.values())
+        total_files = len(entries)
+        victims = []
+        for name, entry in sorted(entries.items(), key=sort_key):
+            if expire_before is not None and sort_key((name, entry)) < expire_before:
+                reason = "age"
+            elif policy["max_files"] and total_files > policy["max_files"]:
+                reason = "files"
+            elif policy["max_bytes"] and total_bytes > policy["max_bytes"]:
+                reason = "bytes"
+            else:
+                # 按时间从旧到新处理，后面的文件更新，既不会过期也不需要再腾出空间
+                break
+            victims.append((name, entry, reason))
+            total_files -= 1
+            key = inodes.get(name, name)
+            links[key] -= 1
+            if not links[key]:
+                total_bytes -= entry["size"]
+        return victims
+
+    @staticmethod
+    def load_inodes(base_dir: Path, entries: dict[str, dict]) -> dict[str, tuple[int, int]]:
+        inodes = {}
+        for name in entries:
+            try:
+                file_stats = (base_dir / name).stat()
+            except OSError:
+                continue
+            inodes[name] = (file_stats.st_dev, file_stats.st_ino)
+        return inodes
+
+    def evict_directory(self, target: str, policy: dict, stop_event: threading.Event) -> dict:
+        base_dir = UPLOAD_TARGETS[target][0]
+        index = get_directory_index(base_dir)
+        if not index.loaded:
+            index.rescan()
+        with index.lock:
+            entries = dict(index.entries)
+        accessed = access_tracker.load(target)
+        inodes = self.load_inodes(base_dir, entries) if policy["max_bytes"] else None
+        summary = {"files": 0, "bytes": 0, "reasons": {}}
+        for name, entry, reason in self.plan(entries, accessed, policy, time.time(), inodes):
+            if stop_event.is_set():
+                break
+            file_path = base_dir / name
+            try:
+                file_stats = file_path.stat()
+                # 计划之后文件可能被覆盖或重新上传，修改时间变了就留到下一轮再判断
+                if file_stats.st_mtime != entry["mtime_ts"]:
+                    continue
+                delete_stored_file(base_dir, file_path, replicate=False)
+            except OSError as error:
+                logger.error(f"清理文件失败 {target}/{name}: {error}")
+                continue
+            # 还有其他硬链接时删除这个文件名并不释放磁盘空间
+            freed = entry["size"] if file_stats.st_nlink <= 1 else 0
+            labels = (("directory", target), ("reason", reason))
+            metrics.inc("transfer_retention_evicted_files_total", labels)
+            metrics.inc("transfer_retention_evicted_bytes_total", labels, freed)
+            summary["files"] += 1
+            summary["bytes"] += freed
+            summary["reasons"][reason] = summary["reasons"].get(reason, 0) + 1
+            if summary["files"] % RETENTION_BATCH_SIZE == 0:
+                stop_event.wait(RETENTION_BATCH_PAUSE)
+
+        with index.lock:
+            current = index.entries.keys()
+            stale = [name for name in accessed if name not in current]
+        if stale:
+            access_tracker.prune(target, stale)
+        return summary
+
+    def run_once(self, stop_event: threading.Event) -> dict | None:
+        if not self.acquire_lease():
+            return None
+        access_tracker.flush()
+        started = time.time()
+        directories = {
+            target: self.evict_directory(target, policy, stop_event)
+            for target, policy in CONFIG["retention"].items()
+        }
+        report = {"started": started, "finished": time.time(), "directories": directories}
+        files = sum(summary["files"] for summary in directories.values())
+        if files:
+            freed = sum(summary["bytes"] for summary in directories.values())
+            logger.info(f"保留策略清理了 {files} 个文件，释放 {freed} 字节",
+                        extra=log_fields(event="retention", count=files, size=freed,
+                                         directories=directories))
+            with self.store.transaction() as connection:
+                connection.execute("INSERT INTO retention_reports (finished, report) VALUES (?, ?)",
+                                   (report["finished"], json.dumps(report, ensure_ascii=False)))
+                connection.execute(
+                    "DELETE FROM retention_reports WHERE id <= (SELECT MAX(id) FROM retention_reports) - ?",
+                    (RETENTION_REPORT_HISTORY,),
+                )
+        return report
+
+    def recent_reports(self) -> list[dict]:
+        return [json.loads(report) for (report,) in self.store.connect().execute(
+            "SELECT report FROM retention_reports ORDER BY id DESC LIMIT ?", (RETENTION_REPORT_HISTORY,)
+        )]
+
+    def run(self, stop_event: threading.Event):
+        # Linux 上线程可以单独设置优先级，清理任务让 CPU 给处理请求的线程
+        if sys.platform.startswith("linux"):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+            except OSError:
+                pass
+        while not stop_event.wait(CONFIG["retention_interval"]):
+            try:
+                self.run_once(stop_event)
+            except Exception as error:
+                logger.error(f"执行保留策略失败: {error}")
+
+
+retention_manager = RetentionManager(metadata_store)
+
+
+class TokenBucket:
+    """令牌桶限速：每秒补充 rate 个字节，rate 为 0 表示不限速"""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int, stop_event: threading.Event):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # 允许透支，透支的部分按速率折算成等待时间
+            self.tokens -= amount
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            stop_event.wait(delay)
+
+
+class MirrorError(Exception):
+    """与其他节点同步失败，下一轮同步时重试"""
+
+
+class MirrorService:
+    """
+    在局域网内的多个实例之间镜像 shared_files。每个节点在 config.json 的 peers 中列出其他节点，
+    定期拉取对方的清单（文件路径、大小、修改时间、sha256 和删除记录），下载本机缺少或较旧的文件。
+
+    下载按 Range 分块进行，先写入以 sha256 命名的断点文件，中断后从已下载的位置继续；
+    整个文件校验 sha256 通过后才放进 shared_files。同一路径内容不同时保留修改时间较新的版本。
+    删除记录带有被删除版本的哈希，只删除内容相同且不比删除时间新的本地文件，不会误删之后重新上传的版本。
+    多进程模式下通过数据库中的租约保证只有一个进程执行同步。
+    """
+
+    def __init__(self, store: MetadataStore):
+        self.store = store
+        self.owner = uuid.uuid4().hex
+        self.node = None
+        self.bucket = TokenBucket(CONFIG["mirror_bandwidth"])
+        self.hash_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mirror-hash")
+        self.hashing: set[str] = set()
+        self.hashing_lock = threading.Lock()
+        self.etags: dict[str, str] = {}
+        self.peers = {
+            peer: {"last_sync": None, "error": None, "pulled_files": 0, "pulled_bytes": 0, "deleted_files": 0}
+            for peer in CONFIG["peers"]
+        }
+
+    def initialize(self):
+        self.node = self.store.node_id()
+
+    def lease_ttl(self) -> float:
+        return max(MIRROR_LEASE_TTL, 3 * CONFIG["mirror_interval"])
+
+    @staticmethod
+    def path_key(name: str) -> str:
+        return content_index.path_key(SHARED_DIR / name)
+
+    def known_hash(self, connection: sqlite3.Connection, name: str) -> str | None:
+        row = connection.execute("SELECT sha256 FROM content_index WHERE path = ?", (self.path_key(name),)).fetchone()
+        return row[0] if row else None
+
+    def record_changes(self, changes: list[tuple[str, str, dict | None]]):
+        """
+        记录 shared_files 中被删除的文件和被删除版本的哈希，文件重新出现时清除删除记录。
+        保留策略清理的文件已有本机清理记录，不生成删除记录，其他节点不会跟着删除。
+        """
+        removed = [name for op, name, _ in changes if op == "remove"]
+        updated = [(name,) for op, name, _ in changes if op == "upsert"]
+        connection = self.store.connect()
+        now = time.time()
+        tombstones = [
+            (name, self.known_hash(connection, name), now) for name in removed
+            if connection.execute("SELECT 1 FROM mirror_evictions WHERE path = ?", (name,)).fetchone() is None
+        ]
+        with self.store.transaction() as connection:
+            if tombstones:
+                self.save_tombstones(connection, tombstones)
+            if updated:
+                connection.executemany("DELETE FROM mirror_tombstones WHERE path = ?", updated)
+                connection.executemany("DELETE FROM mirror_evictions WHERE path = ?", updated)
+
+    def record_eviction(self, name: str):
+        """记录按本机配额清理的文件，镜像时不再从其他节点拉取同一版本"""
+        with self.store.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO mirror_evictions (path, sha256, evicted) VALUES (?, ?, ?)",
+                (name, self.known_hash(connection, name), time.time()),
+            )
+
+    def evictions(self) -> dict[str, dict]:
+        return {
+            path: {"sha256": digest, "evicted": evicted}
+            for path, digest, evicted in self.store.connect().execute("SELECT path, sha256, evicted FROM mirror_evictions")
+        }
+
+    @staticmethod
+    def save_tombstones(connection: sqlite3.Connection, tombstones: list[tuple[str, str | None, float]]):
+        # 同一版本的删除记录保留最早的删除时间，多个节点互相转发时不会不断推后
+        connection.executemany("""
+            INSERT INTO mirror_tombstones (path, sha256, deleted) VALUES (?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                deleted = CASE WHEN excluded.sha256 IS NULL OR excluded.sha256 = mirror_tombstones.sha256
+                               THEN min(mirror_tombstones.deleted, excluded.deleted) ELSE excluded.deleted END,
+                sha256 = coalesce(excluded.sha256, mirror_tombstones.sha256)
+        """, tombstones)
+
+    def tombstones(self) -> dict[str, dict]:
+        rows = self.store.connect().execute(
+            "SELECT path, sha256, deleted FROM mirror_tombstones WHERE deleted > ? ORDER BY path",
+            (time.time() - MIRROR_TOMBSTONE_TTL,),
+        )
+        return {path: {"id": path, "sha256": digest, "deleted": deleted} for path, digest, deleted in rows}
+
+    def local_files(self) -> dict[str, dict]:
+        """shared_files 中哈希已知且仍然有效的文件；还没有哈希的文件在后台计算，下一轮同步时出现在清单中"""
+        index = get_directory_index(SHARED_DIR)
+        if not index.loaded:
+            index.rescan()
+        with index.lock:
+            entries = dict(index.entries)
+        prefix = content_index.path_key(SHARED_DIR) + "/"
+        records = {
+            key[len(prefix):]: (digest, size, mtime_ns)
+            for key, digest, size, mtime_ns in self.store.connect().execute(
+                "SELECT path, sha256, size, mtime_ns FROM content_index WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix),
+            )
+        }
+        files = {}
+        for name, entry in sorted(entries.items()):
+            record = records.get(name)
+            if record and record[1] == entry["size"] and abs(record[2] / 1e9 - entry["mtime_ts"]) < 1e-6:
+                files[name] = {"id": name, "size": entry["size"], "mtime_ns": record[2], "sha256": record[0]}
+            else:
+                self.schedule_hash(name)
+        return files
+
+    def schedule_hash(self, name: str):
+        with self.hashing_lock:
+            if name in self.hashing:
+                return
+            self.hashing.add(name)
+        self.hash_executor.submit(self.hash_local_file, name)
+
+    def hash_local_file(self, name: str):
+        try:
+            file_path = SHARED_DIR / name
+            before = file_path.stat()
+            digest = hash_file(file_path, CONFIG["upload_chunk_size"])
+            after = file_path.stat()
+            # 计算期间文件被修改过，哈希对应的不是当前内容
+            if (before.st_size, before.st_mtime_ns) == (after.st_size, after.st_mtime_ns):
+                content_index.record(file_path, digest)
+        except (OSError, sqlite3.Error) as error:
+            logger.warning(f"计算镜像文件哈希失败 {name}: {error}")
+        finally:
+            with self.hashing_lock:
+                self.hashing.discard(name)
+
+    def manifest(self) -> dict:
+        return {
+            "node": self.node,
+            "files": list(self.local_files().values()),
+            "tombstones": list(self.tombstones().values()),
+        }
+
+    def is_current(self, name: str, digest: str) -> bool:
+        """文件内容是否仍是清单中列出的版本"""
+        row = self.store.connect().execute(
+            "SELECT sha256, size, mtime_ns FROM content_index WHERE path = ?", (self.path_key(name),)
+        ).fetchone()
+        if row is None or row[0] != digest:
+            return False
+        file_stats = (SHARED_DIR / name).stat()
+        return (file_stats.st_size, file_stats.st_mtime_ns) == (row[1], row[2])
+
+    @staticmethod
+    def request(peer: str, path: str, headers: dict | None = None):
+        connection, prefix = open_connection(peer)
+        try:
+            connection.request("GET", prefix + path, headers=headers or {})
+            return connection, connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+
+    def fetch_manifest(self, peer: str) -> tuple[dict | None, str | None]:
+        """返回对方的清单和 ETag，清单与上次同步时相同则返回 None"""
+        etag = self.etags.get(peer)
+        connection, response = self.request(peer, "/mirror/manifest", {"If-None-Match": etag} if etag else None)
+        try:
+            body = response.read()
+        finally:
+            connection.close()
+        if response.status == 304:
+            return None, etag
+        if response.status != 200:
+            raise MirrorError(f"获取清单失败 ({response.status})")
+        manifest = json.loads(body)
+        if manifest.get("node") == self.node:
+            raise MirrorError("peers 中填写了本机地址")
+        return manifest, response.getheader("ETag")
+
+    def apply_tombstones(self, peer: str, tombstones: list[dict], local: dict[str, dict]):
+        expire_before = time.time() - MIRROR_TOMBSTONE_TTL
+        adopted = [
+            (tombstone["id"], tombstone["sha256"], float(tombstone["deleted"]))
+            for tombstone in tombstones if tombstone["deleted"] > expire_before
+        ]
+        for name, digest, deleted in adopted:
+            current = local.get(name)
+            # 本地是删除之后才修改或重新上传的版本时保留
+            if current is None or current["sha256"] != digest or current["mtime_ns"] > deleted * 1e9:
+                continue
+            file_path = resolve_relative_path(SHARED_DIR, name)
+            delete_stored_file(SHARED_DIR, file_path)
+            del local[name]
+            self.peers[peer]["deleted_files"] += 1
+            metrics.inc("transfer_mirror_files_total", (("peer", peer), ("op", "delete")))
+            logger.info(f"镜像删除: {name}", extra=log_fields(event="mirror_delete", file=name, peer=peer))
+        if adopted:
+            with self.store.transaction() as connection:
+                self.save_tombstones(connection, adopted)
+
+    @staticmethod
+    def wants(remote: dict, local: dict | None, tombstone: dict | None, eviction: dict | None = None) -> bool:
+        if tombstone is not None and remote["mtime_ns"] <= tombstone["deleted"] * 1e9:
+            # 对方保留的是本机已经删除的旧版本，等对方收到删除记录
+            return False
+        if eviction is not None and (
+            eviction["sha256"] == remote["sha256"] or remote["mtime_ns"] <= eviction["evicted"] * 1e9
+        ):
+            # 本机按保留策略清理掉的版本不再拉取回来，之后更新的版本照常同步
+            return False
+        if local is None:
+            # 本地存在但还没算出哈希时等下一轮再比较
+            return not (SHARED_DIR / remote["id"]).exists()
+        return local["sha256"] != remote["sha256"] and remote["mtime_ns"] > local["mtime_ns"]
+
+    def download(self, peer: str, remote: dict, part_path: Path, stop_event: threading.Event) -> str:
+        """分块下载到断点文件，返回整个文件的 sha256"""
+        size = remote["size"]
+        digest = hashlib.sha256()
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        if offset > size:
+            part_path.unlink()
+            offset = 0
+        if offset:
+            with part_path.open("rb") as part_file:
+                while chunk := part_file.read(CONFIG["upload_chunk_size"]):
+                    digest.update(chunk)
+        path = f"/mirror/file/{quote(remote['id'])}?sha256={remote['sha256']}"
+        labels = (("peer", peer),)
+        with part_path.open("ab") as part_file:
+            while offset < size:
+                if stop_event.is_set():
+                    raise MirrorError("服务器正在关闭")
+                end = min(offset + MIRROR_CHUNK_SIZE, size) - 1
+                connection, response = self.request(peer, path, {"Range": f"bytes={offset}-{end}"})
+                try:
+                    if response.status != 206 or not (response.getheader("Content-Range") or "").startswith(
+                        f"bytes {offset}-{end}/{size}"
+                    ):
+                        raise MirrorError(f"下载 {remote['id']} 失败 ({response.status})")
+                    while data := response.read(MIRROR_READ_SIZE):
+                        self.bucket.consume(len(data), stop_event)
+                        part_file.write(data)
+                        digest.update(data)
+                        offset += len(data)
+                        metrics.inc("transfer_mirror_bytes_total", labels, len(data))
+                finally:
+                    connection.close()
+                    part_file.flush()
+                if offset != end + 1:
+                    raise MirrorError(f"下载 {remote['id']} 时连接中断，下一轮从 {offset} 字节处继续")
+                self.store.acquire_lease("mirror", self.owner, self.lease_ttl())
+        return digest.hexdigest()
+
+    def pull(self, peer: str, remote: dict, stop_event: threading.Event):
+        name, digest, size = remote["id"], remote["sha256"], remote["size"]
+        if not SHA256_PATTERN.match(digest):
+            raise MirrorError(f"{name} 的哈希不合法")
+        file_path = resolve_relative_path(SHARED_DIR, name)
+        part_path = MIRROR_DIR / f"{digest}.part"
+        existing = content_index.find(digest, size)
+        if existing is not None:
+            # 本机已有相同内容时不再下载；修改时间也相同才能共用 inode，否则复制一份再改修改时间
+            part_path.unlink(missing_ok=True)
+            linked = False
+            if existing.stat().st_mtime_ns == remote["mtime_ns"]:
+                try:
+                    os.link(existing, part_path)
+                    linked = True
+                except OSError:
+                    pass
+            if not linked:
+                shutil.copyfile(existing, part_path)
+            actual = hash_file(part_path, CONFIG["upload_chunk_size"])
+        else:
+            actual = self.download(peer, remote, part_path, stop_event)
+        if actual != digest or part_path.stat().st_size != size:
+            part_path.unlink(missing_ok=True)
+            raise MirrorError(f"{name} 校验失败，下一轮重新下载")
+
+        if part_path.stat().st_mtime_ns != remote["mtime_ns"]:
+            os.utime(part_path, ns=(remote["mtime_ns"], remote["mtime_ns"]))
+        sync_file(part_path)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        if file_path.exists():
+            # 对方的版本更新，原子替换本地的旧版本
+            os.replace(part_path, file_path)
+        else:
+            try:
+                os.link(part_path, file_path)
+                part_path.unlink()
+            except FileExistsError:
+                part_path.unlink()
+                raise MirrorError(f"{name} 在同步期间被上传，下一轮再比较")
+            except OSError:
+                os.replace(part_path, file_path)
+        sync_directory(file_path.parent)
+        content_index.record(file_path, digest)
+        register_new_file(SHARED_DIR, file_path)
+
+        state = self.peers[peer]
+        state["pulled_files"] += 1
+        state["pulled_bytes"] += size
+        metrics.inc("transfer_mirror_files_total", (("peer", peer), ("op", "pull")))
+        logger.info(f"镜像下载: {name}", extra=log_fields(event="mirror_pull", file=name, size=size, peer=peer))
+
+    def sync_peer(self, peer: str, stop_event: threading.Event):
+        manifest, etag = self.fetch_manifest(peer)
+        if manifest is None:
+            return
+        local = self.local_files()
+        self.apply_tombstones(peer, manifest["tombstones"], local)
+        tombstones = self.tombstones()
+        evictions = self.evictions()
+        failures = []
+        for remote in manifest["files"]:
+            if stop_event.is_set():
+                return
+            name = remote["id"]
+            if not self.wants(remote, local.get(name), tombstones.get(name), evictions.get(name)):
+                continue
+            try:
+                self.pull(peer, remote, stop_event)
+            except (OSError, MirrorError, http.client.HTTPException) as error:
+                failures.append(f"{name}: {error}")
+            except HTTPException as error:
+                failures.append(f"{name}: {error.detail}")
+        if failures:
+            raise MirrorError(f"{len(failures)} 个文件同步失败，" + "；".join(failures[:3]))
+        # 全部成功后才记住 ETag，失败的文件下一轮会重新尝试
+        self.etags[peer] = etag
+
+    def cleanup(self):
+        """清理过期的删除记录和长时间没有继续的断点文件"""
+        with self.store.transaction() as connection:
+            connection.execute("DELETE FROM mirror_tombstones WHERE deleted <= ?",
+                               (time.time() - MIRROR_TOMBSTONE_TTL,))
+            connection.execute("DELETE FROM mirror_evictions WHERE evicted <= ?",
+                               (time.time() - MIRROR_TOMBSTONE_TTL,))
+        expire_before = time.time() - UPLOAD_SESSION_TTL
+        for path in MIRROR_DIR.iterdir():
+            try:
+                if path.stat().st_mtime < expire_before:
+                    path.unlink()
+            except OSError:
+                continue
+
+    def run_once(self, stop_event: threading.Event) -> bool:
+        if not self.store.acquire_lease("mirror", self.owner, self.lease_ttl()):
+            return False
+        for peer, state in self.peers.items():
+            if stop_event.is_set():
+                break
+            try:
+                self.sync_peer(peer, stop_event)
+                state["error"] = None
+            except (OSError, ValueError, KeyError, TypeError, MirrorError, http.client.HTTPException) as error:
+                message = str(error) or type(error).__name__
+                # 对方离线时每一轮都会失败，同样的错误只记录一次日志
+                if message != state["error"]:
+                    logger.warning(f"与 {peer} 同步失败: {message}",
+                                   extra=log_fields(event="mirror_error", peer=peer))
+                state["error"] = message
+            else:
+                state["last_sync"] = time.time()
+        self.cleanup()
+        return True
+
+    def describe(self) -> dict:
+        row = self.store.connect().execute(
+            "SELECT owner, expires FROM maintenance_leases WHERE name = 'mirror'"
+        ).fetchone()
+        return {
+            "node": self.node,
+            "interval": CONFIG["mirror_interval"],
+            "bandwidth": CONFIG["mirror_bandwidth"],
+            "active": row is not None and row[0] == self.owner and row[1] > time.time(),
+            "peers": [{"url": peer, **state} for peer, state in self.peers.items()],
+            "tombstones": len(self.tombstones()),
+        }
+
+    def run(self, stop_event: threading.Event):
+        while True:
+            try:
+                self.run_once(stop_event)
+            except Exception as error:
+                logger.error(f"执行镜像同步失败: {error}")
+            if stop_event.wait(CONFIG["mirror_interval"]):
+                break
+
+
+mirror_service = MirrorService(metadata_store)
+
+
+def watch_directory_indexes(stop_event: threading.Event):
+    last_full_rescan = time.monotonic()
+    while not stop_event.wait(INDEX_POLL_INTERVAL):
+        try:
+            access_tracker.flush()
+        except sqlite3.Error as error:
+            logger.error(f"保存访问记录失败: {error}")
+        full_rescan = time.monotonic() - last_full_rescan >= INDEX_FULL_RESCAN_INTERVAL
+        for index in directory_indexes.values():
+            try:
+                if CONFIG["workers"] > 1:
+                    index.sync_changes()
+                # 定期全量扫描，补上原地修改文件这类不改变目录 mtime 的情况
+                if full_rescan:
+                    index.rescan()
+                else:
+                    index.refresh_if_changed()
+            except Exception as error:
+                logger.error(f"刷新目录索引失败 {index.base_dir.name}: {error}")
+        if full_rescan:
+            last_full_rescan = time.monotonic()
+        if CONFIG["workers"] > 1:
+            try:
+                save_metrics_snapshot()
+            except OSError as error:
+                logger.error(f"保存指标快照失败: {error}")
+
+
+def build_file_info(base_dir: Path):
+    return get_directory_index(base_dir).list_files()
+
+
+def encode_listing_cursor(key: tuple) -> str:
+    raw = json.dumps(list(key), ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_listing_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        key = tuple(json.loads(base64.urlsafe_b64decode(cursor.encode("ascii"))))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+    value_type = str if sort == "name" else (int, float)
+    if len(key) != 2 or not isinstance(key[0], value_type) or not isinstance(key[1], str):
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+    return key
+
+
+def list_directory_page(base_dir: Path, limit: int, cursor: str | None, sort: str, order: str, prefix: str) -> dict:
+    """按排序键和游标取一页，只遍历当前页需要的条目"""
+    version, keys, items = get_directory_index(base_dir).get_sorted_view(sort)
+    folded_prefix = prefix.casefold()
+
+    if sort == "name" and folded_prefix:
+        # 名称排序时前缀匹配的条目是连续的一段，直接二分定位
+        low = bisect.bisect_left(keys, (folded_prefix,))
+        high = bisect.bisect_left(keys, (folded_prefix + "\U0010ffff",))
+    else:
+        low, high = 0, len(keys)
+
+    if cursor:
+        cursor_key = decode_listing_cursor(cursor, sort)
+        if order == "asc":
+            low = max(low, bisect.bisect_right(keys, cursor_key))
+        else:
+            high = min(high, bisect.bisect_left(keys, cursor_key))
+
+    positions = range(low, high) if order == "asc" else range(high - 1, low - 1, -1)
+    page = []
+    last_key = None
+    has_more = False
+    for position in positions:
+        item = items[position]
+        if folded_prefix and not item["name"].casefold().startswith(folded_prefix):
+            continue
+        if len(page) == limit:
+            has_more = True
+            break
+        page.append(item)
+        last_key = keys[position]
+
+    return {
+        "version": version,
+        "files": page,
+        "total": len(items),
+        "next_cursor": encode_listing_cursor(last_key) if has_more else None,
+    }
+
+
+async def build_listing_response(request: Request, base_dir: Path, limit: int | None, cursor: str | None,
+                                 sort: str, order: str | None, prefix: str):
+    if sort not in LISTING_SORT_KEYS:
+        raise HTTPException(status_code=400, detail="不支持的排序方式")
+    order = order or LISTING_DEFAULT_ORDERS[sort]
+    if order not in {"asc", "desc"}:
+        raise HTTPException(status_code=400, detail="不支持的排序方向")
+    if limit is not None and not 1 <= limit <= MAX_LISTING_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit 需在 1 ~ {MAX_LISTING_PAGE_SIZE} 之间")
+
+    index = get_directory_index(base_dir)
+    if CONFIG["workers"] > 1:
+        # 上传可能由其他工作进程处理，返回列表前先同步共享的变更日志
+        await run_in_threadpool(index.sync_changes)
+    if limit is None:
+        if not index.loaded:
+            await run_in_threadpool(index.rescan)
+        version = index.version
+    else:
+        page = await run_in_threadpool(list_directory_page, base_dir, limit, cursor, sort, order, prefix)
+        version = page["version"]
+
+    # 目录版本不变时同一查询的结果必然相同，可以用版本号生成强 ETag
+    query_digest = hashlib.md5(str(request.url.query).encode("utf-8"), usedforsecurity=False).hexdigest()[:12]
+    etag = f'"{INDEX_EPOCH}-{base_dir.name}-{version}-{query_digest}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [value.strip() for value in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    if limit is None:
+        return JSONResponse(content={"success": True, "files": build_file_info(base_dir)}, headers=headers)
+    return JSONResponse(content={
+        "success": True,
+        "files": page["files"],
+        "total": page["total"],
+        "next_cursor": page["next_cursor"],
+    }, headers=headers)
+
+
+class ContentIndex:
+    """内容哈希索引（sha256 -> 文件），用于识别重复上传的文件，记录保存在共享的元数据库中"""
+
+    def __init__(self, store: MetadataStore, legacy_path: Path):
+        self.store = store
+        self.legacy_path = legacy_path
+
+    @staticmethod
+    def path_key(file_path: Path) -> str:
+        return file_path.resolve().relative_to(DATA_DIR).as_posix()
+
+    def load(self):
+        # 旧版本把索引保存在 JSON 文件中，首次启动时导入数据库
+        try:
+            with self.legacy_path.open("r", encoding="utf-8") as index_file:
+                records = json.load(index_file)
+        except (OSError, ValueError):
+            return
+        with self.store.transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO content_index (path, sha256, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                [(key, record["sha256"], record["size"], record["mtime_ns"]) for key, record in records.items()],
+            )
+        self.legacy_path.unlink(missing_ok=True)
+
+    def record(self, file_path: Path, digest: str):
+        file_stats = file_path.stat()
+        key = self.path_key(file_path)
+        with self.store.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO content_index (path, sha256, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                (key, digest, file_stats.st_size, file_stats.st_mtime_ns),
+            )
+
+    def forget(self, file_path: Path):
+        with self.store.transaction() as connection:
+            connection.execute("DELETE FROM content_index WHERE path = ?", (self.path_key(file_path),))
+
+    def find(self, digest: str, size: int, exclude: Path | None = None) -> Path | None:
+        exclude_key = self.path_key(exclude) if exclude is not None else None
+        candidates = self.store.connect().execute(
+            "SELECT path, size, mtime_ns FROM content_index WHERE sha256 = ?", (digest,)
+        ).fetchall()
+        for key, record_size, mtime_ns in candidates:
+            if key == exclude_key:
+                continue
+            file_path = DATA_DIR / key
+            try:
+                file_stats = file_path.stat()
+            except OSError:
+                file_stats = None
+            # 文件被外部修改或删除后记录失效，丢弃即可
+            if file_stats is None or file_stats.st_size != record_size or file_stats.st_mtime_ns != mtime_ns:
+                with self.store.transaction() as connection:
+                    connection.execute("DELETE FROM content_index WHERE path = ? AND mtime_ns = ?", (key, mtime_ns))
+                continue
+            if record_size == size:
+                return file_path
+        return None
+
+
+content_index = ContentIndex(metadata_store, CONTENT_INDEX_PATH)
+
+
+def hash_file(file_path: Path, chunk_size: int) -> str:
+    digest = hashlib.sha256()
+    with file_path.open("rb") as input_file:
+        while True:
+            chunk = input_file.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sync_directory(path: Path):
+    """durability 为 fsync 时把目录项刷到磁盘，保证改名之后断电也能看到新文件"""
+    if CONFIG["durability"] != "fsync" or os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_file(path: Path):
+    if CONFIG["durability"] != "fsync":
+        return
+    with path.open("rb+") as output_file:
+        os.fsync(output_file.fileno())
+
+
+def preallocate_file(output_file, size: int):
+    """按声明的大小预先分配磁盘空间：减少碎片，空间不足时在接收数据之前就失败"""
+    if size <= 0:
+        return
+    if shutil.disk_usage(STAGING_DIR).free < size:
+        raise HTTPException(status_code=507, detail="服务器磁盘空间不足")
+    if not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(output_file.fileno(), 0, size)
+    except OSError as error:
+        if error.errno == errno.ENOSPC:
+            raise HTTPException(status_code=507, detail="服务器磁盘空间不足") from error
+        # 部分文件系统（如网络文件系统）不支持预分配，直接写入即可
+
+
+def publish_file(temp_path: Path, target_dir: Path, filename: str) -> Path:
+    """把写完的临时文件以不重名的文件名放进目标目录，目录中不会出现空文件或写了一半的文件"""
+    try:
+        file_path = link_unique_file(temp_path, target_dir, filename)
+    except OSError:
+        # 文件系统不支持硬链接（如 FAT/exFAT）时先占用文件名再原子替换
+        file_path = create_unique_file(target_dir, filename)
+        try:
+            os.replace(temp_path, file_path)
+        except OSError:
+            file_path.unlink(missing_ok=True)
+            raise
+    else:
+        temp_path.unlink()
+    sync_directory(target_dir)
+    return file_path
+
+
+class StagedFile:
+    """
+    在暂存目录中写入的新文件：写完后 commit 改名到目标目录，中途失败或放弃时 discard 删除，
+    目录列表、下载和缩略图都不会看到写了一半的文件。size_hint 为客户端声明的大小，用于预分配空间。
+    """
+
+    def __init__(self, size_hint: int = 0):
+        self.path = STAGING_DIR / f"{uuid.uuid4().hex}.part"
+        self.file = self.path.open("wb")
+        self.committed = False
+        try:
+            preallocate_file(self.file, size_hint)
+        except BaseException:
+            self.discard()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.discard()
+
+    def close(self):
+        if self.file.closed:
+            return
+        # 实际数据可能比声明的短，去掉预分配但没有用到的部分
+        self.file.truncate()
+        if CONFIG["durability"] == "fsync":
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+    def commit(self, target_dir: Path, filename: str) -> Path:
+        self.close()
+        file_path = publish_file(self.path, target_dir, filename)
+        self.committed = True
+        return file_path
+
+    def replace(self, file_path: Path):
+        """原子地替换已有文件，正在读取旧文件的下载不受影响"""
+        self.close()
+        os.replace(self.path, file_path)
+        self.committed = True
+        sync_directory(file_path.parent)
+
+    def discard(self):
+        self.file.close()
+        if not self.committed:
+            self.path.unlink(missing_ok=True)
+
+
+def cleanup_staging_files():
+    """启动时清理上次异常退出留下的暂存文件；多进程模式下其他进程可能正在写入，只清理长时间没有更新的文件"""
+    expire_before = time.time() - STALE_TEMP_FILE_AGE if CONFIG["workers"] > 1 else float("inf")
+    removed = 0
+    for path in STAGING_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < expire_before:
+                path.unlink()
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        logger.info(f"已清理 {removed} 个未完成的暂存文件")
+
+
+def replace_with_link(source: Path, file_path: Path) -> bool:
+    """把 file_path 替换为 source 的硬链接，文件系统不支持硬链接时返回 False"""
+    temp_path = STAGING_DIR / f"{uuid.uuid4().hex}.link"
+    try:
+        # 硬链接与原文件共用 inode，不能修改时间，否则原文件也会显示为刚上传
+        os.link(source, temp_path)
+        os.replace(temp_path, file_path)
+        return True
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+        return False
+
+
+def store_deduplicated(file_path: Path, digest: str):
+    """记录新文件的哈希；内容已存在时改为硬链接，重复文件不再额外占用磁盘"""
+    existing = content_index.find(digest, file_path.stat().st_size, exclude=file_path)
+    if existing is not None and replace_with_link(existing, file_path):
+        logger.info(f"重复内容已链接: {file_path.name} -> {existing.name}")
+    content_index.record(file_path, digest)
+
+
+def copy_upload_stream(source, output_file, chunk_size: int) -> tuple[int, str]:
+    """按固定大小分块写入磁盘，同时计算 sha256，单个传输占用的内存不超过 chunk_size"""
+    written = 0
+    digest = hashlib.sha256()
+    source.seek(0)
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        write_timed(output_file, chunk, "upload")
+        digest.update(chunk)
+        written += len(chunk)
+    return written, digest.hexdigest()
+
+
+def register_new_file(target_dir: Path, file_path: Path):
+    """新文件写入完成后更新目录索引，并在后台预生成缩略图"""
+    get_directory_index(target_dir).update(file_path)
+    schedule_thumbnail(file_path)
+
+
+def save_upload_file(upload: UploadFile, target_dir: Path, default_name: str) -> Path:
+    safe_filename = sanitize_filename(upload.filename, default_name)
+    with StagedFile(upload.size or 0) as staged:
+        _, digest = copy_upload_stream(upload.file, staged.file, CONFIG["upload_chunk_size"])
+        file_path = staged.commit(target_dir, safe_filename)
+    store_deduplicated(file_path, digest)
+    register_new_file(target_dir, file_path)
+    return file_path
+
+
+def link_existing_content(digest: str, size: int, target_dir: Path, filename: str) -> Path | None:
+    """服务器已有相同内容时直接以新文件名创建，无需再传输数据"""
+    existing = content_index.find(digest, size)
+    if existing is None:
+        return None
+    try:
+        file_path = link_unique_file(existing, target_dir, filename)
+    except OSError:
+        with StagedFile(size) as staged, existing.open("rb") as source:
+            shutil.copyfileobj(source, staged.file, CONFIG["upload_chunk_size"])
+            file_path = staged.commit(target_dir, filename)
+    else:
+        # 沿用原文件的修改时间：修改共用的 inode 会让原文件也显示为刚上传
+        sync_directory(target_dir)
+    content_index.record(file_path, digest)
+    register_new_file(target_dir, file_path)
+    return file_path
+
+
+async def save_upload_files(files: list[UploadFile] | None, target_dir: Path, default_name: str, log_prefix: str):
+    uploaded_count = 0
+    for upload in files or []:
+        try:
+            # 磁盘读写放到工作线程中执行，避免大文件阻塞事件循环
+            file_path = await run_in_threadpool(save_upload_file, upload, target_dir, default_name)
+            uploaded_count += 1
+            logger.info(f"{log_prefix}: {upload.filename} -> 保存为: {file_path.name}",
+                        extra=log_fields(event="upload", directory=target_dir.name, file=file_path.name))
+        except Exception as file_error:
+            logger.error(f"保存文件 {getattr(upload, 'filename', 'unknown')} 失败: {file_error}")
+        finally:
+            await upload.close()
+    return uploaded_count
+
+
+class ArchiveFormatError(ValueError):
+    """上传的文件夹归档格式不正确或包含非法路径"""
+
+
+class TarStreamExtractor:
+    """
+    增量解析浏览器发来的 tar 流（ustar，长文件名和大文件用 PAX 扩展头），边接收边把文件写入目标目录。
+    归档中的每个顶层目录都在目标目录下新建一个不重名的目录；只接受普通文件和目录，
+    每一级路径都按上传文件名的规则清理，含有 .. 的路径直接拒绝，不会写到目标目录之外。
+    """
+
+    def __init__(self, target_dir: Path):
+        self.target_dir = target_dir
+        self.buffer = bytearray()
+        self.roots: dict[str, Path] = {}
+        self.overrides: dict[str, str] = {}
+        self.metadata_type = None
+        self.metadata_size = 0
+        self.output = None
+        self.output_path = None
+        self.output_mtime = None
+        self.digest = None
+        self.remaining = 0
+        self.pending_padding = 0
+        self.skip = 0
+        self.finished = False
+        self.saved_files: list[Path] = []
+        self.written = 0
+
+    def feed(self, data: bytes):
+        self.buffer.extend(data)
+        position = 0
+        while not self.finished:
+            available = len(self.buffer) - position
+            if self.output is not None:
+                take = min(available, self.remaining)
+                if take:
+                    chunk = bytes(self.buffer[position:position + take])
+                    write_timed(self.output.file, chunk, "folder")
+                    self.digest.update(chunk)
+                    self.written += take
+                    self.remaining -= take
+                    position += take
+                if self.remaining:
+                    break
+                self.finish_file()
+            elif self.skip:
+                take = min(available, self.skip)
+                self.skip -= take
+                position += take
+                if self.skip:
+                    break
+            elif self.metadata_type is not None:
+                padded = self.metadata_size + (-self.metadata_size % TAR_BLOCK_SIZE)
+                if available < padded:
+                    break
+                self.read_metadata(bytes(self.buffer[position:position + self.metadata_size]))
+                position += padded
+            elif available >= TAR_BLOCK_SIZE:
+                self.read_header(bytes(self.buffer[position:position + TAR_BLOCK_SIZE]))
+                position += TAR_BLOCK_SIZE
+            else:
+                break
+        # 结束块之后的填充数据直接丢弃
+        del self.buffer[:len(self.buffer) if self.finished else position]
+
+    def read_header(self, block: bytes):
+        if block == bytes(TAR_BLOCK_SIZE):
+            self.finished = True
+            return
+        try:
+            info = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+        except tarfile.HeaderError as error:
+            raise ArchiveFormatError("不是有效的 tar 数据") from error
+
+        if info.type in (tarfile.XHDTYPE, tarfile.GNUTYPE_LONGNAME):
+            if info.size > MAX_TAR_METADATA_SIZE:
+                raise ArchiveFormatError("tar 扩展头过大")
+            self.metadata_type = info.type
+            self.metadata_size = info.size
+            return
+
+        overrides, self.overrides = self.overrides, {}
+        try:
+            size = int(overrides.get("size", info.size))
+        except ValueError:
+            raise ArchiveFormatError("tar 扩展头格式错误")
+        if size < 0:
+            raise ArchiveFormatError("tar 文件长度不合法")
+        name = overrides.get("path", info.name)
+        try:
+            mtime = float(overrides.get("mtime", info.mtime))
+        except ValueError:
+            mtime = time.time()
+        if info.type in (tarfile.REGTYPE, tarfile.AREGTYPE, tarfile.CONTTYPE):
+            self.start_file(name, size, mtime)
+        elif info.type == tarfile.DIRTYPE:
+            self.member_path(name, directory=True)
+        else:
+            # 全局扩展头、符号链接、硬链接和设备文件一律跳过
+            self.skip = size + (-size % TAR_BLOCK_SIZE)
+
+    def read_metadata(self, data: bytes):
+        if self.metadata_type == tarfile.GNUTYPE_LONGNAME:
+            self.overrides["path"] = data.rstrip(b"\0").decode("utf-8", "surrogateescape")
+        else:
+            # PAX 记录格式为 "长度 键=值\n"，长度包含记录本身
+            position = 0
+            while position < len(data):
+                length_text, _, rest = data[position:].partition(b" ")
+                try:
+                    length = int(length_text)
+                except ValueError:
+                    raise ArchiveFormatError("tar 扩展头格式错误")
+                if length <= 0:
+                    raise ArchiveFormatError("tar 扩展头格式错误")
+                key, _, value = data[position + len(length_text) + 1:position + length - 1].partition(b"=")
+                if key in (b"path", b"size", b"mtime"):
+                    self.overrides[key.decode("ascii")] = value.decode("utf-8", "surrogateescape")
+                position += length
+        self.metadata_type = None
+
+    def member_path(self, name: str, directory: bool) -> Path | None:
+        parts = [part for part in name.replace("\\", "/").split("/") if part not in {"", "."}]
+        if ".." in parts:
+            raise ArchiveFormatError(f"非法文件路径: {name}")
+        if len(parts) > MAX_PATH_DEPTH:
+            raise ArchiveFormatError(f"目录层级过深: {name}")
+        if not parts:
+            return None
+        parts = [sanitize_filename(part, "_") for part in parts]
+        if len(parts) == 1 and not directory:
+            return self.target_dir / parts[0]
+
+        root = self.roots.get(parts[0])
+        if root is None:
+            root = create_unique_directory(self.target_dir, parts[0])
+            self.roots[parts[0]] = root
+        folder = root.joinpath(*(parts[1:] if directory else parts[1:-1]))
+        folder.mkdir(parents=True, exist_ok=True)
+        if not folder.resolve().is_relative_to(root.resolve()):
+            raise ArchiveFormatError(f"非法文件路径: {name}")
+        # 文件先写入暂存区，写完才以不重名的文件名放到这里
+        return folder if directory else folder / parts[-1]
+
+    def start_file(self, name: str, size: int, mtime: float):
+        file_path = self.member_path(name, directory=False)
+        padding = -size % TAR_BLOCK_SIZE
+        if file_path is None:
+            self.skip = size + padding
+            return
+        self.output_path = file_path
+        self.output = StagedFile(size)
+        self.output_mtime = mtime
+        self.digest = hashlib.sha256()
+        self.remaining = size
+        # 文件数据之后的填充在写完后跳过
+        self.pending_padding = padding
+        if size == 0:
+            self.finish_file()
+
+    def finish_file(self):
+        output, self.output = self.output, None
+        output_path, self.output_path = self.output_path, None
+        try:
+            output.close()
+            try:
+                # 保留原文件的修改时间，相册等目录按时间排序才有意义
+                os.utime(output.path, (self.output_mtime, self.output_mtime))
+            except (OSError, OverflowError, ValueError):
+                pass
+            file_path = output.commit(output_path.parent, output_path.name)
+        finally:
+            output.discard()
+        store_deduplicated(file_path, self.digest.hexdigest())
+        register_new_file(self.target_dir, file_path)
+        self.saved_files.append(file_path)
+        self.skip = self.pending_padding
+
+    def abort(self):
+        """中途出错时丢弃写了一半的文件，已完整写入的文件保留"""
+        if self.output is not None:
+            self.output.discard()
+            self.output = None
+
+
+async def receive_folder_upload(request: Request, extractor: TarStreamExtractor):
+    buffer = bytearray()
+    chunk_size = CONFIG["upload_chunk_size"]
+    try:
+        async for piece in request.stream():
+            buffer.extend(piece)
+            if len(buffer) >= chunk_size:
+                await run_in_threadpool(extractor.feed, bytes(buffer))
+                buffer.clear()
+        await run_in_threadpool(extractor.feed, bytes(buffer))
+        if not extractor.finished or extractor.output is not None or extractor.metadata_type is not None:
+            raise ArchiveFormatError("文件夹数据不完整")
+    finally:
+        await run_in_threadpool(extractor.abort)
+
+
+def merge_received_range(ranges: list[list[int]], start: int, end: int) -> list[list[int]]:
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+
+def get_upload_session_part_path(session_id: str) -> Path:
+    return UPLOAD_SESSION_DIR / f"{session_id}.part"
+
+
+def save_upload_session(session: dict):
+    with metadata_store.transaction() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO upload_sessions (id, data, updated) VALUES (?, ?, ?)",
+            (session["id"], json.dumps(session), time.time()),
+        )
+
+
+def remove_upload_session(session_id: str):
+    with metadata_store.transaction() as connection:
+        connection.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+    get_upload_session_part_path(session_id).unlink(missing_ok=True)
+
+
+def read_upload_session(connection: sqlite3.Connection, session_id: str) -> dict:
+    row = connection.execute("SELECT data FROM upload_sessions WHERE id = ?", (session_id,)).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+    return json.loads(row[0])
+
+
+def load_upload_session(session_id: str) -> dict:
+    if not UPLOAD_SESSION_ID_PATTERN.match(session_id or ""):
+        raise HTTPException(status_code=400, detail="非法上传会话")
+
+    # 会话保存在共享的元数据库中，服务器重启或换了工作进程都可以继续断点续传
+    session = read_upload_session(metadata_store.connect(), session_id)
+    if not get_upload_session_part_path(session_id).exists():
+        remove_upload_session(session_id)
+        raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+    return session
+
+
+def record_upload_range(session_id: str, start: int, end: int) -> dict:
+    """在事务中合并已接收区间，多个进程并发写同一会话的不同分块也不会丢失记录"""
+    with metadata_store.transaction() as connection:
+        session = read_upload_session(connection, session_id)
+        session["received"] = merge_received_range(session["received"], start, end)
+        connection.execute(
+            "UPDATE upload_sessions SET data = ?, updated = ? WHERE id = ?",
+            (json.dumps(session), time.time(), session_id),
+        )
+    return session
+
+
+def claim_upload_session(session_id: str) -> tuple[dict, bool]:
+    """数据已完整时从数据库中取走会话，保证只有一个请求执行组装；返回 (会话, 是否已取走)"""
+    with metadata_store.transaction() as connection:
+        session = read_upload_session(connection, session_id)
+        expected = [[0, session["size"]]] if session["size"] else []
+        if session["received"] != expected:
+            return session, False
+        connection.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+    return session, True
+
+
+def cleanup_stale_upload_sessions():
+    expire_before = time.time() - UPLOAD_SESSION_TTL
+    with metadata_store.transaction() as connection:
+        connection.execute("DELETE FROM upload_sessions WHERE updated < ?", (expire_before,))
+    for path in UPLOAD_SESSION_DIR.iterdir():
+        try:
+            if path.suffix == ".json":
+                # 旧版本把会话保存为 JSON 文件，导入数据库后删除
+                session = json.loads(path.read_text(encoding="utf-8"))
+                if get_upload_session_part_path(session["id"]).exists():
+                    save_upload_session(session)
+                path.unlink()
+            elif path.stat().st_mtime < expire_before:
+                path.unlink()
+        except (OSError, ValueError, KeyError):
+            continue
+
+
+def describe_upload_session(session: dict) -> dict:
+    received = session["received"]
+    contiguous = received[0][1] if received and received[0][0] == 0 else 0
+    return {
+        "success": True,
+        "session_id": session["id"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "chunk_size": session["chunk_size"],
+        "received": received,
+        "received_bytes": sum(end - start for start, end in received),
+        "offset": contiguous,
+    }
+
+
+def create_upload_session(target: str, filename: str, size: int) -> dict:
+    session_id = uuid.uuid4().hex
+    session = {
+        "id": session_id,
+        "target": target,
+        "filename": filename,
+        "size": size,
+        "chunk_size": CONFIG["session_chunk_size"],
+        "received": [],
+        "created": time.time(),
+    }
+    part_path = get_upload_session_part_path(session_id)
+    try:
+        with part_path.open("wb") as part_file:
+            preallocate_file(part_file, size)
+            part_file.truncate(size)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+    save_upload_session(session)
+    return session
+
+
+async def write_request_body_at(request: Request, file_path: Path, offset: int, max_length: int) -> int:
+    """把请求体按块写入文件的指定偏移处，磁盘写入在工作线程中完成"""
+    output_file = await run_in_threadpool(file_path.open, "r+b")
+    written = 0
+    buffer = bytearray()
+    chunk_size = CONFIG["upload_chunk_size"]
+    try:
+        await run_in_threadpool(output_file.seek, offset)
+        async for piece in request.stream():
+            if written + len(buffer) + len(piece) > max_length:
+                raise HTTPException(status_code=400, detail="分块大小超出文件范围")
+            buffer.extend(piece)
+            if len(buffer) >= chunk_size:
+                await run_in_threadpool(write_timed, output_file, bytes(buffer), "session")
+                written += len(buffer)
+                buffer.clear()
+        if buffer:
+            await run_in_threadpool(write_timed, output_file, bytes(buffer), "session")
+            written += len(buffer)
+    finally:
+        await run_in_threadpool(output_file.close)
+    return written
+
+
+def finalize_upload_session(session: dict) -> Path:
+    target_dir, default_name, _ = UPLOAD_TARGETS[session["target"]]
+    part_path = get_upload_session_part_path(session["id"])
+    safe_filename = sanitize_filename(session["filename"], default_name)
+    sync_file(part_path)
+    file_path = publish_file(part_path, target_dir, safe_filename)
+    # 分块乱序到达，无法边写边算，组装完成后再计算一次哈希
+    store_deduplicated(file_path, hash_file(file_path, CONFIG["upload_chunk_size"]))
+    register_new_file(target_dir, file_path)
+    return file_path
+
+
+class DownloadFileResponse(FileResponse):
+    # 默认 64KB 的分块对大文件来说系统调用过多，加大分块提升吞吐
+    chunk_size = DOWNLOAD_CHUNK_SIZE
+
+    async def _handle_multiple_ranges(self, send, ranges: list[tuple[int, int]], file_size: int,
+                                      send_header_only: bool) -> None:
+        # 按 RFC 9110 输出 multipart/byteranges：Content-Type 带 boundary，分隔行使用 CRLF
+        boundary = secrets.token_hex(13)
+        part_type = self.headers["content-type"]
+        part_headers = [
+            (
+                ("\r\n" if position else "")
+                + f"--{boundary}\r\nContent-Type: {part_type}\r\n"
+                + f"Content-Range: bytes {start}-{end - 1}/{file_size}\r\n\r\n"
+            ).encode("latin-1")
+            for position, (start, end) in enumerate(ranges)
+        ]
+        closing = f"\r\n--{boundary}--\r\n".encode("latin-1")
+        content_length = sum(map(len, part_headers)) + sum(end - start for start, end in ranges) + len(closing)
+
+        self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        self.headers["content-length"] = str(content_length)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        if send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            for part_header, (start, end) in zip(part_headers, ranges):
+                await send({"type": "http.response.body", "body": part_header, "more_body": True})
+                await file.seek(start)
+                while start < end:
+                    chunk = await file.read(min(self.chunk_size, end - start))
+                    if not chunk:
+                        break
+                    start += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": closing, "more_body": False})
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match 使用弱比较，忽略 W/ 前缀
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in [value.removeprefix("W/") for value in candidates]
+
+
+def is_not_modified(request: Request, headers) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, headers["etag"])
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None:
+        return False
+    try:
+        return parsedate_to_datetime(headers["last-modified"]) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+def inline_media_type(filename: str) -> str | None:
+    """允许在浏览器中直接打开的 Content-Type，其他类型返回 None"""
+    media_type = mimetypes.guess_type(filename)[0]
+    if media_type in INLINE_MEDIA_TYPES or (media_type or "").startswith(INLINE_MEDIA_PREFIXES):
+        return media_type
+    return None
+
+
+async def build_download_response(request: Request, file_path: Path, inline: bool):
+    """
+    构造文件下载响应。
+
+    Range / 多段 Range / If-Range 由 FileResponse 处理；ASGI 服务器支持
+    http.response.pathsend 扩展时会直接用 sendfile 零拷贝发送。
+    inline=True 时按扩展名返回真实的 Content-Type，视频、图片可以在浏览器中直接播放和拖动；
+    不在白名单中的类型仍按附件下载，直接打开的响应额外加上 CSP sandbox。
+    """
+    stat_result = await run_in_threadpool(file_path.stat)
+    media_type = inline_media_type(file_path.name) if inline else None
+    headers = {"X-Content-Type-Options": "nosniff"}
+    if media_type is not None:
+        disposition = "inline"
+        headers["Content-Security-Policy"] = "sandbox"
+    else:
+        media_type = "application/octet-stream"
+        disposition = "attachment"
+    response = DownloadFileResponse(
+        path=str(file_path),
+        filename=file_path.name,
+        media_type=media_type,
+        stat_result=stat_result,
+        content_disposition_type=disposition,
+        headers=headers,
+    )
+
+    if is_not_modified(request, response.headers):
+        return Response(status_code=304, headers={
+            "ETag": response.headers["etag"],
+            "Last-Modified": response.headers["last-modified"],
+        })
+
+    if "range" not in request.headers and negotiate_encoding(request.headers.get("accept-encoding", "")):
+        variant_path = await run_in_threadpool(compressed_variant_cache.get_variant, file_path, stat_result)
+        if variant_path is not None:
+            # 直接发送预先压缩好的副本，避免每次下载都重新压缩
+            variant_response = DownloadFileResponse(
+                path=str(variant_path),
+                filename=file_path.name,
+                media_type=media_type,
+                content_disposition_type=disposition,
+                headers={
+                    **headers,
+                    "Content-Encoding": "gzip",
+                    "Vary": "Accept-Encoding",
+                    "ETag": response.headers["etag"][:-1] + '-gzip"',
+                    "Last-Modified": response.headers["last-modified"],
+                },
+            )
+            compression_stats.add(precompressed_hits=1,
+                                  precompressed_bytes_saved=stat_result.st_size - variant_path.stat().st_size)
+            return variant_response
+    return response
+
+
+class ZipStreamBuffer:
+    """供 zipfile 写入的不可 seek 输出，写入的数据由生成器分批取走"""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.buffered = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.buffered += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        self.buffered = 0
+        return data
+
+
+def collect_folder_files(folder: Path, prefix: str) -> list[tuple[Path, str]]:
+    files = []
+    for directory, dir_names, file_names in os.walk(folder):
+        dir_names.sort()
+        relative = Path(directory).relative_to(folder).as_posix()
+        for file_name in sorted(file_names):
+            if file_name in HIDDEN_FILE_NAMES:
+                continue
+            arcname = f"{prefix}/{file_name}" if relative == "." else f"{prefix}/{relative}/{file_name}"
+            files.append((Path(directory) / file_name, arcname))
+            if len(files) > MAX_BATCH_FILES:
+                raise HTTPException(status_code=400, detail=f"一次最多打包 {MAX_BATCH_FILES} 个文件")
+    return files
+
+
+def iter_zip_stream(files: list[tuple[Path, str]]):
+    """边读文件边生成 ZIP 数据，不落临时文件，内存占用与文件数量和大小无关"""
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w", allowZip64=True) as archive:
+        for file_path, arcname in files:
+            info = zipfile.ZipInfo.from_file(file_path, arcname, strict_timestamps=False)
+            if file_path.suffix.lower() in STORED_EXTENSIONS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with file_path.open("rb") as source, archive.open(info, "w") as entry:
+                while True:
+                    chunk = source.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+                    if buffer.buffered >= DOWNLOAD_CHUNK_SIZE:
+                        yield buffer.drain()
+            if buffer.buffered:
+                yield buffer.drain()
+    yield buffer.drain()
+
+
+class LRUCache:
+    """线程安全的简单 LRU 缓存"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+
+preview_page_cache = LRUCache(PREVIEW_CACHE_ENTRIES)
+preview_meta_cache = LRUCache(PREVIEW_CACHE_ENTRIES)
+delta_signature_cache = LRUCache(DELTA_SIGNATURE_CACHE_ENTRIES)
+
+
+def detect_text_encoding(sample: bytes) -> str | None:
+    """只根据文件开头的一段样本判断编码，返回 None 表示是二进制文件"""
+    for bom, encoding in ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16-le"),
+                          (codecs.BOM_UTF16_BE, "utf-16-be")):
+        if sample.startswith(bom):
+            return encoding
+    if b"\x00" in sample:
+        return None
+    for encoding in ("utf-8", "gbk"):
+        # 样本末尾可能截断半个字符，使用增量解码器避免误判
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "latin-1"
+
+
+def get_preview_meta(file_path: Path, file_stats: os.stat_result) -> dict:
+    cache_key = (str(file_path), file_stats.st_mtime_ns, file_stats.st_size)
+    meta = preview_meta_cache.get(cache_key)
+    if meta is None:
+        with file_path.open("rb") as input_file:
+            sample = input_file.read(PREVIEW_SAMPLE_SIZE)
+        encoding = detect_text_encoding(sample)
+        meta = {"encoding": encoding, "newline": PREVIEW_NEWLINES.get(encoding, b"\n"), "line_offsets": [0],
+                "lock": threading.Lock()}
+        preview_meta_cache.put(cache_key, meta)
+    return meta
+
+
+def find_newline(data: bytes, newline: bytes, start: int = 0) -> int:
+    """查找换行符，只接受落在字符单元边界上的位置；data 必须从字符单元边界开始"""
+    position = data.find(newline, start)
+    while position >= 0 and position % len(newline):
+        position = data.find(newline, position + 1)
+    return position
+
+
+def rfind_newline(data: bytes, newline: bytes) -> int:
+    position = data.rfind(newline)
+    while position >= 0 and position % len(newline):
+        position = data.rfind(newline, 0, position + len(newline) - 1)
+    return position
+
+
+def read_lines(input_file, newline: bytes, count: int, limit: int) -> tuple[bytes, int]:
+    """从当前位置读取最多 count 行、不超过 limit 字节，返回数据和其中完整的行数"""
+    data = bytearray()
+    found = 0
+    position = 0
+    while found < count and len(data) < limit:
+        chunk = input_file.read(min(PREVIEW_READ_SIZE, limit - len(data)))
+        if not chunk:
+            break
+        data += chunk
+        while found < count:
+            newline_at = find_newline(data, newline, position)
+            if newline_at < 0:
+                # 末尾不完整的字符单元留到下次读入后再查找
+                position = len(data) - len(data) % len(newline)
+                break
+            found += 1
+            position = newline_at + len(newline)
+    if found == count:
+        del data[position:]
+    return bytes(data), found
+
+
+def find_line_offset(file_path: Path, meta: dict, line: int) -> int | None:
+    """借助稀疏行索引（每 PREVIEW_LINE_INDEX_STRIDE 行记录一次偏移）定位行首，只在需要时向后扫描"""
+    newline = meta["newline"]
+    with meta["lock"]:
+        offsets = meta["line_offsets"]
+        anchor_index = min(line // PREVIEW_LINE_INDEX_STRIDE, len(offsets) - 1)
+        offset = offsets[anchor_index]
+        current_line = anchor_index * PREVIEW_LINE_INDEX_STRIDE
+        with file_path.open("rb") as input_file:
+            input_file.seek(offset)
+            while current_line < line:
+                chunk = input_file.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    return None
+                position = 0
+                while current_line < line:
+                    newline_at = find_newline(chunk, newline, position)
+                    if newline_at < 0:
+                        break
+                    position = newline_at + len(newline)
+                    current_line += 1
+                    if current_line % PREVIEW_LINE_INDEX_STRIDE == 0 and current_line // PREVIEW_LINE_INDEX_STRIDE == len(offsets):
+                        offsets.append(offset + position)
+                if current_line < line:
+                    offset += len(chunk)
+                else:
+                    offset += position
+        return offset
+
+
+def read_preview_page(file_path: Path, offset: int, length: int, line: int | None, lines: int) -> dict:
+    file_stats = file_path.stat()
+    cache_key = (str(file_path), file_stats.st_mtime_ns, file_stats.st_size, offset, length, line, lines)
+    page = preview_page_cache.get(cache_key)
+    if page is not None:
+        return page
+
+    meta = get_preview_meta(file_path, file_stats)
+    encoding = meta["encoding"]
+    if encoding is None:
+        raise HTTPException(status_code=400, detail="二进制文件不支持预览")
+    newline = meta["newline"]
+    unit = len(newline)
+    # UTF-16 的偏移和长度都按 2 字节的字符单元取整，不会从半个字符开始解码
+    offset += -offset % unit
+    length = max(unit, length - length % unit)
+
+    if line is not None:
+        offset = find_line_offset(file_path, meta, line)
+        if offset is None:
+            raise HTTPException(status_code=416, detail="超出文件行数")
+
+    with file_path.open("rb") as input_file:
+        if offset > 0 and line is None:
+            # 任意字节偏移先对齐到下一行开头，避免从半个字符开始解码
+            # 最多向后找一页，整段没有换行的文件不会被整个读进内存，找不到换行时从原偏移开始
+            input_file.seek(offset - unit)
+            if input_file.read(unit) != newline:
+                skipped, found = read_lines(input_file, newline, 1, MAX_PREVIEW_PAGE_SIZE)
+                if found:
+                    offset += len(skipped)
+        input_file.seek(offset)
+        if line is not None:
+            # 行数和总字节数都有上限，超长的行只返回到字节上限为止，剩余部分按 next_offset 继续读取
+            data, found = read_lines(input_file, newline, lines, MAX_PREVIEW_PAGE_SIZE)
+        else:
+            data = input_file.read(length)
+            if offset + len(data) < file_stats.st_size:
+                # 在页尾截到最后一个换行处，下一页正好从行首开始
+                newline_at = rfind_newline(data, newline)
+                if newline_at >= 0:
+                    data = data[: newline_at + unit]
+
+    next_offset = offset + len(data)
+    eof = next_offset >= file_stats.st_size
+    content = data.decode(encoding, errors="replace")
+    if offset == 0:
+        # UTF-16 的解码器不会去掉文件开头的 BOM
+        content = content.removeprefix("\ufeff")
+    page = {
+        "success": True,
+        "content": content,
+        "size": file_stats.st_size,
+        "encoding": encoding,
+        "offset": offset,
+        "next_offset": None if eof else next_offset,
+        "eof": eof,
+    }
+    if line is not None:
+        page["line"] = line
+        # 停在一行中间时没有对应的行号，调用方改用 next_offset 继续
+        page["next_line"] = None if eof or not data.endswith(newline) else line + found
+    preview_page_cache.put(cache_key, page)
+    return page
+
+
+async def build_preview_response(base_dir: Path, file_id: str, offset: int, length: int, line: int | None,
+                                 lines: int):
+    try:
+        if offset < 0 or not 1 <= length <= MAX_PREVIEW_PAGE_SIZE:
+            raise HTTPException(status_code=400, detail=f"预览长度需在 1 ~ {MAX_PREVIEW_PAGE_SIZE} 字节之间")
+        if line is not None and (line < 0 or not 1 <= lines <= MAX_PREVIEW_LINES):
+            raise HTTPException(status_code=400, detail=f"预览行数需在 1 ~ {MAX_PREVIEW_LINES} 之间")
+
+        file_path = resolve_existing_file(base_dir, file_id)
+        access_tracker.touch(base_dir, file_path)
+        page = await run_in_threadpool(read_preview_page, file_path, offset, length, line, lines)
+        logger.info(f"文件预览: {file_id} (偏移 {page['offset']}, 共 {page['size']} 字节)")
+        return JSONResponse(content=page)
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"预览文件时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+
+
+def supports_thumbnail(filename: str) -> bool:
+    return PILLOW_AVAILABLE and os.path.splitext(filename)[1].lower() in THUMBNAIL_EXTENSIONS
+
+
+class BoundedDiskCache:
+    """磁盘上的派生文件缓存，按最近使用顺序淘汰，总大小不超过上限"""
+
+    def __init__(self, cache_dir: Path, max_bytes: int, suffix: str):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+
+    def load(self):
+        cached = []
+        for path in self.cache_dir.iterdir():
+            file_stats = path.stat()
+            if path.suffix != self.suffix:
+                # 残留的临时文件；较新的可能是其他工作进程正在写入的，先保留
+                if time.time() - file_stats.st_mtime > STALE_TEMP_FILE_AGE:
+                    path.unlink(missing_ok=True)
+                continue
+            cached.append((file_stats.st_mtime, path.name, file_stats.st_size))
+        with self.lock:
+            for _, name, size in sorted(cached):
+                self.entries[name] = size
+                self.total_bytes += size
+
+    def cache_name(self, file_path: Path, file_stats: os.stat_result) -> str:
+        key = f"{file_path}:{file_stats.st_mtime_ns}:{file_stats.st_size}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest() + self.suffix
+
+    def lookup(self, name: str) -> Path | None:
+        with self.lock:
+            known = name in self.entries
+            if known:
+                self.entries.move_to_end(name)
+        if CONFIG["workers"] == 1:
+            return self.cache_dir / name if known else None
+
+        # 多个工作进程共用缓存目录：采用其他进程生成的文件，丢弃已被其他进程淘汰的记录
+        path = self.cache_dir / name
+        try:
+            size = path.stat().st_size
+        except OSError:
+            if known:
+                with self.lock:
+                    self.total_bytes -= self.entries.pop(name, 0)
+            return None
+        if not known:
+            self.add(name, size)
+        return path
+
+    def add(self, name: str, size: int):
+        evicted = []
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_name, old_size = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old_name)
+        for old_name in evicted:
+            (self.cache_dir / old_name).unlink(missing_ok=True)
+
+
+class ThumbnailCache(BoundedDiskCache):
+    """缩略图缓存，缺失的缩略图交给进程池生成"""
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        super().__init__(cache_dir, max_bytes, ".jpg")
+        self.pending: dict[str, object] = {}
+        self.executor = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        # 图片解码是 CPU 密集型任务，放进独立进程，不占用事件循环和 GIL
+        with self.lock:
+            if self.executor is None:
+                # fork 会把其他线程持有的锁原样复制到子进程里，可能导致子进程死锁，改用 spawn 启动。
+                # spawn 的子进程会重新执行启动脚本，本模块导入时不做初始化，见 initialize_server
+                self.executor = ProcessPoolExecutor(max_workers=per_worker_share(CONFIG["thumbnail_workers"]),
+                                                    mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+
+    def submit(self, file_path: Path):
+        """提交生成任务，同一张图片同时只会生成一次；返回 (缓存文件名, future)"""
+        file_stats = file_path.stat()
+        name = self.cache_name(file_path, file_stats)
+        with self.lock:
+            future = self.pending.get(name)
+            if future is not None or name in self.entries:
+                return name, future
+            future = self.get_executor().submit(generate_thumbnail, str(file_path), str(self.cache_dir / name),
+                                                THUMBNAIL_SIZE)
+            self.pending[name] = future
+
+        def on_done(done_future):
+            with self.lock:
+                self.pending.pop(name, None)
+            if done_future.exception() is None:
+                self.add(name, done_future.result())
+
+        future.add_done_callback(on_done)
+        return name, future
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_DIR, per_worker_share(CONFIG["thumbnail_cache_bytes"]))
+
+
+def schedule_thumbnail(file_path: Path):
+    if not supports_thumbnail(file_path.name):
+        return
+    try:
+        thumbnail_cache.submit(file_path)
+    except Exception as error:
+        logger.error(f"提交缩略图任务失败 {file_path.name}: {error}")
+
+
+async def build_thumbnail_response(base_dir: Path, file_id: str):
+    try:
+        file_path = resolve_existing_file(base_dir, file_id)
+        if not supports_thumbnail(file_path.name):
+            raise HTTPException(status_code=404, detail="该文件没有缩略图")
+
+        name, future = await run_in_threadpool(thumbnail_cache.submit, file_path)
+        if future is not None:
+            await asyncio.wrap_future(future)
+        thumbnail_path = thumbnail_cache.lookup(name)
+        if thumbnail_path is None:
+            raise HTTPException(status_code=404, detail="缩略图生成失败")
+        return FileResponse(path=str(thumbnail_path), media_type="image/jpeg",
+                            headers={"Cache-Control": "max-age=86400"})
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"生成缩略图时出错: {error}")
+        return JSONResponse(content={"success": False, "message": "缩略图生成失败"}, status_code=500)
+
+
+class CompressionStats:
+    """累计压缩节省的字节数和消耗的 CPU 时间，用于评估压缩是否划算"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {
+            "responses_compressed": 0,
+            "response_bytes_before": 0,
+            "response_bytes_after": 0,
+            "response_cpu_seconds": 0.0,
+            "requests_decompressed": 0,
+            "request_bytes_before": 0,
+            "request_bytes_after": 0,
+            "request_cpu_seconds": 0.0,
+            "precompressed_hits": 0,
+            "precompressed_bytes_saved": 0,
+        }
+
+    def add(self, **amounts):
+        with self.lock:
+            for key, amount in amounts.items():
+                self.values[key] += amount
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            values = dict(self.values)
+        values["response_bytes_saved"] = values["response_bytes_before"] - values["response_bytes_after"]
+        values["request_bytes_saved"] = values["request_bytes_after"] - values["request_bytes_before"]
+        return values
+
+
+compression_stats = CompressionStats()
+
+
+def looks_compressed(data: bytes) -> bool:
+    if data.startswith(COMPRESSED_MAGIC_PREFIXES):
+        return True
+    # MP4/MOV 的 ftyp 盒子和 WebP 的 RIFF 头
+    return data[4:8] == b"ftyp" or (data.startswith(b"RIFF") and data[8:12] == b"WEBP")
+
+
+def is_compressible_media_type(content_type: str) -> bool:
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    if media_type == "text/event-stream":
+        return False
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_MEDIA_TYPES
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    if zstandard is not None and accepted.get("zstd", 0) > 0:
+        return "zstd"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def new_compressor(encoding: str):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+class BoundedZstdDecompressor:
+    """提供与 zlib 相同的 decompress(data, max_length) / unconsumed_tail 接口"""
+
+    def __init__(self):
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self.unconsumed_tail = b""
+
+    def decompress(self, data: bytes, max_length: int) -> bytes:
+        output = []
+        produced = 0
+        position = 0
+        while position < len(data) and produced < max_length:
+            chunk = self.decompressor.decompress(data[position:position + ZSTD_DECOMPRESS_INPUT_STEP])
+            position += ZSTD_DECOMPRESS_INPUT_STEP
+            output.append(chunk)
+            produced += len(chunk)
+        self.unconsumed_tail = data[position:]
+        return b"".join(output)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def new_decompressor(encoding: str):
+    if encoding == "zstd" and zstandard is not None:
+        return BoundedZstdDecompressor()
+    if encoding in {"gzip", "deflate"}:
+        return zlib.decompressobj(47)
+    return None
+
+
+class CompressingSender:
+    """包装 ASGI send：符合条件的响应体按协商的编码流式压缩"""
+
+    def __init__(self, send, encoding: str):
+        self.send = send
+        self.encoding = encoding
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+
+    def should_compress(self, message) -> bool:
+        headers = Headers(raw=message["headers"])
+        return (message["status"] == 200
+                and "content-encoding" not in headers
+                and is_compressible_media_type(headers.get("content-type", "")))
+
+    async def compress(self, body: bytes, final: bool) -> bytes:
+        started = time.perf_counter()
+        if len(body) > 256 * 1024:
+            # 大块数据的压缩放到线程里，避免长时间占用事件循环
+            compressed = await run_in_threadpool(self.compressor.compress, body)
+        else:
+            compressed = self.compressor.compress(body)
+        if final:
+            compressed += self.compressor.flush()
+        compression_stats.add(response_bytes_before=len(body), response_bytes_after=len(compressed),
+                              response_cpu_seconds=time.perf_counter() - started)
+        return compressed
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            if self.should_compress(message):
+                self.start_message = message
+            else:
+                self.passthrough = True
+                await self.send(message)
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            start_message, self.start_message = self.start_message, None
+            if (not more_body and len(body) < MIN_COMPRESS_SIZE) or looks_compressed(body[:16]):
+                self.passthrough = True
+                await self.send(start_message)
+                await self.send(message)
+                return
+            headers = MutableHeaders(raw=list(start_message["headers"]))
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if "content-length" in headers:
+                del headers["content-length"]
+            etag = headers.get("etag")
+            if etag and etag.endswith('"'):
+                # 压缩后是另一种表示，强 ETag 需要区分
+                headers["ETag"] = f'{etag[:-1]}-{self.encoding}"'
+            self.compressor = new_compressor(self.encoding)
+            compression_stats.add(responses_compressed=1)
+            await self.send({**start_message, "headers": headers.raw})
+
+        compressed = await self.compress(body, final=not more_body)
+        await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+
+class DecompressingReceive:
+    """
+    包装 ASGI receive：把压缩的请求体解压成不超过 REQUEST_DECOMPRESS_CHUNK_SIZE 的分块逐次交给应用，
+    很小的压缩数据也不会在事件循环中一次展开成几百 MB；解压后的总大小超过上限时返回 413。
+    """
+
+    def __init__(self, receive, decompressor):
+        self.receive = receive
+        self.decompressor = decompressor
+        self.pending = b""
+        self.finished = False
+        self.total = 0
+
+    async def __call__(self):
+        if not self.pending:
+            if self.finished:
+                return await self.receive()
+            message = await self.receive()
+            if message["type"] != "http.request":
+                return message
+            self.pending = message.get("body", b"")
+            self.finished = not message.get("more_body", False)
+
+        started = time.perf_counter()
+        consumed = len(self.pending)
+        data = self.decompressor.decompress(self.pending, REQUEST_DECOMPRESS_CHUNK_SIZE)
+        self.pending = self.decompressor.unconsumed_tail
+        if self.finished and not self.pending:
+            data += self.decompressor.flush()
+        compression_stats.add(request_bytes_before=consumed - len(self.pending), request_bytes_after=len(data),
+                              request_cpu_seconds=time.perf_counter() - started)
+        self.total += len(data)
+        if self.total > MAX_DECOMPRESSED_BODY_SIZE:
+            raise HTTPException(status_code=413, detail="解压后的请求体过大")
+        return {"type": "http.request", "body": data, "more_body": bool(self.pending) or not self.finished}
+
+
+def accepts_compressed_body(path: str) -> bool:
+    return path in COMPRESSED_UPLOAD_PATHS or COMPRESSED_UPLOAD_SESSION_PATTERN.match(path) is not None
+
+
+class CompressionMiddleware:
+    """
+    按 Accept-Encoding 协商 gzip/zstd 压缩 JSON、文本类响应，
+    并接受上传接口带 Content-Encoding 的压缩请求体。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        request_encoding = headers.get("content-encoding", "").strip().lower()
+        if request_encoding and request_encoding != "identity" and accepts_compressed_body(scope["path"]):
+            decompressor = new_decompressor(request_encoding)
+            if decompressor is None:
+                response = JSONResponse(content={"success": False, "message": "不支持的请求体压缩格式"},
+                                        status_code=415)
+                await response(scope, receive, send)
+                return
+            scope = dict(scope)
+            scope["headers"] = [(key, value) for key, value in scope["headers"]
+                                if key not in (b"content-encoding", b"content-length")]
+            receive = DecompressingReceive(receive, decompressor)
+            compression_stats.add(requests_decompressed=1)
+
+        encoding = negotiate_encoding(headers.get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        if_none_match = headers.get("if-none-match")
+        if if_none_match:
+            # 还原压缩时附加在 ETag 上的编码后缀，使条件请求依然能命中 304
+            scope = dict(scope)
+            scope["headers"] = [(key, value) for key, value in scope["headers"] if key != b"if-none-match"]
+            scope["headers"].append((b"if-none-match", if_none_match.replace(f'-{encoding}"', '"').encode("latin-1")))
+        await self.app(scope, receive, CompressingSender(send, encoding))
+
+
+class CompressedVariantCache(BoundedDiskCache):
+    """热门共享文件的 gzip 预压缩副本，多次被下载后才在后台生成"""
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        super().__init__(cache_dir, max_bytes, ".gz")
+        self.hits: dict[str, int] = {}
+        self.skipped: set[str] = set()
+        self.pending: set[str] = set()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def is_candidate(self, file_path: Path, file_stats: os.stat_result) -> bool:
+        if file_stats.st_size < MIN_COMPRESS_SIZE or file_path.suffix.lower() in STORED_EXTENSIONS:
+            return False
+        with file_path.open("rb") as input_file:
+            return not looks_compressed(input_file.read(16))
+
+    def build(self, file_path: Path, name: str):
+        temp_path = self.cache_dir / f"{name}.{uuid.uuid4().hex}.tmp"
+        try:
+            started = time.perf_counter()
+            compressor = new_compressor("gzip")
+            with file_path.open("rb") as input_file, temp_path.open("wb") as output_file:
+                while True:
+                    chunk = input_file.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    output_file.write(compressor.compress(chunk))
+                output_file.write(compressor.flush())
+            compression_stats.add(response_cpu_seconds=time.perf_counter() - started)
+            compressed_size = temp_path.stat().st_size
+            # 压缩率不到 10% 的文件不值得保存副本
+            if compressed_size > file_path.stat().st_size * 0.9:
+                with self.lock:
+                    self.skipped.add(name)
+                return
+            os.replace(temp_path, self.cache_dir / name)
+            self.add(name, compressed_size)
+        except OSError as error:
+            logger.error(f"生成预压缩文件失败 {file_path.name}: {error}")
+        finally:
+            temp_path.unlink(missing_ok=True)
+            with self.lock:
+                self.pending.discard(name)
+
+    def get_variant(self, file_path: Path, file_stats: os.stat_result) -> Path | None:
+        name = self.cache_name(file_path, file_stats)
+        cached = self.lookup(name)
+        if cached is not None:
+            return cached
+        with self.lock:
+            if name in self.skipped or name in self.pending:
+                return None
+            self.hits[name] = self.hits.get(name, 0) + 1
+            if self.hits[name] < PRECOMPRESS_MIN_HITS:
+                return None
+            self.hits.pop(name)
+        if not self.is_candidate(file_path, file_stats):
+            with self.lock:
+                self.skipped.add(name)
+            return None
+        with self.lock:
+            self.pending.add(name)
+        self.executor.submit(self.build, file_path, name)
+        return None
+
+
+compressed_variant_cache = CompressedVariantCache(
+    COMPRESSED_CACHE_DIR, per_worker_share(CONFIG["compressed_cache_bytes"])
+)
+
+
+def require_encryption_key() -> bytes:
+    key = CONFIG["pre_shared_key"]
+    if key == PRE_SHARED_KEY:
+        # 默认密钥写在源码里，用它加密等于没有加密
+        raise HTTPException(status_code=503, detail="加密传输未启用，请先在 config.json 中设置 pre_shared_key")
+    return key
+
+
+async def receive_encrypted_upload(request: Request, output_file, pre_shared_key: bytes) -> tuple[int, str]:
+    """边接收边解密写入，只缓存不完整的帧；任何一帧校验失败都会中止"""
+    decryptor = StreamDecryptor(pre_shared_key)
+    digest = hashlib.sha256()
+    written = 0
+
+    def decrypt_and_write(data: bytes) -> int:
+        count = 0
+        for frame in decryptor.feed(data):
+            write_timed(output_file, frame, "encrypted")
+            digest.update(frame)
+            count += len(frame)
+        return count
+
+    buffer = bytearray()
+    chunk_size = CONFIG["upload_chunk_size"]
+    async for piece in request.stream():
+        buffer.extend(piece)
+        if len(buffer) >= chunk_size:
+            written += await run_in_threadpool(decrypt_and_write, bytes(buffer))
+            buffer.clear()
+    written += await run_in_threadpool(decrypt_and_write, bytes(buffer))
+    decryptor.finish()
+    return written, digest.hexdigest()
+
+
+def delta_base_token(file_stats: os.stat_result) -> str:
+    """旧文件的版本标识，签名和应用增量时必须一致，防止基于过期的签名重建"""
+    return f"{file_stats.st_size}-{file_stats.st_mtime_ns}"
+
+
+def get_delta_signature(file_path: Path, block_size: int | None) -> dict:
+    file_stats = file_path.stat()
+    block_size = block_size or choose_block_size(file_stats.st_size)
+    key = (str(file_path), file_stats.st_mtime_ns, file_stats.st_size, block_size)
+    signature = delta_signature_cache.get(key)
+    if signature is None:
+        signature = compute_signature(file_path, block_size)
+        signature["base"] = delta_base_token(file_stats)
+        delta_signature_cache.put(key, signature)
+    return signature
 
 
-def load_config():
-    default_config = {"port": DEFAULT_PORT}
-    if not CONFIG_PATH.exists():
-        return default_config
+async def receive_delta(request: Request, file_path: Path, base: str, block_size: int,
+                        staged: StagedFile) -> DeltaApplier:
+    """按增量指令把新版本写入暂存文件，复制指令从旧文件读取"""
+    base_file = await run_in_threadpool(file_path.open, "rb")
+    try:
+        file_stats = os.fstat(base_file.fileno())
+        if delta_base_token(file_stats) != base:
+            raise HTTPException(status_code=409, detail="服务器上的文件已变化，请重新获取签名")
+        applier = DeltaApplier(base_file, file_stats.st_size, block_size,
+                               lambda data: write_timed(staged.file, data, "delta"))
+        buffer = bytearray()
+        chunk_size = CONFIG["upload_chunk_size"]
+        async for piece in request.stream():
+            buffer.extend(piece)
+            if len(buffer) >= chunk_size:
+                await run_in_threadpool(applier.feed, bytes(buffer))
+                buffer.clear()
+        await run_in_threadpool(applier.feed, bytes(buffer))
+        applier.finish()
+        return applier
+    finally:
+        await run_in_threadpool(base_file.close)
+
+
+def commit_delta_version(target_dir: Path, file_path: Path, base: str, staged: StagedFile, mode: str,
+                         digest: str) -> Path:
+    if mode == "replace":
+        if delta_base_token(file_path.stat()) != base:
+            raise HTTPException(status_code=409, detail="服务器上的文件已变化，请重新获取签名")
+        # 换成新的 inode 而不是原地改写：旧文件可能与其他文件共享硬链接，正在进行的下载也不受影响
+        saved_path = file_path
+        staged.replace(saved_path)
+    else:
+        saved_path = staged.commit(file_path.parent, file_path.name)
+    store_deduplicated(saved_path, digest)
+    register_new_file(target_dir, saved_path)
+    return saved_path
+
 
+def declared_content_length(request: Request) -> int:
     try:
-        with CONFIG_PATH.open("r", encoding="utf-8") as config_file:
-            config = json.load(config_file)
-    except Exception:
-        return default_config
+        return max(int(request.headers.get("content-length", "0")), 0)
+    except ValueError:
+        return 0
 
-    port = config.get("port")
-    if isinstance(port, int) and 1024 <= port <= 65535:
-        return {"port": port}
-    return default_config
 
+def is_ingest_request(request: Request) -> bool:
+    path = request.url.path
+    if request.method == "POST":
+        if path.startswith("/delta_apply/"):
+            return True
+        return path in {"/upload", "/upload_shared", "/upload_encrypted", "/upload_folder"}
+    return request.method == "PUT" and path.startswith("/upload_session/")
 
-def sanitize_filename(filename: str, default_name: str) -> str:
-    safe_name = Path(filename or "").name.strip()
-    safe_name = INVALID_FILENAME_PATTERN.sub("", safe_name).rstrip(" ")
-    if safe_name in {"", ".", ".."}:
-        safe_name = default_name
 
-    if len(safe_name) > MAX_FILENAME_LENGTH:
-        name, ext = os.path.splitext(safe_name)
-        safe_name = name[: MAX_FILENAME_LENGTH - len(ext)] + ext
+app.add_middleware(CompressionMiddleware)
 
-    return safe_name or default_name
 
+@app.middleware("http")
+async def ingest_admission_control(request: Request, call_next):
+    if not is_ingest_request(request):
+        return await call_next(request)
 
-def get_unique_file_path(base_dir: Path, filename: str) -> Path:
-    candidate = base_dir / filename
-    if not candidate.exists():
-        return candidate
+    declared_size = declared_content_length(request)
+    if not ingest_admission.try_acquire(declared_size):
+        return JSONResponse(content={
+            "success": False,
+            "message": "服务器繁忙，请稍后重试",
+        }, status_code=503, headers={"Retry-After": str(INGEST_RETRY_AFTER)})
+    try:
+        return await call_next(request)
+    finally:
+        ingest_admission.release(declared_size)
 
-    stem = candidate.stem
-    suffix = candidate.suffix
-    counter = 1
-    while True:
-        next_candidate = base_dir / f"{stem}_{counter}{suffix}"
-        if not next_candidate.exists():
-            return next_candidate
-        counter += 1
 
+def classify_transfer(scope) -> str | None:
+    path, method = scope["path"], scope["method"]
+    if method == "PUT" and path.startswith("/upload_session/"):
+        return "uploads"
+    if method == "POST" and (path in UPLOAD_PATHS or path.startswith("/delta_apply/")):
+        return "uploads"
+    if path.startswith(DOWNLOAD_PATH_PREFIXES):
+        return "downloads"
+    return None
 
-def resolve_existing_file(base_dir: Path, file_id: str) -> Path:
-    if not file_id:
-        raise HTTPException(status_code=400, detail="文件名不能为空")
 
-    if file_id != Path(file_id).name:
-        raise HTTPException(status_code=400, detail="非法文件路径")
+def resolve_route_template(scope) -> str:
+    # 用路由模板作为标签，避免每个文件名都产生一组新的时间序列
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match != Match.NONE:
+            return route.path
+    return "unmatched"
 
-    safe_name = sanitize_filename(file_id, "")
-    if safe_name != file_id:
-        raise HTTPException(status_code=400, detail="非法文件名")
 
-    file_path = (base_dir / safe_name).resolve()
-    if file_path.parent != base_dir.resolve() or not file_path.is_file():
-        raise HTTPException(status_code=404, detail="文件不存在")
-    return file_path
+class MetricsMiddleware:
+    """记录每个请求的耗时、状态码、收发字节数，以及正在进行的上传和下载数"""
 
+    def __init__(self, app):
+        self.app = app
 
-def build_file_info(base_dir: Path):
-    files = []
-    for file_path in base_dir.iterdir():
-        if file_path.name in HIDDEN_FILE_NAMES:
-            continue
-        if file_path.is_file():
-            file_stats = file_path.stat()
-            files.append({
-                "id": file_path.name,
-                "name": file_path.name,
-                "size": file_stats.st_size,
-                "mtime": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(file_stats.st_mtime)),
-            })
-    files.sort(key=lambda item: item["mtime"], reverse=True)
-    return files
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
+        started = time.perf_counter()
+        transfer = classify_transfer(scope)
+        if transfer is not None:
+            metrics.inc(f"transfer_{transfer}_in_flight")
+        counts = {"in": 0, "out": 0, "status": 500}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                counts["in"] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "http.response.start":
+                counts["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                counts["out"] += len(message.get("body", b""))
+            await send(message)
 
-def save_upload_files(files: list[UploadFile] | None, target_dir: Path, default_name: str, log_prefix: str):
-    uploaded_count = 0
-    for upload in files or []:
         try:
-            safe_filename = sanitize_filename(upload.filename, default_name)
-            file_path = get_unique_file_path(target_dir, safe_filename)
-            with file_path.open("wb") as output_file:
-                output_file.write(upload.file.read())
-            uploaded_count += 1
-            print(f"[*] {log_prefix}: {upload.filename} -> 保存为: {file_path.name}")
-        except Exception as file_error:
-            print(f"[!] 保存文件 {getattr(upload, 'filename', 'unknown')} 失败: {file_error}")
-    return uploaded_count
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            if transfer is not None:
+                metrics.inc(f"transfer_{transfer}_in_flight", amount=-1)
+            route = resolve_route_template(scope)
+            labels = (("route", route), ("method", scope["method"]))
+            metrics.observe("transfer_http_request_duration_seconds", labels, time.perf_counter() - started)
+            metrics.inc("transfer_http_requests_total", labels + (("status", str(counts["status"])),))
+            metrics.inc("transfer_http_request_bytes_total", (("route", route),), counts["in"])
+            metrics.inc("transfer_http_response_bytes_total", (("route", route),), counts["out"])
+
+
+# 最后添加的中间件在最外层，统计的耗时包括准入控制和压缩
+app.add_middleware(MetricsMiddleware)
 
 
 @app.get('/')
 def index(request: Request):
     """主页"""
-    return templates.TemplateResponse("index.html", {"request": request})
+    return templates.TemplateResponse("index.html", {
+        "request": request,
+        "upload_parallel_files": CONFIG["client_upload_parallelism"],
+        "small_file_threshold": CONFIG["session_chunk_size"],
+    })
 
 
 @app.post('/upload')
 async def upload(file: list[UploadFile] = File(None)):
     """处理文件上传（手机到电脑）"""
     try:
-        uploaded_count = save_upload_files(file, RECEIVED_DIR, "uploaded_file", "收到文件")
+        uploaded_count = await save_upload_files(file, RECEIVED_DIR, "uploaded_file", "收到文件")
         return JSONResponse(content={
             "success": True,
             "message": f"成功上传 {uploaded_count} 个文件",
             "uploaded_count": uploaded_count,
         })
     except Exception as error:
-        print(f"[!] 处理文件上传时出错: {error}")
+        logger.error(f"处理文件上传时出错: {error}")
         return JSONResponse(content={
             "success": False,
             "message": str(error),
@@ -149,214 +3831,699 @@ async def upload(file: list[UploadFile] = File(None)):
 async def upload_shared(file: list[UploadFile] = File(None)):
     """上传文件到共享目录（电脑到手机）"""
     try:
-        uploaded_count = save_upload_files(file, SHARED_DIR, "shared_file", "共享文件上传")
+        uploaded_count = await save_upload_files(file, SHARED_DIR, "shared_file", "共享文件上传")
         return JSONResponse(content={
             "success": True,
             "message": f"成功上传 {uploaded_count} 个共享文件",
             "uploaded_count": uploaded_count,
         })
     except Exception as error:
-        print(f"[!] 处理共享文件上传时出错: {error}")
+        logger.error(f"处理共享文件上传时出错: {error}")
         return JSONResponse(content={
             "success": False,
             "message": str(error),
         }, status_code=500)
 
 
-@app.get('/files')
-async def get_files():
-    """获取共享文件列表"""
+@app.post('/upload_folder')
+async def upload_folder(request: Request, target: str = "received"):
+    """接收浏览器打包的 tar 数据流，边接收边解包，保留原有的目录结构"""
+    extractor = None
     try:
+        if target not in UPLOAD_TARGETS:
+            raise HTTPException(status_code=400, detail="未知的上传目录")
+        target_dir, _, log_prefix = UPLOAD_TARGETS[target]
+        extractor = TarStreamExtractor(target_dir)
+        await receive_folder_upload(request, extractor)
+        folders = [root.name for root in extractor.roots.values()]
+        saved_to = ", ".join(folders) or target_dir.name
+        logger.info(f"{log_prefix}（文件夹）: {len(extractor.saved_files)} 个文件 -> {saved_to}",
+                    extra=log_fields(event="upload_folder", directory=target, count=len(extractor.saved_files),
+                                     size=extractor.written))
         return JSONResponse(content={
             "success": True,
-            "files": build_file_info(SHARED_DIR),
+            "message": f"成功上传 {len(extractor.saved_files)} 个文件",
+            "uploaded_count": len(extractor.saved_files),
+            "folders": folders,
+            "size": extractor.written,
         })
+    except ArchiveFormatError as error:
+        return JSONResponse(content={
+            "success": False,
+            "message": str(error),
+            "uploaded_count": len(extractor.saved_files),
+        }, status_code=400)
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
     except Exception as error:
-        print(f"[!] 获取文件列表时出错: {error}")
+        logger.error(f"处理文件夹上传时出错: {error}")
         return JSONResponse(content={
             "success": False,
             "message": str(error),
+            "uploaded_count": len(extractor.saved_files) if extractor is not None else 0,
         }, status_code=500)
 
 
-@app.get('/received_files')
-async def get_received_files():
-    """获取已上传文件列表（received_files目录）"""
+@app.post('/upload_check')
+async def upload_check(sha256: str = Form(...), size: int = Form(...), filename: str = Form(...),
+                       target: str = Form("received")):
+    """上传前按内容哈希检查，服务器已有相同内容时直接创建新文件名"""
     try:
+        if target not in UPLOAD_TARGETS:
+            raise HTTPException(status_code=400, detail="未知的上传目录")
+        digest = sha256.lower()
+        if not SHA256_PATTERN.match(digest):
+            raise HTTPException(status_code=400, detail="无效的 sha256")
+
+        target_dir, default_name, log_prefix = UPLOAD_TARGETS[target]
+        safe_filename = sanitize_filename(filename, default_name)
+        file_path = await run_in_threadpool(link_existing_content, digest, size, target_dir, safe_filename)
+        if file_path is None:
+            return JSONResponse(content={"success": True, "exists": False})
+
+        logger.info(f"{log_prefix}（秒传）: {filename} -> 保存为: {file_path.name}",
+                    extra=log_fields(event="upload_linked", directory=target, file=file_path.name, size=size))
         return JSONResponse(content={
             "success": True,
-            "files": build_file_info(RECEIVED_DIR),
+            "exists": True,
+            "message": "服务器已有相同文件，无需重复上传",
+            "filename": file_path.name,
+            "size": size,
         })
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
     except Exception as error:
-        print(f"[!] 获取已上传文件列表时出错: {error}")
-        return JSONResponse(content={
-            "success": False,
-            "message": str(error),
-        }, status_code=500)
+        logger.error(f"检查重复文件时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
 
 
-@app.get('/download/{file_id}')
-async def download_file(file_id: str):
-    """下载共享文件"""
+@app.post('/upload_session')
+async def init_upload_session(filename: str = Form(...), size: int = Form(...), target: str = Form("received")):
+    """创建断点续传上传会话"""
     try:
-        file_path = resolve_existing_file(SHARED_DIR, file_id)
-        print(f"[*] 文件下载: {file_id}")
-        return FileResponse(path=str(file_path), filename=file_path.name, media_type='application/octet-stream')
+        if target not in UPLOAD_TARGETS:
+            raise HTTPException(status_code=400, detail="未知的上传目录")
+        if size < 0:
+            raise HTTPException(status_code=400, detail="文件大小不合法")
+        session = await run_in_threadpool(create_upload_session, target, filename, size)
+        logger.info(f"创建上传会话: {filename} ({size} 字节) -> {session['id']}",
+                    extra=log_fields(event="session_created", session=session["id"], size=size))
+        return JSONResponse(content=describe_upload_session(session))
     except HTTPException as error:
         return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
     except Exception as error:
-        print(f"[!] 下载文件时出错: {error}")
+        logger.error(f"创建上传会话时出错: {error}")
         return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
 
 
-@app.get('/download_received/{file_id}')
-async def download_received_file(file_id: str):
-    """下载已上传文件（received_files目录）"""
+@app.get('/upload_session/{session_id}')
+async def get_upload_session(session_id: str):
+    """查询上传会话已接收的数据范围"""
     try:
-        file_path = resolve_existing_file(RECEIVED_DIR, file_id)
-        print(f"[*] 文件下载: {file_id}")
-        return FileResponse(path=str(file_path), filename=file_path.name, media_type='application/octet-stream')
+        session = await run_in_threadpool(load_upload_session, session_id)
+        return JSONResponse(content=describe_upload_session(session))
     except HTTPException as error:
         return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
     except Exception as error:
-        print(f"[!] 下载文件时出错: {error}")
+        logger.error(f"查询上传会话时出错: {error}")
         return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
 
 
-@app.post('/upload_text')
-async def upload_text(text: str = Form(...), filename: str = Form(...)):
-    """上传文本内容并保存为txt文件"""
+@app.put('/upload_session/{session_id}')
+async def put_upload_chunk(session_id: str, request: Request, offset: int = 0):
+    """上传会话中的一个分块，可并发发送多个分块"""
     try:
-        safe_filename = sanitize_filename(filename, 'text_file.txt')
-        if not safe_filename.endswith('.txt'):
-            safe_filename += '.txt'
+        session = await run_in_threadpool(load_upload_session, session_id)
+        if not 0 <= offset <= session["size"]:
+            raise HTTPException(status_code=400, detail="分块偏移不合法")
+        max_length = session["size"] - offset
+        content_length = request.headers.get("content-length")
+        if content_length is not None:
+            try:
+                declared_length = int(content_length)
+            except ValueError:
+                declared_length = -1
+            if declared_length < 0:
+                raise HTTPException(status_code=400, detail="Content-Length 不合法")
+            if declared_length > max_length:
+                raise HTTPException(status_code=400, detail="分块大小超出文件范围")
 
-        file_path = get_unique_file_path(SHARED_DIR, safe_filename)
-        with file_path.open("w", encoding="utf-8") as output_file:
-            output_file.write(text)
+        part_path = get_upload_session_part_path(session_id)
+        written = await write_request_body_at(request, part_path, offset, max_length)
+        if written:
+            session = await run_in_threadpool(record_upload_range, session_id, offset, offset + written)
+        return JSONResponse(content=describe_upload_session(session))
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"写入上传分块时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
 
-        file_size = file_path.stat().st_size
-        print(f"[*] 文本已保存: {file_path.name} ({file_size} 字节)")
 
+@app.post('/upload_session/{session_id}/complete')
+async def complete_upload_session(session_id: str):
+    """所有分块到齐后组装为最终文件"""
+    try:
+        await run_in_threadpool(load_upload_session, session_id)
+        session, claimed = await run_in_threadpool(claim_upload_session, session_id)
+        if not claimed:
+            return JSONResponse(content={
+                **describe_upload_session(session),
+                "success": False,
+                "message": "文件尚未上传完整",
+            }, status_code=409)
+        try:
+            file_path = await run_in_threadpool(finalize_upload_session, session)
+        except Exception:
+            # 组装失败时放回会话，客户端可以重试
+            if get_upload_session_part_path(session_id).exists():
+                await run_in_threadpool(save_upload_session, session)
+            raise
+
+        _, _, log_prefix = UPLOAD_TARGETS[session["target"]]
+        logger.info(f"{log_prefix}: {session['filename']} -> 保存为: {file_path.name}",
+                    extra=log_fields(event="session_completed", session=session_id, file=file_path.name,
+                                     size=session["size"]))
         return JSONResponse(content={
             "success": True,
-            "message": "文本上传成功",
+            "message": "上传完成",
             "filename": file_path.name,
-            "size": file_size,
+            "size": session["size"],
         })
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"完成上传会话时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+
+
+@app.delete('/upload_session/{session_id}')
+async def abort_upload_session(session_id: str):
+    """取消上传会话并删除已接收的数据"""
+    try:
+        await run_in_threadpool(load_upload_session, session_id)
+        await run_in_threadpool(remove_upload_session, session_id)
+        return JSONResponse(content={"success": True, "message": "上传已取消"})
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"取消上传会话时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+
+
+@app.get('/files')
+async def get_files(request: Request, limit: int | None = None, cursor: str | None = None,
+                    sort: str = "mtime", order: str | None = None, prefix: str = ""):
+    """获取共享文件列表，支持分页、排序、前缀过滤和 ETag"""
+    try:
+        return await build_listing_response(request, SHARED_DIR, limit, cursor, sort, order, prefix)
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
     except Exception as error:
-        print(f"[!] 处理文本上传时出错: {error}")
+        logger.error(f"获取文件列表时出错: {error}")
         return JSONResponse(content={
             "success": False,
             "message": str(error),
         }, status_code=500)
 
 
-@app.get('/preview/{file_id}')
-async def preview_file(file_id: str):
-    """预览文件内容（仅支持小于100KB的文件）"""
+@app.get('/received_files')
+async def get_received_files(request: Request, limit: int | None = None, cursor: str | None = None,
+                             sort: str = "mtime", order: str | None = None, prefix: str = ""):
+    """获取已上传文件列表（received_files目录），支持分页、排序、前缀过滤和 ETag"""
     try:
-        file_path = resolve_existing_file(SHARED_DIR, file_id)
-        file_size = file_path.stat().st_size
-        if file_size > 102400:
-            return JSONResponse(content={
-                "success": False,
-                "message": "文件过大，无法预览（超过100KB）",
-            }, status_code=400)
+        return await build_listing_response(request, RECEIVED_DIR, limit, cursor, sort, order, prefix)
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"获取已上传文件列表时出错: {error}")
+        return JSONResponse(content={
+            "success": False,
+            "message": str(error),
+        }, status_code=500)
+
+
+@app.get('/search')
+async def search_files(q: str, target: str = "all", limit: int = DEFAULT_SEARCH_RESULTS):
+    """按文件名和文本内容搜索，直接查询持久化索引，不扫描目录"""
+    try:
+        query = q.strip()
+        if not query:
+            raise HTTPException(status_code=400, detail="请输入搜索关键词")
+        if target == "all":
+            targets = list(UPLOAD_TARGETS)
+        elif target in UPLOAD_TARGETS:
+            targets = [target]
+        else:
+            raise HTTPException(status_code=400, detail="未知的文件目录")
+        if not 1 <= limit <= MAX_SEARCH_RESULTS:
+            raise HTTPException(status_code=400, detail=f"limit 需在 1 ~ {MAX_SEARCH_RESULTS} 之间")
+        result = await run_in_threadpool(search_index.search, query, targets, limit)
+        return JSONResponse(content={"success": True, "query": query, **result})
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"搜索文件时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
 
+
+def format_server_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.get('/events')
+async def stream_events(request: Request):
+    """以 Server-Sent Events 推送两个目录的新增、修改、删除增量，客户端据此就地更新列表"""
+    subscriber = change_broker.subscribe()
+
+    async def event_stream():
         try:
-            content = file_path.read_text(encoding="utf-8")
-        except UnicodeDecodeError:
-            try:
-                content = file_path.read_text(encoding="gbk")
-            except UnicodeDecodeError:
+            # ready 事件带上当前版本号，客户端断线重连后据此重新加载一次列表
+            yield f"retry: {EVENT_RETRY_MS}\n\n"
+            yield format_server_event("ready", {
+                index.target: index.version for index in directory_indexes.values()
+            })
+            while True:
                 try:
-                    content = file_path.read_text(encoding="latin-1")
-                except Exception:
-                    return JSONResponse(content={
-                        "success": False,
-                        "message": "文件编码不支持，无法预览",
-                    }, status_code=400)
-
-        print(f"[*] 文件预览: {file_id} ({file_size} 字节)")
-        return JSONResponse(content={"success": True, "content": content, "size": file_size})
+                    event = await asyncio.wait_for(subscriber.get(), EVENT_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_server_event("change", event)
+        finally:
+            change_broker.unsubscribe(subscriber)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+@app.api_route('/download/{file_id:path}', methods=["GET", "HEAD"])
+async def download_file(request: Request, file_id: str, inline: bool = False):
+    """下载共享文件，支持断点续传（Range）和条件请求"""
+    try:
+        file_path = resolve_existing_file(SHARED_DIR, file_id)
+        access_tracker.touch(SHARED_DIR, file_path)
+        logger.info(f"文件下载: {file_id}", extra=log_fields(event="download", file=file_id))
+        return await build_download_response(request, file_path, inline)
     except HTTPException as error:
         return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
     except Exception as error:
-        print(f"[!] 预览文件时出错: {error}")
+        logger.error(f"下载文件时出错: {error}")
         return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
 
 
-@app.get('/preview_received/{file_id}')
-async def preview_received_file(file_id: str):
-    """预览已上传文件内容（received_files目录，仅支持小于100KB的文件）"""
+@app.api_route('/download_received/{file_id:path}', methods=["GET", "HEAD"])
+async def download_received_file(request: Request, file_id: str, inline: bool = False):
+    """下载已上传文件（received_files目录），支持断点续传（Range）和条件请求"""
     try:
         file_path = resolve_existing_file(RECEIVED_DIR, file_id)
-        file_size = file_path.stat().st_size
-        if file_size > 102400:
-            return JSONResponse(content={
-                "success": False,
-                "message": "文件过大，无法预览（超过100KB）",
-            }, status_code=400)
+        access_tracker.touch(RECEIVED_DIR, file_path)
+        logger.info(f"文件下载: {file_id}", extra=log_fields(event="download", file=file_id))
+        return await build_download_response(request, file_path, inline)
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"下载文件时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
 
-        try:
-            content = file_path.read_text(encoding="utf-8")
-        except UnicodeDecodeError:
-            try:
-                content = file_path.read_text(encoding="gbk")
-            except UnicodeDecodeError:
-                try:
-                    content = file_path.read_text(encoding="latin-1")
-                except Exception:
-                    return JSONResponse(content={
-                        "success": False,
-                        "message": "文件编码不支持，无法预览",
-                    }, status_code=400)
-
-        print(f"[*] 文件预览: {file_id} ({file_size} 字节)")
-        return JSONResponse(content={"success": True, "content": content, "size": file_size})
+
+@app.post('/upload_encrypted')
+async def upload_encrypted(request: Request, filename: str, target: str = "received"):
+    """接收用预共享密钥加密的分帧数据流（格式见 secure_transfer.py）"""
+    staged = None
+    try:
+        if target not in UPLOAD_TARGETS:
+            raise HTTPException(status_code=400, detail="未知的上传目录")
+        pre_shared_key = require_encryption_key()
+        target_dir, default_name, log_prefix = UPLOAD_TARGETS[target]
+        # 密文比明文略长，按声明长度预分配，提交时截掉多余部分
+        staged = await run_in_threadpool(StagedFile, declared_content_length(request))
+        written, digest = await receive_encrypted_upload(request, staged.file, pre_shared_key)
+        saved_path = await run_in_threadpool(staged.commit, target_dir, sanitize_filename(filename, default_name))
+        await run_in_threadpool(store_deduplicated, saved_path, digest)
+        await run_in_threadpool(register_new_file, target_dir, saved_path)
+        logger.info(f"{log_prefix}（加密）: {filename} -> 保存为: {saved_path.name}",
+                    extra=log_fields(event="upload_encrypted", directory=target, file=saved_path.name, size=written))
+        return JSONResponse(content={
+            "success": True,
+            "message": "上传完成",
+            "filename": saved_path.name,
+            "size": written,
+        })
+    except StreamIntegrityError as error:
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=400)
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"处理加密上传时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+    finally:
+        if staged is not None:
+            # 未完成或校验失败的数据只留在暂存区，这里一并删除
+            await run_in_threadpool(staged.discard)
+
+
+@app.get('/download_encrypted/{file_id:path}')
+async def download_encrypted(file_id: str, target: str = "shared"):
+    """以加密分帧流的形式下载文件，边读边加密，不缓存整个文件"""
+    try:
+        if target not in UPLOAD_TARGETS:
+            raise HTTPException(status_code=400, detail="未知的文件目录")
+        pre_shared_key = require_encryption_key()
+        file_path = resolve_existing_file(UPLOAD_TARGETS[target][0], file_id)
+        access_tracker.touch(UPLOAD_TARGETS[target][0], file_path)
+        size = file_path.stat().st_size
+        logger.info(f"文件下载（加密）: {file_id}", extra=log_fields(event="download_encrypted", file=file_id))
+        return StreamingResponse(
+            iter_encrypted_file(file_path, pre_shared_key, DEFAULT_FRAME_SIZE),
+            media_type=ENCRYPTED_MEDIA_TYPE,
+            headers={"Content-Length": str(encrypted_size(size, DEFAULT_FRAME_SIZE))},
+        )
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"加密下载文件时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+
+
+@app.get('/delta_signature/{file_id:path}')
+async def delta_signature(file_id: str, target: str = "shared", block_size: int | None = None):
+    """返回已有文件的分块校验和，客户端据此只上传变化的块（见 delta_sync.py）"""
+    try:
+        if target not in UPLOAD_TARGETS:
+            raise HTTPException(status_code=400, detail="未知的文件目录")
+        if block_size is not None and not MIN_DELTA_BLOCK_SIZE <= block_size <= MAX_DELTA_BLOCK_SIZE:
+            raise HTTPException(status_code=400,
+                                detail=f"block_size 需在 {MIN_DELTA_BLOCK_SIZE} ~ {MAX_DELTA_BLOCK_SIZE} 之间")
+        file_path = resolve_existing_file(UPLOAD_TARGETS[target][0], file_id)
+        signature = await run_in_threadpool(get_delta_signature, file_path, block_size)
+        return JSONResponse(content={"success": True, **signature})
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"计算增量签名时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+
+
+@app.post('/delta_apply/{file_id:path}')
+async def delta_apply(request: Request, file_id: str, base: str, block_size: int, target: str = "shared",
+                      mode: str = "replace"):
+    """按增量指令重建文件：校验通过后原子替换旧文件（replace），或保留旧文件另存为新版本（version）"""
+    staged = None
+    try:
+        if target not in UPLOAD_TARGETS:
+            raise HTTPException(status_code=400, detail="未知的文件目录")
+        if mode not in {"replace", "version"}:
+            raise HTTPException(status_code=400, detail="mode 只能是 replace 或 version")
+        if not MIN_DELTA_BLOCK_SIZE <= block_size <= MAX_DELTA_BLOCK_SIZE:
+            raise HTTPException(status_code=400,
+                                detail=f"block_size 需在 {MIN_DELTA_BLOCK_SIZE} ~ {MAX_DELTA_BLOCK_SIZE} 之间")
+        target_dir = UPLOAD_TARGETS[target][0]
+        file_path = resolve_existing_file(target_dir, file_id)
+        # 新版本通常与旧文件大小相近，按旧文件大小预分配
+        staged = await run_in_threadpool(StagedFile, file_path.stat().st_size)
+        applier = await receive_delta(request, file_path, base, block_size, staged)
+        saved_path = await run_in_threadpool(commit_delta_version, target_dir, file_path, base, staged, mode,
+                                             applier.digest.hexdigest())
+        saved_id = get_directory_index(target_dir).relative_id(saved_path)
+        logger.info(f"增量同步: {file_id} -> {saved_id} (新数据 {applier.literal_bytes} / {applier.written} 字节)",
+                    extra=log_fields(event="delta_apply", directory=target, file=saved_id, size=applier.written,
+                                     literal_bytes=applier.literal_bytes))
+        return JSONResponse(content={
+            "success": True,
+            "message": "同步完成",
+            "filename": saved_id,
+            "size": applier.written,
+        })
+    except DeltaFormatError as error:
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=400)
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"应用增量时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+    finally:
+        if staged is not None:
+            await run_in_threadpool(staged.discard)
+
+
+@app.post('/download_batch')
+async def download_batch(file_id: list[str] = Form(...), target: str = Form("shared")):
+    """把多个文件打包成 ZIP 流式下载"""
+    try:
+        if target not in UPLOAD_TARGETS:
+            raise HTTPException(status_code=400, detail="未知的文件目录")
+        if len(file_id) > MAX_BATCH_FILES:
+            raise HTTPException(status_code=400, detail=f"一次最多打包 {MAX_BATCH_FILES} 个文件")
+
+        base_dir = UPLOAD_TARGETS[target][0]
+        files = []
+        seen = set()
+        for item in file_id:
+            # 选中的是目录时打包其中的全部文件，ZIP 内保留相对路径
+            path = resolve_relative_path(base_dir, item)
+            if path.is_dir():
+                members = collect_folder_files(path, item)
+            else:
+                members = [(resolve_existing_file(base_dir, item), item)]
+            for member_path, arcname in members:
+                if arcname not in seen:
+                    seen.add(arcname)
+                    files.append((member_path, arcname))
+                    access_tracker.touch(base_dir, member_path)
+            if len(files) > MAX_BATCH_FILES:
+                raise HTTPException(status_code=400, detail=f"一次最多打包 {MAX_BATCH_FILES} 个文件")
+
+        archive_name = f"{base_dir.name}_{time.strftime('%Y%m%d_%H%M%S')}.zip"
+        logger.info(f"批量下载: {len(files)} 个文件 -> {archive_name}",
+                    extra=log_fields(event="download_batch", directory=target, count=len(files)))
+        return StreamingResponse(
+            iter_zip_stream(files),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{archive_name}"'},
+        )
+    except HTTPException as error:
+        return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
+    except Exception as error:
+        logger.error(f"批量下载时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+
+
+@app.get('/thumbnail/{file_id:path}')
+async def thumbnail_file(file_id: str):
+    """共享图片的缩略图"""
+    return await build_thumbnail_response(SHARED_DIR, file_id)
+
+
+@app.get('/thumbnail_received/{file_id:path}')
+async def thumbnail_received_file(file_id: str):
+    """已上传图片的缩略图（received_files目录）"""
+    return await build_thumbnail_response(RECEIVED_DIR, file_id)
+
+
+@app.get('/metrics')
+async def get_metrics():
+    """Prometheus 格式的运行指标，多进程模式下汇总所有工作进程"""
+    snapshots = await run_in_threadpool(collect_metrics_snapshots)
+    return Response(content=metrics.render(snapshots), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get('/compression_stats')
+async def get_compression_stats():
+    """传输压缩的统计：节省的字节数与消耗的 CPU 时间"""
+    return JSONResponse(content={"success": True, **compression_stats.snapshot()})
+
+
+def describe_retention() -> dict:
+    usage = {}
+    for target, (base_dir, _, _) in UPLOAD_TARGETS.items():
+        index = get_directory_index(base_dir)
+        with index.lock:
+            usage[target] = {
+                "files": len(index.entries),
+                "bytes": sum(entry["size"] for entry in index.entries.values()),
+            }
+    return {
+        "policies": CONFIG["retention"],
+        "interval": CONFIG["retention_interval"],
+        "usage": usage,
+        "reports": retention_manager.recent_reports(),
+    }
+
+
+@app.get('/retention')
+async def get_retention():
+    """保留策略的配置、各目录当前占用，以及最近几次清理释放的文件和空间"""
+    try:
+        return JSONResponse(content={"success": True, **await run_in_threadpool(describe_retention)})
+    except Exception as error:
+        logger.error(f"获取保留策略状态时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+
+
+@app.get('/mirror/manifest')
+async def mirror_manifest(request: Request):
+    """镜像清单：shared_files 中的文件及其哈希、删除记录，内容不变时返回 304"""
+    try:
+        manifest = await run_in_threadpool(mirror_service.manifest)
+        body = json.dumps({"success": True, **manifest}, ensure_ascii=False).encode("utf-8")
+        etag = f'"{hashlib.md5(body, usedforsecurity=False).hexdigest()}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in [value.strip() for value in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type="application/json", headers=headers)
+    except Exception as error:
+        logger.error(f"生成镜像清单时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+
+
+@app.get('/mirror/file/{file_id:path}')
+async def mirror_file(request: Request, file_id: str, sha256: str):
+    """供其他节点分块拉取文件；内容已不是清单中的版本时返回 409，对方按新清单重新下载"""
+    try:
+        file_path = resolve_existing_file(SHARED_DIR, file_id)
+        if not await run_in_threadpool(mirror_service.is_current, file_id, sha256):
+            raise HTTPException(status_code=409, detail="文件已变化")
+        return await build_download_response(request, file_path, False)
     except HTTPException as error:
         return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
     except Exception as error:
-        print(f"[!] 预览文件时出错: {error}")
+        logger.error(f"发送镜像文件时出错: {error}")
+        return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
+
+
+@app.get('/mirror/status')
+async def mirror_status():
+    """镜像同步状态：本机标识、各节点最近一次同步时间、错误和同步的文件数"""
+    try:
+        return JSONResponse(content={"success": True, **await run_in_threadpool(mirror_service.describe)})
+    except Exception as error:
+        logger.error(f"获取镜像状态时出错: {error}")
         return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
 
 
-@app.post('/delete_shared/{file_id}')
+def save_text_file(text: str, filename: str) -> Path:
+    data = text.encode("utf-8")
+    with StagedFile(len(data)) as staged:
+        write_timed(staged.file, data, "text")
+        file_path = staged.commit(SHARED_DIR, filename)
+    content_index.record(file_path, hashlib.sha256(data).hexdigest())
+    get_directory_index(SHARED_DIR).update(file_path)
+    return file_path
+
+
+@app.post('/upload_text')
+async def upload_text(text: str = Form(...), filename: str = Form(...)):
+    """上传文本内容并保存为txt文件"""
+    try:
+        safe_filename = sanitize_filename(filename, 'text_file.txt')
+        if not safe_filename.endswith('.txt'):
+            safe_filename += '.txt'
+
+        file_path = await run_in_threadpool(save_text_file, text, safe_filename)
+        file_size = file_path.stat().st_size
+        logger.info(f"文本已保存: {file_path.name} ({file_size} 字节)")
+
+        return JSONResponse(content={
+            "success": True,
+            "message": "文本上传成功",
+            "filename": file_path.name,
+            "size": file_size,
+        })
+    except Exception as error:
+        logger.error(f"处理文本上传时出错: {error}")
+        return JSONResponse(content={
+            "success": False,
+            "message": str(error),
+        }, status_code=500)
+
+
+@app.get('/preview/{file_id:path}')
+async def preview_file(file_id: str, offset: int = 0, length: int = DEFAULT_PREVIEW_PAGE_SIZE,
+                       line: int | None = None, lines: int = DEFAULT_PREVIEW_LINES):
+    """分页预览共享文件内容，可按字节偏移或行号翻页"""
+    return await build_preview_response(SHARED_DIR, file_id, offset, length, line, lines)
+
+
+@app.get('/preview_received/{file_id:path}')
+async def preview_received_file(file_id: str, offset: int = 0, length: int = DEFAULT_PREVIEW_PAGE_SIZE,
+                                line: int | None = None, lines: int = DEFAULT_PREVIEW_LINES):
+    """分页预览已上传文件内容（received_files目录）"""
+    return await build_preview_response(RECEIVED_DIR, file_id, offset, length, line, lines)
+
+
+@app.post('/delete_shared/{file_id:path}')
 async def delete_shared_file(file_id: str):
     """删除共享文件（shared_files目录）"""
     try:
         file_path = resolve_existing_file(SHARED_DIR, file_id)
-        file_path.unlink()
-        print(f"[*] 文件已删除: {file_id}")
+        await run_in_threadpool(delete_stored_file, SHARED_DIR, file_path)
+        logger.info(f"文件已删除: {file_id}", extra=log_fields(event="delete", file=file_id))
         return JSONResponse(content={"success": True, "message": "文件删除成功"})
     except HTTPException as error:
         return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
     except Exception as error:
-        print(f"[!] 删除文件时出错: {error}")
+        logger.error(f"删除文件时出错: {error}")
         return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
 
 
-@app.post('/delete_received/{file_id}')
+@app.post('/delete_received/{file_id:path}')
 async def delete_received_file(file_id: str):
     """删除已上传文件（received_files目录）"""
     try:
         file_path = resolve_existing_file(RECEIVED_DIR, file_id)
-        file_path.unlink()
-        print(f"[*] 文件已删除: {file_id}")
+        await run_in_threadpool(delete_stored_file, RECEIVED_DIR, file_path)
+        logger.info(f"文件已删除: {file_id}", extra=log_fields(event="delete", file=file_id))
         return JSONResponse(content={"success": True, "message": "文件删除成功"})
     except HTTPException as error:
         return JSONResponse(content={"success": False, "message": error.detail}, status_code=error.status_code)
     except Exception as error:
-        print(f"[!] 删除文件时出错: {error}")
+        logger.error(f"删除文件时出错: {error}")
         return JSONResponse(content={"success": False, "message": str(error)}, status_code=500)
 
 
-if __name__ == "__main__":
-    import sys
+def select_server_runtime() -> tuple[str, str]:
+    """安装了 uvloop / httptools 时使用更快的事件循环和 HTTP 解析器，否则退回标准实现"""
+    loop = "uvloop" if find_spec("uvloop") is not None else "asyncio"
+    http = "httptools" if find_spec("httptools") is not None else "h11"
+    return loop, http
+
+
+def run_server(port: int, on_listening=None):
+    """
+    在当前进程中启动 uvicorn。单进程模式下 on_listening 在监听套接字就绪后调用，
+    启动脚本用它统计启动耗时；多进程模式由 uvicorn 的主进程绑定端口并拉起工作进程。
+    """
     import uvicorn
 
-    port = load_config()["port"]
+    setup_logging()
+    workers = CONFIG["workers"]
+    loop, http = select_server_runtime()
+    print(f"[*] 服务器启动，访问地址: http://0.0.0.0:{port}")
+    print(f"[*] 工作进程: {workers}，事件循环: {loop}，HTTP 解析: {http}")
+    print("[*] 请确保客户端使用相同的预共享密钥")
+    options = dict(host="0.0.0.0", port=port, loop=loop, http=http, reload=False, log_config=None,
+                   timeout_graceful_shutdown=SHUTDOWN_GRACE_PERIOD)
+    if workers > 1:
+        # 多进程模式需要以导入路径启动，每个工作进程各自导入本模块
+        uvicorn.run("server_simple:app", workers=workers, app_dir=str(BASE_DIR), **options)
+        return
+
+    class Server(uvicorn.Server):
+        async def startup(self, sockets=None):
+            await super().startup(sockets=sockets)
+            if on_listening is not None and self.started:
+                on_listening()
+
+    Server(uvicorn.Config(app, **options)).run()
+
+
+if __name__ == "__main__":
+    port = CONFIG["port"]
     if len(sys.argv) > 1:
         try:
             cmd_port = int(sys.argv[1])
@@ -366,6 +4533,4 @@ if __name__ == "__main__":
         except ValueError:
             print(f"无效的端口号参数，使用配置文件端口: {port}")
 
-    print(f"[*] 服务器启动，访问地址: http://0.0.0.0:{port}")
-    print("[*] 请确保客户端使用相同的预共享密钥")
-    uvicorn.run(app, host="0.0.0.0", port=port, reload=False)
+    run_server(port)
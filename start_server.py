@@ -1,7 +1,13 @@
+import time
+
+LAUNCH_STARTED = time.perf_counter()
+
+import hashlib
 import json
 import os
 import platform
 import socket
+import struct
 import subprocess
 import sys
 from importlib.util import find_spec
@@ -9,6 +15,7 @@ from importlib.util import find_spec
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_PATH = os.path.join(BASE_DIR, "config.json")
 REQUIREMENTS_PATH = os.path.join(BASE_DIR, "requirements.txt")
+DEPENDENCY_CACHE_PATH = os.path.join(BASE_DIR, ".dependency_check.json")
 RECEIVED_DIR = os.path.join(BASE_DIR, "received_files")
 SHARED_DIR = os.path.join(BASE_DIR, "shared_files")
 REQUIRED_MODULES = [
@@ -19,6 +26,8 @@ REQUIRED_MODULES = [
     ("Crypto", "pycryptodome"),
 ]
 MIN_PYTHON_VERSION = (3, 10)
+# 读取网卡地址的 ioctl 请求号（SIOCGIFADDR），其他系统退回按主机名解析
+SIOCGIFADDR = {"Linux": 0x8915, "Darwin": 0xC0206921}
 
 
 def wait_before_exit(message="按回车键退出..."):
@@ -88,6 +97,42 @@ def get_missing_runtime_dependencies():
     return missing_packages
 
 
+def get_dependency_check_key():
+    """解释器或 requirements.txt 变化后缓存自动失效"""
+    digest = hashlib.sha256()
+    digest.update(sys.executable.encode("utf-8"))
+    digest.update(sys.version.encode("utf-8"))
+    try:
+        with open(REQUIREMENTS_PATH, "rb") as f:
+            digest.update(f.read())
+    except OSError:
+        pass
+    return digest.hexdigest()
+
+
+def dependency_check_cached():
+    try:
+        with open(DEPENDENCY_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f).get("key") == get_dependency_check_key()
+    except (OSError, ValueError, AttributeError):
+        return False
+
+
+def remember_dependency_check():
+    try:
+        with open(DEPENDENCY_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump({"key": get_dependency_check_key(), "checked_at": time.time()}, f)
+    except OSError:
+        pass
+
+
+def forget_dependency_check():
+    try:
+        os.remove(DEPENDENCY_CACHE_PATH)
+    except OSError:
+        pass
+
+
 def install_runtime_dependencies(missing_packages):
     print("4. 检查运行依赖...")
     if not missing_packages:
@@ -142,19 +187,39 @@ def get_local_ipv4_addresses():
             seen.add(address)
             addresses.append(address)
 
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.connect(("8.8.8.8", 80))
-            add_address(sock.getsockname()[0])
-    except OSError:
-        pass
+    for address in get_interface_ipv4_addresses():
+        add_address(address)
+
+    if not addresses:
+        try:
+            for info in socket.getaddrinfo(socket.gethostname(), None, family=socket.AF_INET):
+                add_address(info[4][0])
+        except OSError:
+            pass
 
+    return addresses
+
+
+def get_interface_ipv4_addresses():
+    """直接读取各网卡的 IPv4 地址，不发起任何网络连接，断网时也不会卡住"""
+    request = SIOCGIFADDR.get(platform.system())
+    if request is None or not hasattr(socket, "if_nameindex"):
+        return []
+    import fcntl
+
+    addresses = []
     try:
-        for info in socket.getaddrinfo(socket.gethostname(), None, family=socket.AF_INET):
-            add_address(info[4][0])
+        interfaces = socket.if_nameindex()
     except OSError:
-        pass
-
+        return []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in interfaces:
+            try:
+                result = fcntl.ioctl(sock.fileno(), request, struct.pack("256s", name.encode("utf-8")[:15]))
+            except OSError:
+                continue
+            # ifreq 结构中接口名占 16 字节，随后的 sockaddr_in 从第 20 字节开始是 IPv4 地址
+            addresses.append(socket.inet_ntoa(result[20:24]))
     return addresses
 
 
@@ -191,7 +256,54 @@ def show_local_ip_info(port):
         print(f"   http://{address}:{port}")
 
 
+def check_dependencies(force=False):
+    if not force and dependency_check_cached():
+        print("4. 检查运行依赖...")
+        print("依赖检查结果已缓存，跳过（如需重新检查请加参数 --recheck）")
+        print()
+        return True
+
+    missing_packages = get_missing_runtime_dependencies()
+    if not install_runtime_dependencies(missing_packages):
+        return False
+    remember_dependency_check()
+    return True
+
+
+def import_server():
+    """在当前进程中加载服务器模块；缓存过期导致导入失败时重新检查依赖后再试一次"""
+    try:
+        import server_simple
+    except ImportError as error:
+        print(f"加载服务器失败: {error}，重新检查依赖...")
+        forget_dependency_check()
+        if not check_dependencies(force=True):
+            return None
+        import server_simple
+    return server_simple
+
+
+class StartupTimer:
+    """记录启动各阶段的耗时，监听端口就绪后输出报告"""
+
+    def __init__(self):
+        self.last = LAUNCH_STARTED
+        self.phases = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        self.mark("监听就绪")
+        total = time.perf_counter() - LAUNCH_STARTED
+        details = "，".join(f"{name} {elapsed * 1000:.0f} ms" for name, elapsed in self.phases)
+        print(f"[*] 启动耗时 {total * 1000:.0f} ms（{details}）", flush=True)
+
+
 def main():
+    timer = StartupTimer()
     print("=" * 50)
     print("局域网安全文件传输系统")
     print("=" * 50)
@@ -216,10 +328,11 @@ def main():
             print(f"建议可用端口: {suggested_port}")
         wait_before_exit()
         return
+    timer.mark("准备")
 
-    missing_packages = get_missing_runtime_dependencies()
-    if not install_runtime_dependencies(missing_packages):
+    if not check_dependencies(force="--recheck" in sys.argv[1:]):
         return
+    timer.mark("依赖检查")
 
     print()
     print("=" * 50)
@@ -233,12 +346,18 @@ def main():
     print("5. 如需修改端口，请编辑 config.json 文件")
     print("=" * 50)
     show_local_ip_info(port)
+    timer.mark("识别IP")
 
     print(f"6. 正在启动服务器，端口: {port}...")
     print()
 
+    # 直接在当前进程中启动服务器，省去再启动一个 Python 解释器和重复导入的时间
+    server = import_server()
+    if server is None:
+        return
+    timer.mark("加载应用")
     try:
-        subprocess.run([sys.executable, os.path.join(BASE_DIR, "server_simple.py"), str(port)], check=False)
+        server.run_server(port, on_listening=timer.report)
     except KeyboardInterrupt:
         print()
         print("服务器已停止")
@@ -0,0 +1,138 @@
+"""
+测试公共设置。
+
+server_simple 在导入时读取 TRANSFER_DATA_DIR / TRANSFER_CONFIG，这里在任何测试导入它之前
+把数据目录指向临时目录，测试不会在仓库里留下 received_files 等运行数据。
+需要真实网络和多进程的测试通过 server_factory 在临时目录中启动独立的 server_simple.py 进程。
+"""
+import atexit
+import http.client
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+sys.path.insert(0, str(ROOT_DIR / "benchmarks"))
+
+TEST_DATA_DIR = Path(tempfile.mkdtemp(prefix="transfer-test-"))
+os.environ["TRANSFER_DATA_DIR"] = str(TEST_DATA_DIR)
+os.environ["TRANSFER_CONFIG"] = str(TEST_DATA_DIR / "config.json")
+atexit.register(shutil.rmtree, TEST_DATA_DIR, ignore_errors=True)
+
+from download_throughput import find_free_port, wait_for_port  # noqa: E402
+
+
+class ServerProcess:
+    """在独立数据目录中运行的 server_simple.py 进程"""
+
+    def __init__(self, root: Path, config: dict):
+        self.root = root
+        self.data_dir = root / "data"
+        self.config_path = root / "config.json"
+        self.port = find_free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.write_config(config)
+        self.process = None
+
+    def write_config(self, config: dict):
+        self.config_path.write_text(json.dumps(config), encoding="utf-8")
+
+    def start(self):
+        env = dict(os.environ, TRANSFER_DATA_DIR=str(self.data_dir), TRANSFER_CONFIG=str(self.config_path))
+        self.log = (self.root / "server.log").open("ab")
+        self.process = subprocess.Popen(
+            [sys.executable, str(ROOT_DIR / "server_simple.py"), str(self.port)],
+            env=env, stdout=self.log, stderr=subprocess.STDOUT,
+        )
+        wait_for_port(self.port)
+        return self
+
+    def stop(self):
+        """正常退出：uvicorn 收到 SIGTERM 后执行 lifespan 的清理"""
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(timeout=30)
+        self.log.close()
+
+    def kill(self):
+        """模拟崩溃：不执行任何清理"""
+        self.process.kill()
+        self.process.wait(timeout=30)
+        self.log.close()
+
+    def descendants(self) -> list[int]:
+        """服务器进程派生的所有子孙进程，读取 /proc，只能在 Linux 上使用"""
+        parents = {}
+        for stat_path in Path("/proc").glob("[0-9]*/stat"):
+            try:
+                # 进程名可能带空格和括号，从最后一个右括号之后开始解析
+                fields = stat_path.read_text().rsplit(")", 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            parents[int(stat_path.parent.name)] = int(fields[1])
+        found, pending = [], [self.process.pid]
+        while pending:
+            parent = pending.pop()
+            children = [pid for pid, ppid in parents.items() if ppid == parent]
+            found += children
+            pending += children
+        return found
+
+    def opens_metadata_db(self, pid: int) -> bool:
+        """进程是否打开了元数据库（含 -wal、-shm 文件）"""
+        db_path = str(self.data_dir / ".metadata.sqlite3")
+        for fd_path in Path(f"/proc/{pid}/fd").iterdir():
+            try:
+                if os.readlink(fd_path).startswith(db_path):
+                    return True
+            except OSError:
+                continue
+        return False
+
+    @property
+    def shared_dir(self) -> Path:
+        return self.data_dir / "shared_files"
+
+    def request(self, method: str, path: str, body=None, headers: dict | None = None) -> tuple[int, bytes]:
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def get_json(self, path: str) -> dict:
+        status, body = self.request("GET", path)
+        assert status == 200, body
+        return json.loads(body)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def initialized_server():
+    """进程内的测试直接调用 server_simple 的函数，先完成 lifespan 中的初始化"""
+    import server_simple
+    server_simple.initialize_server()
+
+
+@pytest.fixture
+def server_factory(tmp_path):
+    servers = []
+
+    def create(name: str = "node", config: dict | None = None) -> ServerProcess:
+        server = ServerProcess(tmp_path / name, config or {})
+        servers.append(server)
+        return server
+
+    yield create
+    for server in servers:
+        if server.process is not None and server.process.poll() is None:
+            server.stop()
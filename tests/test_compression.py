@@ -0,0 +1,123 @@
+"""压缩上传：逐块有界解压、总大小上限和接受压缩请求体的路径"""
+import asyncio
+import gzip
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import server_simple
+from server_simple import REQUEST_DECOMPRESS_CHUNK_SIZE, DecompressingReceive, new_decompressor
+
+ENCODINGS = ["gzip"] + (["zstd"] if server_simple.zstandard is not None else [])
+
+
+def compress(encoding: str, data: bytes) -> bytes:
+    if encoding == "zstd":
+        return server_simple.zstandard.ZstdCompressor(level=19).compress(data)
+    return gzip.compress(data)
+
+
+def drain(messages: list[dict], encoding: str) -> list[bytes]:
+    async def run():
+        pending = list(messages)
+
+        async def receive():
+            return pending.pop(0)
+
+        receive_decompressed = DecompressingReceive(receive, new_decompressor(encoding))
+        chunks = []
+        while True:
+            message = await receive_decompressed()
+            chunks.append(message["body"])
+            if not message["more_body"]:
+                return chunks
+
+    return asyncio.run(run())
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(server_simple.app) as test_client:
+        yield test_client
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_bomb_is_released_in_bounded_chunks(encoding):
+    data = b"\0" * (64 * 1024 * 1024)
+    body = compress(encoding, data)
+    chunks = drain([{"type": "http.request", "body": body, "more_body": False}], encoding)
+    # zstd 每次喂入的一小段输入最多再展开一个 128KB 的块序列
+    slack = 0 if encoding == "gzip" else 4 * 1024 * 1024
+    assert max(map(len, chunks)) <= REQUEST_DECOMPRESS_CHUNK_SIZE + slack
+    assert sum(map(len, chunks)) == len(data)
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_split_body_round_trips(encoding):
+    data = bytes(range(256)) * 20000
+    body = compress(encoding, data)
+    messages = [
+        {"type": "http.request", "body": body[position:position + 1000], "more_body": position + 1000 < len(body)}
+        for position in range(0, len(body), 1000)
+    ]
+    assert b"".join(drain(messages, encoding)) == data
+
+
+def test_total_size_cap_raises_413(monkeypatch):
+    monkeypatch.setattr(server_simple, "MAX_DECOMPRESSED_BODY_SIZE", 4 * 1024 * 1024)
+    body = gzip.compress(b"\0" * (16 * 1024 * 1024))
+    with pytest.raises(HTTPException) as error:
+        drain([{"type": "http.request", "body": body, "more_body": False}], "gzip")
+    assert error.value.status_code == 413
+
+
+@pytest.mark.parametrize("path", ["/upload", "/upload_text"])
+def test_oversized_compressed_upload_returns_413(client, monkeypatch, path):
+    monkeypatch.setattr(server_simple, "MAX_DECOMPRESSED_BODY_SIZE", 1024 * 1024)
+    boundary = "compression-test"
+    field = 'name="file"; filename="bomb.bin"' if path == "/upload" else 'name="text"'
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; {field}\r\n\r\n".encode()
+        + b"a" * (8 * 1024 * 1024)
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+    response = client.post(path, content=gzip.compress(body), headers={
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Encoding": "gzip",
+    })
+    assert response.status_code == 413
+
+
+def test_compressed_upload_is_stored_decompressed(client):
+    boundary = "compression-test"
+    data = b"hello compressed upload\n" * 1000
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="plain.txt"\r\n\r\n'.encode()
+        + data
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+    response = client.post("/upload_shared", content=gzip.compress(body), headers={
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Encoding": "gzip",
+    })
+    assert response.status_code == 200
+    stored = server_simple.SHARED_DIR / "plain.txt"
+    try:
+        assert stored.read_bytes() == data
+    finally:
+        stored.unlink(missing_ok=True)
+
+
+@pytest.mark.parametrize("path, accepted", [
+    ("/upload", True),
+    ("/upload_shared", True),
+    ("/upload_text", True),
+    ("/upload_session/" + "0" * 32, True),
+    ("/upload_folder", False),
+    ("/upload_encrypted", False),
+    ("/upload_session", False),
+    ("/upload_session/" + "0" * 32 + "/complete", False),
+])
+def test_compressed_bodies_only_on_exact_paths(path, accepted):
+    assert server_simple.accepts_compressed_body(path) is accepted
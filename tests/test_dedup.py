@@ -0,0 +1,54 @@
+"""重复内容以硬链接保存，且不改动原文件的修改时间"""
+import hashlib
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server_simple
+
+OLD_MTIME_NS = 1_600_000_000_000_000_000
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(server_simple.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def original():
+    data = os.urandom(256 * 1024)
+    file_path = server_simple.SHARED_DIR / "original.bin"
+    file_path.write_bytes(data)
+    os.utime(file_path, ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+    digest = hashlib.sha256(data).hexdigest()
+    server_simple.content_index.record(file_path, digest)
+    server_simple.get_directory_index(server_simple.SHARED_DIR).update(file_path)
+    yield file_path, data, digest
+    for name in ("original.bin", "duplicate.bin", "checked.bin"):
+        path = server_simple.SHARED_DIR / name
+        if path.exists():
+            server_simple.delete_stored_file(server_simple.SHARED_DIR, path)
+
+
+def test_duplicate_upload_keeps_original_mtime(client, original):
+    file_path, data, _ = original
+    response = client.post("/upload_shared", files=[("file", ("duplicate.bin", data))])
+    assert response.status_code == 200
+    duplicate = server_simple.SHARED_DIR / "duplicate.bin"
+    assert duplicate.stat().st_ino == file_path.stat().st_ino
+    assert file_path.stat().st_mtime_ns == OLD_MTIME_NS
+
+
+def test_upload_check_links_without_touching_original(client, original):
+    file_path, data, digest = original
+    response = client.post("/upload_check", data={
+        "sha256": digest, "size": len(data), "filename": "checked.bin", "target": "shared",
+    })
+    assert response.json()["exists"] is True
+    checked = server_simple.SHARED_DIR / "checked.bin"
+    assert checked.read_bytes() == data
+    assert file_path.stat().st_mtime_ns == OLD_MTIME_NS
+    # 两个路径的哈希记录都仍然有效，之后还能继续秒传
+    assert server_simple.content_index.find(digest, len(data), exclude=file_path) == checked.resolve()
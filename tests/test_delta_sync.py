@@ -0,0 +1,119 @@
+"""块级增量同步：滚动校验和、增量指令生成与重建"""
+import io
+import os
+import random
+import zlib
+
+import pytest
+
+from delta_sync import (
+    COPY_OP, END_OP, MAX_BLOCK_SIZE, MIN_BLOCK_SIZE, DeltaApplier, DeltaFormatError, choose_block_size,
+    compute_signature, decode_signature, iter_delta, roll_adler32,
+)
+
+BLOCK_SIZE = 4096
+
+
+def make_delta(tmp_path, old: bytes, new: bytes, block_size: int = BLOCK_SIZE) -> tuple[bytes, dict]:
+    old_path, new_path = tmp_path / "old.bin", tmp_path / "new.bin"
+    old_path.write_bytes(old)
+    new_path.write_bytes(new)
+    stats = {}
+    delta = b"".join(iter_delta(new_path, compute_signature(old_path, block_size), stats))
+    return delta, stats
+
+
+def apply_delta(old: bytes, delta: bytes, block_size: int = BLOCK_SIZE, piece: int = 1000) -> bytes:
+    output = io.BytesIO()
+    applier = DeltaApplier(io.BytesIO(old), len(old), block_size, output.write)
+    for position in range(0, len(delta), piece):
+        applier.feed(delta[position:position + piece])
+    applier.finish()
+    return output.getvalue()
+
+
+def test_rolling_checksum_matches_zlib():
+    data = os.urandom(BLOCK_SIZE + 500)
+    checksum = zlib.adler32(data[:BLOCK_SIZE])
+    for start in range(1, 500):
+        checksum = roll_adler32(checksum, data[start - 1], data[start - 1 + BLOCK_SIZE], BLOCK_SIZE)
+        assert checksum == zlib.adler32(data[start:start + BLOCK_SIZE])
+
+
+@pytest.mark.parametrize("size, expected", [
+    (0, MIN_BLOCK_SIZE), (1000, MIN_BLOCK_SIZE), (64 * 1024 * 1024, 8192), (2 ** 50, MAX_BLOCK_SIZE),
+])
+def test_block_size_follows_square_root(size, expected):
+    assert choose_block_size(size) == expected
+
+
+def test_signature_covers_short_tail(tmp_path):
+    file_path = tmp_path / "base.bin"
+    file_path.write_bytes(os.urandom(3 * BLOCK_SIZE + 10))
+    block_size, size, weak, strong = decode_signature(compute_signature(file_path, BLOCK_SIZE))
+    assert (block_size, size) == (BLOCK_SIZE, 3 * BLOCK_SIZE + 10)
+    # 3 个整块加 1 个不足一块的尾部
+    assert len(weak) == len(strong) == 4
+    assert weak[3] == zlib.adler32(file_path.read_bytes()[-10:])
+
+
+EDITS = {
+    "unchanged": lambda old: old,
+    "insert": lambda old: old[:100_000] + b"inserted bytes" + old[100_000:],
+    "delete": lambda old: old[:5000] + old[9000:],
+    "overwrite": lambda old: old[:200_000] + b"x" * 10 + old[200_010:],
+    "append": lambda old: old + b"appended tail",
+    "truncate": lambda old: old[:-1],
+    "replace": lambda old: os.urandom(1000),
+}
+
+
+@pytest.mark.parametrize("edit", EDITS)
+def test_delta_round_trips(tmp_path, edit):
+    random.seed(edit)
+    old = random.randbytes(300_000)
+    new = EDITS[edit](old)
+    delta, stats = make_delta(tmp_path, old, new)
+    assert apply_delta(old, delta) == new
+    assert stats["literal_bytes"] + stats["copied_bytes"] == len(new)
+
+
+def test_small_edit_sends_little_data(tmp_path):
+    old = os.urandom(1024 * 1024)
+    new = old[:500_000] + b"edit" + old[500_000:]
+    delta, stats = make_delta(tmp_path, old, new)
+    # 只有插入点所在的一块需要重新发送
+    assert stats["literal_bytes"] < 2 * BLOCK_SIZE
+    assert len(delta) < 3 * BLOCK_SIZE
+
+
+def test_empty_base_sends_everything(tmp_path):
+    delta, stats = make_delta(tmp_path, b"", b"brand new")
+    assert stats == {"literal_bytes": 9, "copied_bytes": 0}
+    assert apply_delta(b"", delta) == b"brand new"
+
+
+def test_wrong_digest_is_rejected(tmp_path):
+    old = os.urandom(50_000)
+    delta, _ = make_delta(tmp_path, old, old)
+    tampered = delta[:-1] + bytes([delta[-1] ^ 1])
+    with pytest.raises(DeltaFormatError):
+        apply_delta(old, tampered)
+
+
+def test_copy_outside_base_is_rejected():
+    old = os.urandom(2 * BLOCK_SIZE)
+    applier = DeltaApplier(io.BytesIO(old), len(old), BLOCK_SIZE, lambda data: None)
+    with pytest.raises(DeltaFormatError):
+        applier.feed(COPY_OP + (1).to_bytes(4, "big") + (2).to_bytes(4, "big"))
+
+
+def test_truncated_stream_is_incomplete(tmp_path):
+    old = os.urandom(50_000)
+    delta, _ = make_delta(tmp_path, old, old + b"more")
+    end = len(delta) - 1 - 32
+    assert delta[end:end + 1] == END_OP
+    applier = DeltaApplier(io.BytesIO(old), len(old), BLOCK_SIZE, lambda data: None)
+    applier.feed(delta[:end])
+    with pytest.raises(DeltaFormatError):
+        applier.finish()
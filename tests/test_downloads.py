@@ -0,0 +1,78 @@
+"""下载接口：直接打开的类型白名单、安全响应头和多段 Range"""
+import re
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server_simple
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(server_simple.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def shared_file():
+    created = []
+
+    def create(name: str, data: bytes) -> str:
+        file_path = server_simple.SHARED_DIR / name
+        file_path.write_bytes(data)
+        created.append(file_path)
+        return name
+
+    yield create
+    for file_path in created:
+        file_path.unlink(missing_ok=True)
+
+
+@pytest.mark.parametrize("name", ["page.html", "image.svg", "script.js", "notes.txt"])
+def test_unsafe_types_are_never_served_inline(client, shared_file, name):
+    shared_file(name, b"<script>alert(1)</script>")
+    response = client.get(f"/download/{name}", params={"inline": "true"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert response.headers["content-disposition"].startswith("attachment")
+    assert response.headers["x-content-type-options"] == "nosniff"
+    assert "content-security-policy" not in response.headers
+
+
+@pytest.mark.parametrize("name, media_type", [
+    ("photo.png", "image/png"), ("clip.mp4", "video/mp4"), ("song.mp3", "audio/mpeg"),
+    ("paper.pdf", "application/pdf"),
+])
+def test_media_types_open_inline_in_a_sandbox(client, shared_file, name, media_type):
+    shared_file(name, b"\x00" * 128)
+    response = client.get(f"/download/{name}", params={"inline": "true"})
+    assert response.headers["content-type"] == media_type
+    assert response.headers["content-disposition"].startswith("inline")
+    assert response.headers["content-security-policy"] == "sandbox"
+    assert response.headers["x-content-type-options"] == "nosniff"
+
+
+def test_attachment_download_sends_nosniff(client, shared_file):
+    shared_file("photo.jpg", b"\xff\xd8\xff" + b"\x00" * 64)
+    response = client.get("/download/photo.jpg")
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert response.headers["x-content-type-options"] == "nosniff"
+    assert "content-security-policy" not in response.headers
+
+
+def test_multi_range_response_follows_rfc_9110(client, shared_file):
+    data = bytes(range(256)) * 4
+    shared_file("ranges.bin", data)
+    response = client.get("/download/ranges.bin", headers={"Range": "bytes=0-9,100-119"})
+    assert response.status_code == 206
+    boundary = re.fullmatch(r"multipart/byteranges; boundary=(\S+)", response.headers["content-type"]).group(1)
+    assert int(response.headers["content-length"]) == len(response.content)
+    expected = (
+        f"--{boundary}\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes 0-9/1024\r\n\r\n".encode()
+        + data[0:10]
+        + f"\r\n--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+          f"Content-Range: bytes 100-119/1024\r\n\r\n".encode()
+        + data[100:120]
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+    assert response.content == expected
@@ -0,0 +1,112 @@
+"""文件夹上传：增量解析 tar 流，保留目录结构，拒绝越界路径"""
+import io
+import os
+import shutil
+import tarfile
+
+import pytest
+
+import server_simple
+from server_simple import ArchiveFormatError, TarStreamExtractor
+
+MTIME = 1_600_000_000
+
+
+def build_tar(members: list[tuple[str, bytes | None]], tar_format=tarfile.PAX_FORMAT) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tar_format) as archive:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.mtime = MTIME
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                archive.addfile(info)
+            else:
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def extract():
+    target_dir = server_simple.RECEIVED_DIR
+    before = set(target_dir.iterdir())
+
+    def run(archive: bytes, piece: int = 700) -> TarStreamExtractor:
+        extractor = TarStreamExtractor(target_dir)
+        try:
+            # 按不与 512 字节块对齐的长度分段喂入，模拟网络分包
+            for position in range(0, len(archive), piece):
+                extractor.feed(archive[position:position + piece])
+        finally:
+            extractor.abort()
+        return extractor
+
+    yield run
+    for path in set(target_dir.iterdir()) - before:
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            server_simple.delete_stored_file(target_dir, path)
+    server_simple.get_directory_index(target_dir).rescan()
+
+
+def test_nested_folders_keep_structure_and_mtime(extract):
+    extractor = extract(build_tar([
+        ("album", None), ("album/2024/photo.jpg", os.urandom(5000)), ("album/notes.txt", b"notes"),
+        ("album/empty", None),
+    ]))
+    root = server_simple.RECEIVED_DIR / "album"
+    assert extractor.finished
+    assert list(extractor.roots.values()) == [root]
+    assert (root / "notes.txt").read_bytes() == b"notes"
+    assert (root / "2024" / "photo.jpg").stat().st_size == 5000
+    assert (root / "2024" / "photo.jpg").stat().st_mtime == MTIME
+    assert (root / "empty").is_dir()
+    assert extractor.written == 5005
+
+
+@pytest.mark.parametrize("tar_format", [tarfile.PAX_FORMAT, tarfile.GNU_FORMAT])
+def test_long_paths_use_extended_headers(extract, tar_format):
+    # 超过 ustar 头部 100 字节的名称字段
+    name = "deep/" + "/".join(["子目录" * 5] * 6) + "/" + "长文件名" * 10 + ".txt"
+    extract(build_tar([(name, b"long")], tar_format))
+    assert (server_simple.RECEIVED_DIR / name).read_bytes() == b"long"
+
+
+def test_existing_folder_is_not_merged(extract):
+    extract(build_tar([("photos/a.jpg", b"first")]))
+    extractor = extract(build_tar([("photos/a.jpg", b"second")]))
+    assert extractor.roots["photos"].name == "photos_1"
+    assert (server_simple.RECEIVED_DIR / "photos" / "a.jpg").read_bytes() == b"first"
+    assert (server_simple.RECEIVED_DIR / "photos_1" / "a.jpg").read_bytes() == b"second"
+
+
+@pytest.mark.parametrize("name", ["../escape.txt", "folder/../../escape.txt"])
+def test_parent_references_are_rejected(extract, name):
+    with pytest.raises(ArchiveFormatError):
+        extract(build_tar([(name, b"x")]))
+    assert not (server_simple.RECEIVED_DIR.parent / "escape.txt").exists()
+
+
+def test_links_are_skipped(extract):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as archive:
+        link = tarfile.TarInfo("links/passwd")
+        link.type = tarfile.SYMTYPE
+        link.linkname = "/etc/passwd"
+        archive.addfile(link)
+        kept = tarfile.TarInfo("links/kept.txt")
+        kept.size = 4
+        archive.addfile(kept, io.BytesIO(b"kept"))
+    extractor = extract(buffer.getvalue())
+    assert [path.name for path in extractor.saved_files] == ["kept.txt"]
+    assert not os.path.lexists(server_simple.RECEIVED_DIR / "links" / "passwd")
+
+
+def test_interrupted_upload_keeps_completed_files_only(extract):
+    archive = build_tar([("partial/done.txt", b"done"), ("partial/big.bin", os.urandom(100_000))])
+    extractor = extract(archive[:len(archive) // 2])
+    assert not extractor.finished
+    folder = server_simple.RECEIVED_DIR / "partial"
+    assert sorted(path.name for path in folder.iterdir()) == ["done.txt"]
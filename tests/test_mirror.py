@@ -0,0 +1,82 @@
+"""镜像同步的判断逻辑：删除记录、本机清理记录和新旧比较"""
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+import server_simple
+from server_simple import MirrorService
+
+DAY = 86400
+
+
+def remote(name: str, data: bytes, mtime: float) -> dict:
+    return {"id": name, "size": len(data), "mtime_ns": int(mtime * 1e9), "sha256": hashlib.sha256(data).hexdigest()}
+
+
+def test_newer_remote_version_wins():
+    local = remote("a.txt", b"old", 100)
+    assert MirrorService.wants(remote("a.txt", b"new", 200), local, None)
+    assert not MirrorService.wants(remote("a.txt", b"older", 50), local, None)
+    assert not MirrorService.wants(remote("a.txt", b"old", 300), local, None)
+
+
+def test_tombstone_blocks_versions_deleted_here():
+    tombstone = {"id": "a.txt", "sha256": None, "deleted": 150.0}
+    assert not MirrorService.wants(remote("a.txt", b"v1", 100), None, tombstone)
+    assert MirrorService.wants(remote("never-seen.txt", b"v2", 200), None, tombstone)
+
+
+@pytest.fixture
+def shared_file():
+    created = []
+
+    def create(name: str, data: bytes, age_days: float):
+        file_path = server_simple.SHARED_DIR / name
+        file_path.write_bytes(data)
+        mtime = time.time() - age_days * DAY
+        os.utime(file_path, (mtime, mtime))
+        server_simple.content_index.record(file_path, hashlib.sha256(data).hexdigest())
+        server_simple.get_directory_index(server_simple.SHARED_DIR).update(file_path)
+        created.append(name)
+        return file_path
+
+    yield create
+    with server_simple.metadata_store.transaction() as connection:
+        for name in created:
+            (server_simple.SHARED_DIR / name).unlink(missing_ok=True)
+            connection.execute("DELETE FROM mirror_tombstones WHERE path = ?", (name,))
+            connection.execute("DELETE FROM mirror_evictions WHERE path = ?", (name,))
+    server_simple.get_directory_index(server_simple.SHARED_DIR).rescan()
+
+
+def test_user_delete_writes_tombstone_with_hash(shared_file):
+    file_path = shared_file("deleted.txt", b"delete me", 1)
+    server_simple.delete_stored_file(server_simple.SHARED_DIR, file_path)
+    tombstone = server_simple.mirror_service.tombstones()["deleted.txt"]
+    assert tombstone["sha256"] == hashlib.sha256(b"delete me").hexdigest()
+
+
+def test_retention_eviction_does_not_replicate(shared_file):
+    data = b"evicted by local quota"
+    shared_file("evicted.txt", data, 40)
+    policy = {"max_bytes": 0, "max_files": 0, "max_age_days": 30, "evict": "age"}
+    summary = server_simple.retention_manager.evict_directory("shared", policy, threading.Event())
+    assert summary["files"] == 1
+
+    service = server_simple.mirror_service
+    assert "evicted.txt" not in service.tombstones()
+    eviction = service.evictions()["evicted.txt"]
+    # 其他节点上的同一版本不会被拉取回来，之后更新的版本照常同步
+    assert not MirrorService.wants(remote("evicted.txt", data, time.time() - 40 * DAY), None, None, eviction)
+    assert MirrorService.wants(remote("evicted.txt", b"edited later", time.time() + 60), None, None, eviction)
+
+
+def test_reupload_clears_eviction(shared_file):
+    shared_file("again.txt", b"v1", 40)
+    server_simple.delete_stored_file(server_simple.SHARED_DIR, server_simple.SHARED_DIR / "again.txt",
+                                     replicate=False)
+    shared_file("again.txt", b"v2", 0)
+    assert "again.txt" not in server_simple.mirror_service.evictions()
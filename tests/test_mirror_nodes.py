@@ -0,0 +1,163 @@
+"""
+多节点镜像：每个节点是独立数据目录和配置的 server_simple.py 进程，
+检查文件复制（含子目录）、删除传播、同名冲突、断点文件损坏后重新下载，以及进程被杀后从断点继续。
+"""
+import hashlib
+import io
+import os
+import sqlite3
+import tarfile
+import time
+import uuid
+
+MIRROR_INTERVAL = 2
+TIMEOUT = 60
+
+
+def wait_until(condition, timeout: float = TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(0.2)
+    raise AssertionError(f"{timeout} 秒内没有完成同步")
+
+
+def connect(nodes: list, **config):
+    """每个节点都把其他节点列为 peers"""
+    for node in nodes:
+        peers = [other.url for other in nodes if other is not node]
+        node.write_config({"peers": peers, "mirror_interval": MIRROR_INTERVAL, **config})
+
+
+def start_cluster(server_factory, count: int) -> list:
+    nodes = [server_factory(f"node{number}") for number in range(count)]
+    connect(nodes)
+    return [node.start() for node in nodes]
+
+
+def upload_shared(node, name: str, data: bytes):
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n\r\n'.encode()
+        + data
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+    status, response = node.request("POST", "/upload_shared", body,
+                                    {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    assert status == 200, response
+
+
+def upload_folder(node, files: dict[str, bytes]):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.USTAR_FORMAT) as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            archive.addfile(info, io.BytesIO(data))
+    status, response = node.request("POST", "/upload_folder?target=shared", buffer.getvalue())
+    assert status == 200, response
+
+
+def has_content(node, name: str, data: bytes) -> bool:
+    try:
+        return (node.shared_dir / name).read_bytes() == data
+    except OSError:
+        return False
+
+
+def mirrored_bytes(node) -> int:
+    status, body = node.request("GET", "/metrics")
+    assert status == 200
+    return sum(
+        int(float(line.rsplit(" ", 1)[1]))
+        for line in body.decode().splitlines() if line.startswith("transfer_mirror_bytes_total{")
+    )
+
+
+def test_files_and_folders_replicate_to_every_node(server_factory):
+    nodes = start_cluster(server_factory, 3)
+    data = os.urandom(300 * 1024)
+    upload_shared(nodes[0], "report.bin", data)
+    upload_folder(nodes[1], {"album/2024/photo.jpg": b"jpeg" * 1000, "album/notes.txt": b"notes"})
+
+    for node in nodes:
+        wait_until(lambda: has_content(node, "report.bin", data))
+        wait_until(lambda: has_content(node, "album/2024/photo.jpg", b"jpeg" * 1000))
+        wait_until(lambda: has_content(node, "album/notes.txt", b"notes"))
+
+
+def test_delete_propagates_and_is_not_pulled_back(server_factory):
+    nodes = start_cluster(server_factory, 3)
+    upload_shared(nodes[0], "temporary.txt", b"soon gone")
+    for node in nodes:
+        wait_until(lambda: has_content(node, "temporary.txt", b"soon gone"))
+
+    status, body = nodes[2].request("POST", "/delete_shared/temporary.txt")
+    assert status == 200, body
+    for node in nodes:
+        wait_until(lambda: not (node.shared_dir / "temporary.txt").exists())
+    # 再等几轮同步，已删除的版本不会从还没收到删除记录的节点拉回来
+    time.sleep(3 * MIRROR_INTERVAL)
+    assert not any((node.shared_dir / "temporary.txt").exists() for node in nodes)
+
+
+def test_conflicting_versions_converge_to_newest(server_factory):
+    nodes = [server_factory(f"node{number}") for number in range(3)]
+    now = time.time()
+    for node, (data, age) in zip(nodes, [(b"old version", 300), (b"newest version", 10), (b"middle", 100)]):
+        node.shared_dir.mkdir(parents=True, exist_ok=True)
+        file_path = node.shared_dir / "plan.txt"
+        file_path.write_bytes(data)
+        os.utime(file_path, (now - age, now - age))
+    connect(nodes)
+    for node in nodes:
+        node.start()
+
+    for node in nodes:
+        wait_until(lambda: has_content(node, "plan.txt", b"newest version"))
+
+
+def test_corrupt_partial_download_is_discarded(server_factory):
+    source, target = [server_factory(name) for name in ("source", "target")]
+    data = os.urandom(512 * 1024)
+    digest = hashlib.sha256(data).hexdigest()
+    source.shared_dir.mkdir(parents=True, exist_ok=True)
+    (source.shared_dir / "archive.bin").write_bytes(data)
+    # 断点文件的前半部分内容是错的，续传后整体校验失败，下一轮从头下载
+    mirror_dir = target.data_dir / ".mirror"
+    mirror_dir.mkdir(parents=True)
+    (mirror_dir / f"{digest}.part").write_bytes(os.urandom(200 * 1024))
+    connect([source, target])
+    source.start()
+    target.start()
+
+    wait_until(lambda: has_content(target, "archive.bin", data))
+    assert not (mirror_dir / f"{digest}.part").exists()
+
+
+def test_killed_node_resumes_from_partial_file(server_factory):
+    size = 4 * 1024 * 1024
+    source, target = [server_factory(name) for name in ("source", "target")]
+    connect([source, target], mirror_bandwidth=256 * 1024)
+    source.start()
+    target.start()
+    data = os.urandom(size)
+    upload_shared(source, "large.bin", data)
+
+    part_path = target.data_dir / ".mirror" / f"{hashlib.sha256(data).hexdigest()}.part"
+    wait_until(lambda: part_path.exists() and part_path.stat().st_size >= size // 4)
+    target.kill()
+    partial = part_path.stat().st_size
+    assert 0 < partial < size
+    # 被杀的进程来不及释放镜像租约，模拟租约过期，不必等满 MIRROR_LEASE_TTL
+    with sqlite3.connect(target.data_dir / ".metadata.sqlite3") as connection:
+        connection.execute("DELETE FROM maintenance_leases WHERE name = 'mirror'")
+
+    # 重启后不再限速，只需要下载剩下的部分
+    connect([source, target])
+    target.start()
+    wait_until(lambda: has_content(target, "large.bin", data))
+    assert mirrored_bytes(target) == size - partial
+
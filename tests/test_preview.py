@@ -0,0 +1,76 @@
+"""分页预览：按字节偏移和按行读取都有内存上限，UTF-16 按字符单元对齐"""
+import codecs
+
+import pytest
+
+import server_simple
+from server_simple import MAX_PREVIEW_PAGE_SIZE, read_preview_page
+
+
+@pytest.fixture
+def text_file(tmp_path):
+    def create(data: bytes):
+        file_path = tmp_path / "preview.txt"
+        file_path.write_bytes(data)
+        return file_path
+    return create
+
+
+def test_offset_is_aligned_to_next_line(text_file):
+    file_path = text_file(b"first line\nsecond line\nthird line\n")
+    page = read_preview_page(file_path, 14, 1024, None, 0)
+    assert page["offset"] == len(b"first line\nsecond line\n")
+    assert page["content"] == "third line\n"
+    assert page["eof"]
+
+
+def test_alignment_scan_is_bounded_without_newlines(text_file):
+    file_path = text_file(b"a" * (3 * MAX_PREVIEW_PAGE_SIZE))
+    page = read_preview_page(file_path, 10, 4096, None, 0)
+    # 找不到换行时从请求的位置开始，而不是跳到文件末尾
+    assert page["offset"] == 10
+    assert len(page["content"]) == 4096
+    assert page["next_offset"] == 10 + 4096
+
+
+def test_line_mode_stops_at_page_size(text_file):
+    line = b"x" * 1023 + b"\n"
+    file_path = text_file(line * 5000)
+    page = read_preview_page(file_path, 0, 1024, 0, server_simple.MAX_PREVIEW_LINES)
+    assert len(page["content"]) == MAX_PREVIEW_PAGE_SIZE
+    assert page["next_offset"] == MAX_PREVIEW_PAGE_SIZE
+    assert page["next_line"] == MAX_PREVIEW_PAGE_SIZE // len(line)
+    assert not page["eof"]
+
+
+def test_line_mode_splits_overlong_line(text_file):
+    file_path = text_file(b"y" * (2 * MAX_PREVIEW_PAGE_SIZE) + b"\nend\n")
+    page = read_preview_page(file_path, 0, 1024, 0, 10)
+    assert len(page["content"]) == MAX_PREVIEW_PAGE_SIZE
+    # 停在行中间，只能按字节偏移继续
+    assert page["next_line"] is None
+    assert page["next_offset"] == MAX_PREVIEW_PAGE_SIZE
+
+
+@pytest.mark.parametrize("encoding", ["utf-16-le", "utf-16-be"])
+def test_utf16_pages_align_to_code_units(text_file, encoding):
+    bom = codecs.BOM_UTF16_LE if encoding == "utf-16-le" else codecs.BOM_UTF16_BE
+    # "一ਊ一" 编码后跨字符单元的两个字节正好是换行符，不能被当成换行
+    lines = [f"第{number}行 一ਊ一 text\n" for number in range(200)]
+    file_path = text_file(bom + "".join(lines).encode(encoding))
+
+    first = read_preview_page(file_path, 0, 1000, None, 0)
+    assert first["content"].startswith("第0行")
+    second = read_preview_page(file_path, first["next_offset"], 1000, None, 0)
+    assert second["content"].startswith("第")
+    assert "".join(lines).startswith(first["content"] + second["content"])
+
+    # 奇数偏移先对齐到字符单元，再对齐到下一行
+    middle = read_preview_page(file_path, 101, 1000, None, 0)
+    assert middle["offset"] % 2 == 0
+    assert middle["content"].split("\n", 1)[0] + "\n" in lines
+
+    by_line = read_preview_page(file_path, 0, 1000, 50, 3)
+    assert by_line["content"] == "".join(lines[50:53])
+    assert by_line["next_line"] == 53
+    assert read_preview_page(file_path, 0, 1000, 199, 5)["content"] == lines[199]
@@ -0,0 +1,87 @@
+"""保留策略：清理计划的顺序和原因，硬链接只计算一次容量"""
+import os
+import threading
+import time
+
+import pytest
+
+import server_simple
+from server_simple import RetentionManager
+
+NOW = 1_700_000_000.0
+DAY = 86400
+
+
+def policy(**overrides) -> dict:
+    return {"max_bytes": 0, "max_files": 0, "max_age_days": 0, "evict": "lru", **overrides}
+
+
+def entries(*specs) -> dict[str, dict]:
+    return {name: {"size": size, "mtime_ts": NOW - age_days * DAY} for name, size, age_days in specs}
+
+
+def test_expired_files_are_removed_first():
+    plan = RetentionManager.plan(entries(("old", 1, 40), ("new", 1, 1)), {}, policy(max_age_days=30), NOW)
+    assert [(name, reason) for name, _, reason in plan] == [("old", "age")]
+
+
+def test_file_count_limit_evicts_oldest():
+    plan = RetentionManager.plan(entries(("a", 1, 3), ("b", 1, 2), ("c", 1, 1)), {}, policy(max_files=1), NOW)
+    assert [(name, reason) for name, _, reason in plan] == [("a", "files"), ("b", "files")]
+
+
+def test_lru_keeps_recently_downloaded_files():
+    files = entries(("a", 10, 3), ("b", 10, 2), ("c", 10, 1))
+    accessed = {"a": NOW}
+    lru = RetentionManager.plan(files, accessed, policy(max_bytes=20), NOW)
+    age = RetentionManager.plan(files, accessed, policy(max_bytes=20, evict="age"), NOW)
+    assert [name for name, _, _ in lru] == ["b"]
+    assert [name for name, _, _ in age] == ["a"]
+
+
+def test_hardlinks_count_once_toward_quota():
+    files = entries(("a", 100, 3), ("a_copy", 100, 2), ("b", 100, 1))
+    inodes = {"a": (1, 10), "a_copy": (1, 10), "b": (1, 11)}
+    # 实际占用 200 字节，没有超出上限
+    assert RetentionManager.plan(files, {}, policy(max_bytes=200), NOW, inodes) == []
+    # 删除 a 不释放空间，要连 a_copy 一起删除才能回到 100 字节以内
+    plan = RetentionManager.plan(files, {}, policy(max_bytes=100), NOW, inodes)
+    assert [name for name, _, _ in plan] == ["a", "a_copy"]
+
+
+@pytest.fixture
+def received_files():
+    base_dir = server_simple.RECEIVED_DIR
+    created = []
+
+    def create(name: str, data: bytes | None, age_days: float, link_to=None):
+        file_path = base_dir / name
+        if link_to is None:
+            file_path.write_bytes(data)
+            mtime = time.time() - age_days * DAY
+            os.utime(file_path, (mtime, mtime))
+        else:
+            os.link(link_to, file_path)
+        created.append(file_path)
+        return file_path
+
+    yield create
+    for file_path in created:
+        file_path.unlink(missing_ok=True)
+    server_simple.get_directory_index(base_dir).rescan()
+
+
+def test_evicting_a_hardlink_credits_no_freed_bytes(received_files):
+    original = received_files("linked.bin", b"x" * 1000, 40)
+    duplicate = received_files("linked_copy.bin", None, 40, link_to=original)
+    fresh = received_files("fresh.bin", b"y" * 500, 1)
+    server_simple.get_directory_index(server_simple.RECEIVED_DIR).rescan()
+
+    summary = server_simple.retention_manager.evict_directory(
+        "received", policy(max_age_days=30, max_bytes=10 ** 9), threading.Event()
+    )
+    assert summary["files"] == 2
+    # 两个链接都被删除，只有最后一个释放了 1000 字节
+    assert summary["bytes"] == 1000
+    assert not original.exists() and not duplicate.exists()
+    assert fresh.exists()
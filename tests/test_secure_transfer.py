@@ -0,0 +1,102 @@
+"""加密分帧格式：往返解密、长度计算，以及篡改、重排和截断检测"""
+import os
+
+import pytest
+
+from secure_transfer import (
+    FINAL_FLAG, FRAME_HEADER, STREAM_HEADER_SIZE, StreamDecryptor, StreamEncryptor, StreamIntegrityError,
+    encrypted_size, iter_encrypted_file,
+)
+
+KEY = b"test pre-shared key"
+FRAME_SIZE = 4096
+
+
+def encrypt(data: bytes, frame_size: int = FRAME_SIZE) -> list[bytes]:
+    """返回流头和每一帧，最后一帧是空的结束帧"""
+    encryptor = StreamEncryptor(KEY)
+    frames = [encryptor.encrypt_frame(data[start:start + frame_size])
+              for start in range(0, len(data), frame_size)]
+    return [encryptor.header, *frames, encryptor.encrypt_frame(b"", final=True)]
+
+
+def decrypt(stream: bytes, piece: int = 1000, key: bytes = KEY) -> bytes:
+    decryptor = StreamDecryptor(key)
+    plain = []
+    for position in range(0, len(stream), piece):
+        plain.extend(decryptor.feed(stream[position:position + piece]))
+    decryptor.finish()
+    return b"".join(plain)
+
+
+@pytest.mark.parametrize("size", [0, 1, FRAME_SIZE, 3 * FRAME_SIZE + 17])
+def test_round_trip_and_size(size):
+    data = os.urandom(size)
+    stream = b"".join(encrypt(data))
+    assert len(stream) == encrypted_size(size, FRAME_SIZE)
+    assert decrypt(stream) == data
+
+
+def test_file_iterator_matches_encrypted_size(tmp_path):
+    file_path = tmp_path / "plain.bin"
+    data = os.urandom(2 * FRAME_SIZE + 5)
+    file_path.write_bytes(data)
+    stream = b"".join(iter_encrypted_file(file_path, KEY, FRAME_SIZE))
+    assert len(stream) == encrypted_size(len(data), FRAME_SIZE)
+    assert decrypt(stream, piece=7) == data
+
+
+def test_each_stream_uses_a_fresh_salt():
+    assert encrypt(b"same")[0] != encrypt(b"same")[0]
+
+
+def test_wrong_key_is_rejected():
+    with pytest.raises(StreamIntegrityError):
+        decrypt(b"".join(encrypt(b"secret")), key=b"another key")
+
+
+def test_flipped_bit_is_rejected():
+    stream = bytearray(b"".join(encrypt(os.urandom(FRAME_SIZE))))
+    stream[STREAM_HEADER_SIZE + FRAME_HEADER.size + 10] ^= 1
+    with pytest.raises(StreamIntegrityError):
+        decrypt(bytes(stream))
+
+
+def test_reordered_frames_are_rejected():
+    header, first, second, final = encrypt(os.urandom(2 * FRAME_SIZE))
+    with pytest.raises(StreamIntegrityError):
+        decrypt(header + second + first + final)
+
+
+def test_dropped_frame_is_rejected():
+    header, first, second, final = encrypt(os.urandom(2 * FRAME_SIZE))
+    with pytest.raises(StreamIntegrityError):
+        decrypt(header + second + final)
+
+
+def test_truncated_stream_is_rejected():
+    header, *frames, final = encrypt(os.urandom(2 * FRAME_SIZE))
+    # 在帧边界截断，每一帧都能单独校验通过，只有缺少结束帧才能发现
+    with pytest.raises(StreamIntegrityError):
+        decrypt(header + b"".join(frames))
+    with pytest.raises(StreamIntegrityError):
+        decrypt(header + b"".join(frames) + final[:-1])
+
+
+def test_final_flag_cannot_be_forged():
+    header, first, second, final = encrypt(os.urandom(2 * FRAME_SIZE))
+    (length,) = FRAME_HEADER.unpack_from(first)
+    forged = FRAME_HEADER.pack(length | FINAL_FLAG) + first[FRAME_HEADER.size:]
+    with pytest.raises(StreamIntegrityError):
+        decrypt(header + forged)
+
+
+def test_data_after_final_frame_is_rejected():
+    stream = b"".join(encrypt(b"data"))
+    with pytest.raises(StreamIntegrityError):
+        decrypt(stream + bytes(FRAME_HEADER.size))
+
+
+def test_not_an_encrypted_stream():
+    with pytest.raises(StreamIntegrityError):
+        decrypt(b"plain text that is not encrypted")
@@ -0,0 +1,46 @@
+"""缩略图：进程池以 spawn 启动，子进程重新执行启动脚本时不做服务器的初始化"""
+import io
+from pathlib import Path
+
+import pytest
+
+PIL = pytest.importorskip("PIL.Image")
+
+
+def png_bytes() -> bytes:
+    buffer = io.BytesIO()
+    PIL.new("RGBA", (640, 480), (200, 30, 30, 255)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def spawned_workers(server) -> list[int]:
+    return [pid for pid in server.descendants()
+            if b"spawn_main" in Path(f"/proc/{pid}/cmdline").read_bytes()]
+
+
+@pytest.mark.skipif(not Path("/proc/self/fd").exists(), reason="需要 /proc 查看子进程")
+def test_thumbnail_workers_skip_server_startup(server_factory):
+    server = server_factory(config={"thumbnail_workers": 1}).start()
+    (server.shared_dir / "photo.png").write_bytes(png_bytes())
+    # 模拟一个正在进行的上传
+    in_progress = server.data_dir / ".staging" / "upload.part"
+    in_progress.write_bytes(b"partial")
+
+    status, body = server.request("GET", "/thumbnail/photo.png")
+    assert status == 200, body
+    assert body.startswith(b"\xff\xd8")
+    assert in_progress.read_bytes() == b"partial"
+    workers = spawned_workers(server)
+    assert len(workers) == 1
+    assert server.opens_metadata_db(server.process.pid)
+    assert not server.opens_metadata_db(workers[0])
+
+
+def test_thumbnail_pool_uses_spawn():
+    import server_simple
+
+    executor = server_simple.ThumbnailCache(server_simple.THUMBNAIL_DIR, 0).get_executor()
+    try:
+        assert executor._mp_context.get_start_method() == "spawn"
+    finally:
+        executor.shutdown()
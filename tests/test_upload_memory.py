@@ -0,0 +1,74 @@
+"""多个大文件同时上传时，服务进程的内存不随上传总量增长"""
+import http.client
+import threading
+from pathlib import Path
+
+import pytest
+
+from load_suite import RssSampler
+
+FILE_SIZE = 96 * 1024 * 1024
+CONCURRENT_UPLOADS = 4
+BLOCK = bytes(range(256)) * 4096
+# 上传总量为 384MB，流式写盘时峰值内存只比空闲时多出若干个分块
+MAX_RSS_GROWTH = 96 * 1024 * 1024
+
+
+def multipart_upload(port: int, filename: str, size: int) -> int:
+    boundary = "transfer-test-boundary"
+    head = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def body():
+        yield head
+        remaining = size
+        while remaining:
+            chunk = BLOCK[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+        yield tail
+
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    try:
+        connection.request("POST", "/upload", body=body(), headers={
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            "Content-Length": str(len(head) + size + len(tail)),
+        })
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+@pytest.mark.skipif(not Path("/proc").is_dir(), reason="需要 /proc 采样进程内存")
+def test_concurrent_large_uploads_keep_rss_flat(server_factory):
+    server = server_factory(config={"max_concurrent_uploads": 16, "max_inflight_upload_bytes": 2 ** 32}).start()
+    sampler = RssSampler(server.process.pid)
+    # 先上传一个小文件让所有模块和线程池完成初始化，再以此时的内存为基准
+    assert multipart_upload(server.port, "warmup.bin", 1024 * 1024) == 200
+    baseline = sampler.sample()
+    sampler.start()
+    statuses = []
+    threads = [
+        threading.Thread(target=lambda name=f"large_{index}.bin": statuses.append(
+            multipart_upload(server.port, name, FILE_SIZE)
+        ))
+        for index in range(CONCURRENT_UPLOADS)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sampler.stop()
+
+    assert statuses == [200] * CONCURRENT_UPLOADS
+    for index in range(CONCURRENT_UPLOADS):
+        assert (server.data_dir / "received_files" / f"large_{index}.bin").stat().st_size == FILE_SIZE
+    growth = max(sampler.peak_bytes, sampler.sample()) - baseline
+    assert growth < MAX_RSS_GROWTH, f"峰值内存比空闲时多 {growth / 1024 / 1024:.0f}MB"
@@ -0,0 +1,39 @@
+"""断点续传上传会话：分块请求头的 Content-Length 校验"""
+import pytest
+from fastapi.testclient import TestClient
+
+import server_simple
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(server_simple.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def session_id(client):
+    response = client.post("/upload_session", data={"filename": "chunked.bin", "size": "10"})
+    assert response.status_code == 200, response.text
+    yield response.json()["session_id"]
+    server_simple.remove_upload_session(response.json()["session_id"])
+
+
+@pytest.mark.parametrize("content_length", ["abc", "-1", "1.5"])
+def test_malformed_content_length_is_rejected(client, session_id, content_length):
+    response = client.put(f"/upload_session/{session_id}?offset=0", content=b"0123",
+                          headers={"Content-Length": content_length})
+    assert response.status_code == 400
+    assert response.json() == {"success": False, "message": "Content-Length 不合法"}
+
+
+def test_chunk_beyond_file_size_is_rejected(client, session_id):
+    response = client.put(f"/upload_session/{session_id}?offset=8", content=b"0123")
+    assert response.status_code == 400
+    assert response.json()["message"] == "分块大小超出文件范围"
+
+
+def test_chunk_is_recorded(client, session_id):
+    response = client.put(f"/upload_session/{session_id}?offset=0", content=b"0123")
+    assert response.status_code == 200, response.text
+    assert response.json()["received"] == [[0, 4]]
@@ -0,0 +1,32 @@
+"""多进程模式：主进程只负责监听和管理工作进程，每个工作进程只初始化一次"""
+import re
+import time
+from pathlib import Path
+
+import pytest
+
+WORKERS = 2
+
+
+@pytest.mark.skipif(not Path("/proc/self/fd").exists(), reason="需要 /proc 查看子进程")
+def test_each_worker_initializes_once(server_factory):
+    server = server_factory(config={"workers": WORKERS}).start()
+    log_path = server.root / "server.log"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        started = re.findall(r"服务进程 (\d+) 初始化完成", log_path.read_text(encoding="utf-8"))
+        if len(started) >= WORKERS:
+            break
+        time.sleep(0.2)
+
+    workers = [pid for pid in server.descendants()
+               if b"spawn_main" in Path(f"/proc/{pid}/cmdline").read_bytes()]
+    assert sorted(map(int, started)) == sorted(workers)
+    assert len(workers) == WORKERS
+    # 启动脚本在主进程和工作进程中都会执行，但只有工作进程打开元数据库
+    assert not server.opens_metadata_db(server.process.pid)
+    assert all(server.opens_metadata_db(pid) for pid in workers)
+
+    # 请求分散到各个工作进程，每次都能正常处理
+    for _ in range(10):
+        assert server.get_json("/mirror/status")["success"]
@@ -0,0 +1,29 @@
+"""
+缩略图生成：在独立的进程池中解码图片
+
+缩略图进程以 spawn 方式启动。子进程会以 __mp_main__ 的名字重新执行启动脚本，
+因此 server_simple 导入时只定义函数和对象，初始化都在 initialize_server 中完成；
+生成函数放在这个只依赖 Pillow 的模块里，子进程反序列化任务时不必再导入一份服务器模块。
+"""
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 缩略图是可选功能，未安装 Pillow 时不提供
+    Image = None
+
+PILLOW_AVAILABLE = Image is not None
+
+
+def generate_thumbnail(source: str, destination: str, size: int) -> int:
+    """在子进程中解码图片并生成 JPEG 缩略图，返回缩略图大小"""
+    with Image.open(source) as image:
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        temp_path = f"{destination}.{os.getpid()}.tmp"
+        image.save(temp_path, "JPEG", quality=80, optimize=True)
+    os.replace(temp_path, destination)
+    return os.path.getsize(destination)